@@ -0,0 +1,270 @@
+"""
+Benchmark della pipeline SDD - benchmarks/bench_pipeline.py
+Descrizione: misura tempo, throughput e picco di memoria di ogni fase
+             (lettura, normalizzazione, validazione, aggregazione, lotto, XML anche su
+             più processi) su dati
+             sintetici, salva i risultati in JSON e li confronta con una baseline
+
+Ogni dimensione viene eseguita in un processo separato, così il picco di
+memoria di una misura non influenza le altre. Il tempo è il migliore su
+``--ripetizioni`` esecuzioni; il picco di memoria è misurato con tracemalloc
+in un'esecuzione a parte (include numpy, non i buffer interni di pyarrow).
+
+Esempi:
+    python benchmarks/bench_pipeline.py --salva benchmarks/risultati/baseline.json
+    python benchmarks/bench_pipeline.py --righe 1000 100000 --baseline benchmarks/risultati/baseline.json
+"""
+
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import pandas as pd  # noqa: E402
+
+import sdd_xml_core as core  # noqa: E402
+from genera_dati import csv_incassi_bytes  # noqa: E402
+
+RIGHE_DEFAULT = [1000, 100_000, 1_000_000]
+# Variazioni assolute sotto queste soglie sono considerate rumore di misura
+RUMORE = {"secondi": 0.01, "picco_mb": 1.0}
+FASI = ["lettura", "normalizzazione", "validazione", "aggregazione", "lotto", "xml", "xml_parallelo",
+        "pipeline_a_blocchi"]
+
+DATI_AZIENDALI = {
+    "nome_azienda": "BENCHMARK SRL",
+    "indirizzo_azienda": "Via dei Test 1",
+    "iban": "IT60X0542811101000000123456",
+    "abi": "05428",
+    "creditor_id": "IT00ZZZ0000000000000000",
+    "prefisso_mandato": "BNC",
+}
+
+
+class SinkNullo:
+    """Sink di byte che scarta l'output e ne conta la dimensione."""
+
+    def __init__(self):
+        self.byte = 0
+
+    def write(self, dati: bytes):
+        self.byte += len(dati)
+
+
+def _silenzio(livello, messaggio):
+    pass
+
+
+def esegui_fasi(dati: bytes) -> dict:
+    """Esegue una volta tutte le fasi e restituisce {fase: secondi}."""
+    tempi = {}
+
+    inizio = time.perf_counter()
+    df = core.leggi_csv_incassi(io.BytesIO(dati), _silenzio)
+    tempi["lettura"] = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    df, _ = core.mappa_colonne_incassi(df, _silenzio)
+    df = core.normalizza_incassi(df)
+    tempi["normalizzazione"] = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    report = core.valida_incassi(df)
+    tempi["validazione"] = time.perf_counter() - inizio
+    if (report["gravita"] == "errore").any():
+        raise ValueError(core.riepilogo_validazione(report))
+
+    inizio = time.perf_counter()
+    df_aggregato = core.aggrega_incassi(df)
+    tempi["aggregazione"] = time.perf_counter() - inizio
+    del df
+
+    inizio = time.perf_counter()
+    lotto = core.LottoIncassi.da_dataframe(df_aggregato)
+    tempi["lotto"] = time.perf_counter() - inizio
+    del df_aggregato
+
+    inizio = time.perf_counter()
+    core.scrivi_xml_cbi(SinkNullo(), DATI_AZIENDALI, lotto, "2030-01-10", "BENCH")
+    tempi["xml"] = time.perf_counter() - inizio
+
+    inizio = time.perf_counter()
+    core.scrivi_xml_cbi(SinkNullo(), DATI_AZIENDALI, lotto, "2030-01-10", "BENCH", processi=None)
+    tempi["xml_parallelo"] = time.perf_counter() - inizio
+    del lotto
+
+    inizio = time.perf_counter()
+    blocchi = core.leggi_csv_incassi_a_blocchi(io.BytesIO(dati), notifica=_silenzio)
+    core.processa_csv_incassi_a_blocchi(blocchi, _silenzio)
+    tempi["pipeline_a_blocchi"] = time.perf_counter() - inizio
+
+    return tempi
+
+
+def misura_memoria(dati: bytes) -> dict:
+    """Picco di memoria (MB, tracemalloc) di ogni fase."""
+    picchi = {}
+    tracemalloc.start()
+
+    def picco(fase):
+        picchi[fase] = round(tracemalloc.get_traced_memory()[1] / 1e6, 2)
+        tracemalloc.reset_peak()
+
+    df = core.leggi_csv_incassi(io.BytesIO(dati), _silenzio)
+    picco("lettura")
+    df, _ = core.mappa_colonne_incassi(df, _silenzio)
+    df = core.normalizza_incassi(df)
+    picco("normalizzazione")
+    core.valida_incassi(df)
+    picco("validazione")
+    df_aggregato = core.aggrega_incassi(df)
+    picco("aggregazione")
+    del df
+    lotto = core.LottoIncassi.da_dataframe(df_aggregato)
+    picco("lotto")
+    del df_aggregato
+    core.scrivi_xml_cbi(SinkNullo(), DATI_AZIENDALI, lotto, "2030-01-10", "BENCH")
+    picco("xml")
+    # Solo il processo principale: i blocchi generati nei processi figli non sono misurati
+    core.scrivi_xml_cbi(SinkNullo(), DATI_AZIENDALI, lotto, "2030-01-10", "BENCH", processi=None)
+    picco("xml_parallelo")
+    del lotto
+    blocchi = core.leggi_csv_incassi_a_blocchi(io.BytesIO(dati), notifica=_silenzio)
+    core.processa_csv_incassi_a_blocchi(blocchi, _silenzio)
+    picco("pipeline_a_blocchi")
+
+    tracemalloc.stop()
+    return picchi
+
+
+def benchmark_dimensione(righe: int, ripetizioni: int, opzioni_dati: dict, memoria: bool) -> dict:
+    """Benchmark completo per una dimensione (eseguito in un processo dedicato)."""
+    dati = csv_incassi_bytes(righe, **opzioni_dati)
+
+    migliori = {}
+    for _ in range(ripetizioni):
+        for fase, secondi in esegui_fasi(dati).items():
+            migliori[fase] = min(secondi, migliori.get(fase, float("inf")))
+
+    picchi = misura_memoria(dati) if memoria else {}
+
+    return {
+        fase: {
+            "secondi": round(migliori[fase], 4),
+            "righe_al_secondo": round(righe / migliori[fase]) if migliori[fase] else None,
+            "picco_mb": picchi.get(fase),
+        }
+        for fase in FASI
+    }
+
+
+def esegui_benchmark(righe_lista, ripetizioni: int = 3, opzioni_dati: dict = None, memoria: bool = True) -> dict:
+    """Esegue il benchmark per ogni dimensione, ognuna in un processo nuovo."""
+    opzioni_dati = opzioni_dati or {}
+    contesto = multiprocessing.get_context("spawn")
+    risultati = {}
+    for righe in righe_lista:
+        with ProcessPoolExecutor(max_workers=1, mp_context=contesto) as pool:
+            risultati[str(righe)] = pool.submit(
+                benchmark_dimensione, righe, ripetizioni, opzioni_dati, memoria
+            ).result()
+        stampa_dimensione(righe, risultati[str(righe)])
+    return {
+        "data": datetime.now().isoformat(timespec="seconds"),
+        "ambiente": {
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "piattaforma": platform.platform(),
+            "processore": platform.processor() or platform.machine(),
+        },
+        "dati": opzioni_dati,
+        "risultati": risultati,
+    }
+
+
+def stampa_dimensione(righe: int, misure: dict):
+    print(f"\n{righe} righe")
+    print(f"  {'fase':<20}{'secondi':>10}{'righe/s':>14}{'picco MB':>10}")
+    for fase, m in misure.items():
+        picco = "-" if m["picco_mb"] is None else f"{m['picco_mb']:.1f}"
+        print(f"  {fase:<20}{m['secondi']:>10.3f}{m['righe_al_secondo'] or 0:>14,}{picco:>10}")
+
+
+def confronta(attuale: dict, baseline: dict, soglia: float) -> list:
+    """Elenca le regressioni (tempo o memoria oltre ``1 + soglia`` volte la baseline).
+
+    Le differenze assolute entro RUMORE non vengono segnalate.
+    """
+    regressioni = []
+    for righe, fasi in attuale["risultati"].items():
+        for fase, misura in fasi.items():
+            riferimento = baseline.get("risultati", {}).get(righe, {}).get(fase)
+            if not riferimento:
+                continue
+            for chiave in ("secondi", "picco_mb"):
+                nuovo, vecchio = misura.get(chiave), riferimento.get(chiave)
+                if nuovo is None or not vecchio:
+                    continue
+                rapporto = nuovo / vecchio
+                if rapporto > 1 + soglia and nuovo - vecchio > RUMORE[chiave]:
+                    regressioni.append(f"{righe} righe, {fase}, {chiave}: {vecchio} -> {nuovo} ({rapporto:.2f}x)")
+    return regressioni
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark di lettura, aggregazione e generazione XML.")
+    parser.add_argument("--righe", type=int, nargs="+", default=RIGHE_DEFAULT,
+                        help="dimensioni da misurare (default: 1000 100000 1000000)")
+    parser.add_argument("--ripetizioni", type=int, default=3, help="esecuzioni per dimensione (si tiene la migliore)")
+    parser.add_argument("--duplicati", type=float, default=0.3)
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--separatore", default=";")
+    parser.add_argument("--formati-data", nargs="+", default=["%d/%m/%Y", "%Y-%m-%d", "%d.%m.%y"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--senza-memoria", action="store_true", help="salta la misura del picco di memoria")
+    parser.add_argument("--salva", help="file JSON in cui salvare i risultati (es. nuova baseline)")
+    parser.add_argument("--baseline", help="file JSON di una esecuzione precedente da confrontare")
+    parser.add_argument("--soglia", type=float, default=0.2,
+                        help="peggioramento relativo oltre cui segnalare una regressione (default 0.2)")
+    args = parser.parse_args(argv)
+
+    opzioni_dati = {
+        "duplicati": args.duplicati,
+        "encoding": args.encoding,
+        "separatore": "\t" if args.separatore == "\\t" else args.separatore,
+        "formati_data": args.formati_data,
+        "seed": args.seed,
+    }
+    risultato = esegui_benchmark(args.righe, args.ripetizioni, opzioni_dati, not args.senza_memoria)
+
+    if args.salva:
+        Path(args.salva).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.salva, "w", encoding="utf-8") as f:
+            json.dump(risultato, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressioni = confronta(risultato, baseline, args.soglia)
+        if regressioni:
+            print("\nRegressioni rispetto alla baseline:")
+            for r in regressioni:
+                print(f"  {r}")
+            return 1
+        print("\nNessuna regressione rispetto alla baseline.")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,129 @@
+"""
+Generatore di CSV incassi sintetici per i benchmark - benchmarks/genera_dati.py
+Descrizione: produce file incassi riproducibili (seed) con numero di righe,
+             quota di IBAN ripetuti, encoding, separatore e formati data configurabili
+
+Esempio:
+    python benchmarks/genera_dati.py incassi_100k.csv --righe 100000 --duplicati 0.3 \
+        --encoding utf-16 --separatore ";" --formati-data "%d/%m/%Y" "%Y-%m-%d"
+"""
+
+import argparse
+import csv
+import io
+import random
+import sys
+from datetime import date, timedelta
+
+NOMI = ["Mario", "Laura", "Giuseppe", "Anna", "Francesco", "Giulia", "Luca", "Chiara",
+        "Marco", "Sara", "Andrea", "Elena", "Paolo", "Francesca", "Stefano", "Valentina"]
+COGNOMI = ["Rossi", "Bianchi", "Romano", "Colombo", "Ricci", "Marino", "Greco", "Bruno",
+           "Gallo", "Conti", "De Luca", "Mancini", "Costa", "Giordano", "Rizzo", "Lombardi"]
+CAUSALI = ["Fattura {n}/2025 del {d}", "Abbonamento annuale 2025", "Canone mensile {n}",
+           "Rata {n} contratto assistenza", "Quota associativa 2025"]
+INTESTAZIONI = ["nome_debitore", "codice_fiscale", "iban", "importo", "causale", "data_firma_mandato"]
+FORMATI_DATA_DEFAULT = ["%d/%m/%Y"]
+
+
+def iban_italiano(rng: random.Random) -> str:
+    """IBAN italiano sintetico con check digit mod-97 corretti."""
+    bban = (rng.choice("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+            + f"{rng.randrange(100000):05d}{rng.randrange(100000):05d}{rng.randrange(10 ** 12):012d}")
+    numerico = "".join(str(int(c, 36)) for c in bban + "IT00")
+    check = 98 - int(numerico) % 97
+    return f"IT{check:02d}{bban}"
+
+
+# Valori dei caratteri in posizione dispari per il carattere di controllo del codice fiscale
+CF_DISPARI = [1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 2, 4, 18, 20, 11, 3, 6, 8, 12, 14, 16, 10, 22, 25, 24, 23]
+
+
+def codice_fiscale(rng: random.Random) -> str:
+    """Codice fiscale sintetico (16 caratteri) con carattere di controllo corretto."""
+    lettere = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+    cf = ("".join(rng.choice(lettere) for _ in range(6)) + f"{rng.randrange(100):02d}"
+          + rng.choice("ABCDEHLMPRST") + f"{rng.randrange(1, 72):02d}"
+          + rng.choice(lettere) + f"{rng.randrange(1000):03d}")
+    somma = 0
+    for posizione, carattere in enumerate(cf):
+        valore = int(carattere) if carattere.isdigit() else ord(carattere) - 65
+        somma += CF_DISPARI[valore] if posizione % 2 == 0 else valore
+    return cf + lettere[somma % 26]
+
+
+def debitore(rng: random.Random) -> tuple:
+    """(nome, codice fiscale, IBAN, data firma mandato) di un nuovo debitore."""
+    nome = f"{rng.choice(NOMI)} {rng.choice(COGNOMI)}"
+    firma = date(2020, 1, 1) + timedelta(days=rng.randrange(5 * 365))
+    return nome, codice_fiscale(rng), iban_italiano(rng), firma
+
+
+def righe_incassi(righe: int, duplicati: float = 0.3, formati_data=None, seed: int = 0):
+    """Genera le righe del CSV incassi.
+
+    ``duplicati`` è la probabilità che una riga riusi l'IBAN di un debitore
+    già generato (righe da aggregare).
+    """
+    rng = random.Random(seed)
+    formati_data = formati_data or FORMATI_DATA_DEFAULT
+    debitori = []
+    for n in range(righe):
+        if debitori and rng.random() < duplicati:
+            nome, cf, iban, firma = rng.choice(debitori)
+        else:
+            nome, cf, iban, firma = debitore(rng)
+            debitori.append((nome, cf, iban, firma))
+        importo = f"{rng.randrange(100, 500000) / 100:.2f}"
+        if rng.random() < 0.5:
+            importo = importo.replace(".", ",")
+        causale = rng.choice(CAUSALI).format(n=n % 1000 + 1, d=firma.strftime("%d/%m/%Y"))
+        yield [nome, cf, iban, importo, causale, firma.strftime(rng.choice(formati_data))]
+
+
+def scrivi_csv_incassi(destinazione, righe: int, duplicati: float = 0.3, encoding: str = "utf-8",
+                       separatore: str = ",", formati_data=None, intestazioni: bool = True,
+                       seed: int = 0):
+    """Scrive un CSV incassi sintetico su un percorso o su un sink di byte."""
+    if isinstance(destinazione, str):
+        with open(destinazione, "wb") as f:
+            return scrivi_csv_incassi(f, righe, duplicati, encoding, separatore, formati_data,
+                                      intestazioni, seed)
+
+    testo = io.TextIOWrapper(destinazione, encoding=encoding, newline="", write_through=False)
+    writer = csv.writer(testo, delimiter=separatore)
+    if intestazioni:
+        writer.writerow(INTESTAZIONI)
+    writer.writerows(righe_incassi(righe, duplicati, formati_data, seed))
+    testo.flush()
+    testo.detach()
+
+
+def csv_incassi_bytes(righe: int, **opzioni) -> bytes:
+    """CSV incassi sintetico in memoria."""
+    buffer = io.BytesIO()
+    scrivi_csv_incassi(buffer, righe, **opzioni)
+    return buffer.getvalue()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Genera un CSV incassi sintetico.")
+    parser.add_argument("output", help="file CSV da scrivere")
+    parser.add_argument("--righe", type=int, default=1000)
+    parser.add_argument("--duplicati", type=float, default=0.3,
+                        help="quota di righe che ripetono un IBAN già usato (default 0.3)")
+    parser.add_argument("--encoding", default="utf-8")
+    parser.add_argument("--separatore", default=",")
+    parser.add_argument("--formati-data", nargs="+", default=FORMATI_DATA_DEFAULT,
+                        help="formati strftime usati a caso per le date (default %%d/%%m/%%Y)")
+    parser.add_argument("--senza-intestazioni", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    scrivi_csv_incassi(args.output, args.righe, args.duplicati, args.encoding,
+                       "\t" if args.separatore == "\\t" else args.separatore,
+                       args.formati_data, not args.senza_intestazioni, args.seed)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,218 @@
+"""
+Generatore XML SEPA SDD CBI - batch multi-azienda - sdd_xml_batch.py
+Descrizione: genera in parallelo (un processo per core) i flussi di più aziende
+             elencati in un manifest CSV, con tempi ed esito per ogni lavoro
+
+Il manifest ha le colonne: azienda, incassi, data_addebito, id_flusso
+(colonne facoltative: output, incrementale). I percorsi relativi sono
+risolti rispetto alla directory del manifest.
+
+Esempio:
+    python sdd_xml_batch.py manifest.csv --output-dir flussi/ --report esiti.csv
+"""
+
+import argparse
+import csv
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+from sdd_xml_cli import (aggiungi_opzione_compressione, aggiungi_opzione_indice_esiti, aggiungi_opzioni_allocatore,
+                         aggiungi_opzioni_diagnostica, aggiungi_opzioni_suddivisione, aggiungi_opzioni_verifica, limiti_da_argomenti,
+                         opzioni_diagnostica)
+from sdd_xml_core import (carica_dati_aziendali, genera_flusso_da_file, genera_message_id, Strumentazione,
+                          valida_data_addebito, valida_id_flusso)
+
+logger = logging.getLogger("sdd_xml_batch")
+
+COLONNE_MANIFEST = ["azienda", "incassi", "data_addebito", "id_flusso"]
+# Facoltative: nome del file XML e indice della generazione incrementale (uno per azienda)
+COLONNE_FACOLTATIVE = ["output", "incrementale"]
+COLONNE_REPORT = ["numero", "azienda", "incassi", "id_flusso", "esito", "output",
+                  "nb_of_txs", "ctrl_sum", "durata_s", "diagnostica", "variazioni", "verifica", "errore"]
+
+
+def leggi_manifest(percorso) -> list:
+    """Legge il manifest CSV e restituisce la lista dei lavori (dict)."""
+    percorso = Path(percorso)
+    base = percorso.parent
+    with open(percorso, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        mancanti = [c for c in COLONNE_MANIFEST if c not in (reader.fieldnames or [])]
+        if mancanti:
+            raise ValueError(f"Colonne mancanti nel manifest: {', '.join(mancanti)}")
+
+        lavori = []
+        for numero, riga in enumerate(reader, 1):
+            lavoro = {campo: (riga.get(campo) or "").strip() for campo in COLONNE_MANIFEST + COLONNE_FACOLTATIVE}
+            lavoro["numero"] = numero
+            for campo in ("azienda", "incassi", "incrementale"):
+                lavoro[campo] = str(base / lavoro[campo]) if lavoro[campo] else ""
+            lavori.append(lavoro)
+    return lavori
+
+
+def assegna_output(lavori: list, output_dir) -> list:
+    """Assegna a ogni lavoro un file XML di destinazione univoco."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    usati = set()
+    for lavoro in lavori:
+        if lavoro.get("output"):
+            destinazione = Path(output_dir) / lavoro["output"]
+        else:
+            nome = f"SEPA_SDD_CBI_{lavoro['id_flusso'].upper()}_{Path(lavoro['incassi']).stem}_{timestamp}"
+            destinazione = Path(output_dir) / f"{nome}.xml"
+            if destinazione in usati:
+                destinazione = Path(output_dir) / f"{nome}_{lavoro['numero']}.xml"
+        usati.add(destinazione)
+        lavoro["output"] = str(destinazione)
+    return lavori
+
+
+def esegui_lavoro(lavoro: dict) -> dict:
+    """Esegue un singolo lavoro (eseguito nei processi del pool).
+
+    Non solleva eccezioni: gli errori finiscono nel campo ``errore`` del risultato.
+    """
+    inizio = time.perf_counter()
+    risultato = {campo: lavoro.get(campo, "") for campo in ("numero", "azienda", "incassi", "id_flusso")}
+    try:
+        valido, messaggio = valida_data_addebito(lavoro["data_addebito"])
+        if not valido:
+            raise ValueError(messaggio)
+        id_flusso = lavoro["id_flusso"].upper()
+        valido, messaggio = valida_id_flusso(id_flusso)
+        if not valido:
+            raise ValueError(messaggio)
+
+        dati_aziendali = carica_dati_aziendali(lavoro["azienda"])
+        diagnostica = lavoro.get("diagnostica")
+        # I lavori girano già in processi separati: i file di un flusso suddiviso no
+        riepilogo = genera_flusso_da_file(dati_aziendali, lavoro["incassi"], lavoro["data_addebito"],
+                                          id_flusso, lavoro["output"],
+                                          dimensione_blocco=lavoro.get("dimensione_blocco"),
+                                          limiti=lavoro.get("limiti"), processi=1,
+                                          strumentazione=Strumentazione(**diagnostica) if diagnostica else None,
+                                          registro_mandati=lavoro.get("registro_mandati"),
+                                          indice_incrementale=lavoro.get("incrementale") or None,
+                                          compressione=lavoro.get("compressione"),
+                                          verifica=lavoro.get("verifica", False), xsd=lavoro.get("xsd"),
+                                          indice_esiti=lavoro.get("indice_esiti"),
+                                          allocatore=lavoro.get("allocatore"),
+                                          ammetti_duplicati=lavoro.get("ammetti_duplicati", False),
+                                          msg_id=lavoro.get("msg_id"))
+        risultato.update(esito="ok", output=riepilogo["output"], diagnostica=riepilogo.get("diagnostica", ""),
+                         variazioni=riepilogo.get("variazioni", ""), verifica=riepilogo.get("verifica", ""),
+                         nb_of_txs=riepilogo["nb_of_txs"], ctrl_sum=riepilogo["ctrl_sum"])
+    except Exception as e:
+        risultato.update(esito="errore", errore=f"{type(e).__name__}: {e}")
+    risultato["durata_s"] = round(time.perf_counter() - inizio, 3)
+    return risultato
+
+
+def esegui_batch(lavori: list, processi: int = None) -> list:
+    """Esegue i lavori in un pool di processi (default: tutti i core).
+
+    Un lavoro fallito non interrompe gli altri. I risultati sono restituiti
+    nell'ordine del manifest. I MsgId dei lavori senza allocatore sono
+    assegnati qui, nel processo padre, così due lavori con lo stesso ID
+    flusso non generano lo stesso MsgId.
+    """
+    for lavoro in lavori:
+        if not lavoro.get("allocatore") and not lavoro.get("msg_id"):
+            lavoro["msg_id"] = genera_message_id(str(lavoro.get("id_flusso", "")).upper())
+    processi = processi or os.cpu_count() or 1
+    risultati = {}
+    with ProcessPoolExecutor(max_workers=min(processi, max(len(lavori), 1))) as pool:
+        futures = {pool.submit(esegui_lavoro, lavoro): lavoro for lavoro in lavori}
+        for future in as_completed(futures):
+            lavoro = futures[future]
+            try:
+                risultato = future.result()
+            except Exception as e:
+                # Processo terminato in modo anomalo (es. memoria esaurita)
+                risultato = {campo: lavoro.get(campo, "") for campo in ("numero", "azienda", "incassi", "id_flusso")}
+                risultato.update(esito="errore", errore=f"{type(e).__name__}: {e}", durata_s="")
+            risultati[lavoro["numero"]] = risultato
+            logger.info("Lavoro %s (%s): %s in %ss", risultato["numero"], risultato["incassi"],
+                        risultato["esito"], risultato["durata_s"])
+    return [risultati[lavoro["numero"]] for lavoro in lavori]
+
+
+def scrivi_report(risultati: list, destinazione):
+    """Scrive il report CSV con esito e tempi di ogni lavoro."""
+    with open(destinazione, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=COLONNE_REPORT, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(risultati)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Genera in parallelo i flussi SDD elencati in un manifest CSV.")
+    parser.add_argument("manifest", help="CSV con colonne azienda, incassi, data_addebito, id_flusso")
+    parser.add_argument("--output-dir", default=".", help="directory dei file XML (default: corrente)")
+    parser.add_argument("--processi", type=int, default=None, help="numero di processi (default: tutti i core)")
+    parser.add_argument("--report", help="file CSV in cui scrivere esiti e tempi dei lavori")
+    parser.add_argument("--blocchi", type=int, default=None, metavar="RIGHE",
+                        help="legge gli incassi a blocchi di RIGHE righe (per file più grandi della memoria)")
+    aggiungi_opzioni_suddivisione(parser)
+    aggiungi_opzioni_diagnostica(parser)
+    aggiungi_opzione_compressione(parser)
+    aggiungi_opzioni_verifica(parser)
+    parser.add_argument("--registro-mandati", metavar="FILE",
+                        help="database SQLite dei mandati condiviso dai lavori (FRST/RCUR e incassi generati)")
+    aggiungi_opzione_indice_esiti(parser)
+    aggiungi_opzioni_allocatore(parser)
+    parser.add_argument("-v", "--verbose", action="store_true", help="mostra l'avanzamento dei lavori")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    try:
+        lavori = leggi_manifest(args.manifest)
+    except (OSError, ValueError) as e:
+        logger.error("Manifest non valido (%s): %s", args.manifest, e)
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    assegna_output(lavori, args.output_dir)
+    limiti = limiti_da_argomenti(args)
+    diagnostica = opzioni_diagnostica(args)
+    for lavoro in lavori:
+        lavoro["dimensione_blocco"] = args.blocchi
+        lavoro["limiti"] = limiti
+        lavoro["diagnostica"] = diagnostica
+        lavoro["registro_mandati"] = args.registro_mandati
+        lavoro["compressione"] = args.comprimi
+        lavoro["verifica"] = args.verifica
+        lavoro["xsd"] = args.xsd
+        lavoro["indice_esiti"] = args.indice_esiti
+        lavoro["allocatore"] = args.allocatore
+        lavoro["ammetti_duplicati"] = args.ammetti_duplicati
+
+    inizio = time.perf_counter()
+    risultati = esegui_batch(lavori, args.processi)
+    durata = time.perf_counter() - inizio
+
+    for r in risultati:
+        if r["esito"] == "ok":
+            print(f"[{r['numero']}] OK {r['output']}: {r['nb_of_txs']} transazioni, "
+                  f"totale {r['ctrl_sum']} EUR ({r['durata_s']}s)")
+        else:
+            print(f"[{r['numero']}] ERRORE {r['incassi']}: {r['errore']} ({r['durata_s']}s)")
+
+    errori = sum(1 for r in risultati if r["esito"] != "ok")
+    print(f"{len(risultati) - errori}/{len(risultati)} flussi generati in {durata:.2f}s")
+
+    if args.report:
+        scrivi_report(risultati, args.report)
+
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+"""
+Generatore XML SEPA SDD CBI - riga di comando - sdd_xml_cli.py
+Descrizione: genera i flussi XML SEPA SDD CBI senza interfaccia Streamlit
+             (adatto a esecuzioni batch, ad es. da cron)
+
+Esempio:
+    python sdd_xml_cli.py --azienda dati_aziendali.csv --data-addebito 2025-03-10 \\
+        --id-flusso FLX9J372 --output-dir flussi/ incassi_marzo.csv altri_incassi/
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from sdd_xml_core import (carica_dati_aziendali, ESTENSIONI_FILE, FORMATI_COMPRESSIONE, genera_flusso_da_file,
+                          LimitiPartizione, Strumentazione, valida_data_addebito, valida_id_flusso)
+
+logger = logging.getLogger("sdd_xml_cli")
+
+
+def data_addebito_valida(valore: str) -> str:
+    """Tipo argparse: data di addebito YYYY-MM-DD non nel passato."""
+    valido, messaggio = valida_data_addebito(valore)
+    if not valido:
+        raise argparse.ArgumentTypeError(messaggio)
+    return valore
+
+
+def id_flusso_valido(valore: str) -> str:
+    """Tipo argparse: ID flusso normalizzato in maiuscolo."""
+    id_norm = valore.strip().upper()
+    valido, messaggio = valida_id_flusso(id_norm)
+    if not valido:
+        raise argparse.ArgumentTypeError(messaggio)
+    if messaggio != "OK":
+        logger.warning(messaggio)
+    return id_norm
+
+
+def espandi_file_incassi(percorsi) -> list:
+    """Espande le directory nei file incassi (CSV, xlsx, Parquet, Arrow) che contengono (in ordine alfabetico)."""
+    file_incassi = []
+    for percorso in map(Path, percorsi):
+        if percorso.is_dir():
+            file_incassi.extend(sorted(p for p in percorso.iterdir() if p.suffix.lower().lstrip(".") in ESTENSIONI_FILE))
+        else:
+            file_incassi.append(percorso)
+    return file_incassi
+
+
+def nome_file_output(percorso_incassi: Path, timestamp: str) -> str:
+    """Nome del file XML generato per un file incassi."""
+    return f"SEPA_SDD_CBI_{percorso_incassi.stem}_{timestamp}.xml"
+
+
+def crea_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Genera flussi XML SEPA SDD CBI da dati aziendali e incassi (CSV, xlsx, Parquet o Arrow)."
+    )
+    parser.add_argument("incassi", nargs="+",
+                        help="file incassi (CSV, xlsx, Parquet, Arrow) o directory che li contengono")
+    parser.add_argument("--azienda", required=True, help="file con i dati aziendali (CSV, xlsx, Parquet, Arrow)")
+    parser.add_argument("--data-addebito", required=True, type=data_addebito_valida,
+                        help="data di addebito (YYYY-MM-DD)")
+    parser.add_argument("--id-flusso", required=True, type=id_flusso_valido,
+                        help="ID flusso alfanumerico (max 12 caratteri)")
+    parser.add_argument("--output-dir", default=".", help="directory dei file XML (default: corrente)")
+    parser.add_argument("--indent", default="",
+                        help="indentazione degli elementi XML (default: nessuna)")
+    parser.add_argument("--blocchi", type=int, default=None, metavar="RIGHE",
+                        help="legge gli incassi a blocchi di RIGHE righe (per file più grandi della memoria)")
+    aggiungi_opzioni_suddivisione(parser)
+    parser.add_argument("--registro-mandati", metavar="FILE",
+                        help="database SQLite dei mandati: decide FRST/RCUR e registra gli incassi generati")
+    parser.add_argument("--incrementale", metavar="FILE",
+                        help="indice SQLite dell'ultima esecuzione: riusa le transazioni dei debitori invariati "
+                             "e salva <nome>_variazioni.csv")
+    aggiungi_opzione_indice_esiti(parser)
+    aggiungi_opzioni_allocatore(parser)
+    parser.add_argument("--processi", type=int, default=None,
+                        help="processi per generare il flusso: uno per file se suddiviso, altrimenti "
+                             "blocchi di transazioni (default: tutti i core; output identico con 1)")
+    aggiungi_opzione_compressione(parser)
+    aggiungi_opzioni_verifica(parser)
+    aggiungi_opzioni_diagnostica(parser)
+    parser.add_argument("-v", "--verbose", action="store_true", help="mostra i messaggi diagnostici")
+    return parser
+
+
+def aggiungi_opzioni_suddivisione(parser: argparse.ArgumentParser):
+    """Opzioni per suddividere il flusso in più sottodistinte e file."""
+    gruppo = parser.add_argument_group("suddivisione del flusso")
+    gruppo.add_argument("--max-tx-sottodistinta", type=int, default=None, metavar="N",
+                        help="massimo di transazioni per sottodistinta (PmtInf)")
+    gruppo.add_argument("--max-tx-file", type=int, default=None, metavar="N",
+                        help="massimo di transazioni per file")
+    gruppo.add_argument("--max-mb-file", type=float, default=None, metavar="MB",
+                        help="dimensione massima (stimata) di ogni file in MB")
+
+
+def aggiungi_opzione_compressione(parser: argparse.ArgumentParser):
+    """Opzione per consegnare il flusso compresso."""
+    parser.add_argument("--comprimi", choices=FORMATI_COMPRESSIONE, default=None,
+                        help="zip: un unico archivio con tutti i file del flusso; gzip: un .xml.gz per file "
+                             "(gli XML non compressi vengono eliminati)")
+
+
+def aggiungi_opzione_indice_esiti(parser: argparse.ArgumentParser):
+    """Opzione per registrare le transazioni generate nell'indice degli esiti."""
+    parser.add_argument("--indice-esiti", metavar="FILE",
+                        help="database SQLite in cui registrare le transazioni generate, per riconciliare gli "
+                             "esiti della banca con sdd_xml_esiti.py")
+
+
+def aggiungi_opzioni_allocatore(parser: argparse.ArgumentParser):
+    """Opzioni per MsgId univoci tra processi e blocco degli incassi già generati."""
+    gruppo = parser.add_argument_group("identificativi e duplicati")
+    gruppo.add_argument("--allocatore", metavar="FILE",
+                        help="database SQLite condiviso che assegna MsgId univoci (anche tra processi) e blocca "
+                             "gli incassi già generati con stessi IBAN, importo, causale e data di addebito")
+    gruppo.add_argument("--ammetti-duplicati", action="store_true",
+                        help="con --allocatore, genera comunque gli incassi già generati (solo avvisi)")
+
+
+def aggiungi_opzioni_verifica(parser: argparse.ArgumentParser):
+    """Opzioni per verificare i file generati."""
+    gruppo = parser.add_argument_group("verifica del flusso generato")
+    gruppo.add_argument("--verifica", action="store_true",
+                        help="rilegge i file generati e ne ricontrolla totali, identificativi e campi "
+                             "(problemi in <nome>_verifica.csv)")
+    gruppo.add_argument("--xsd", metavar="FILE",
+                        help="valida anche con lo schema XSD CBIBdySDDReq (richiede lxml; implica --verifica)")
+
+
+def limiti_da_argomenti(args) -> LimitiPartizione:
+    """Limiti di suddivisione richiesti sulla riga di comando (None se nessuno)."""
+    limiti = LimitiPartizione(
+        max_tx_sottodistinta=args.max_tx_sottodistinta,
+        max_tx_file=args.max_tx_file,
+        max_byte_file=int(args.max_mb_file * 1024 * 1024) if args.max_mb_file else None,
+    )
+    return limiti if any(limiti) else None
+
+
+def aggiungi_opzioni_diagnostica(parser: argparse.ArgumentParser):
+    """Opzioni per misurare le fasi dell'elaborazione."""
+    gruppo = parser.add_argument_group("diagnostica")
+    gruppo.add_argument("--diagnostica", action="store_true",
+                        help="salva <nome>_diagnostica.json con tempo, righe e picco RSS di ogni fase")
+    gruppo.add_argument("--memoria", action="store_true",
+                        help="misura anche il picco di memoria di ogni fase con tracemalloc "
+                             "(rallenta l'elaborazione; implica --diagnostica)")
+    gruppo.add_argument("--profilo", action="store_true",
+                        help="aggiunge al JSON diagnostico il profilo cProfile (implica --diagnostica)")
+
+
+def opzioni_diagnostica(args) -> dict:
+    """Argomenti di Strumentazione richiesti sulla riga di comando (None se nessuno)."""
+    if not (args.diagnostica or args.memoria or args.profilo):
+        return None
+    return {"memoria": args.memoria, "profilo": args.profilo}
+
+
+def main(argv=None) -> int:
+    args = crea_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    try:
+        dati_aziendali = carica_dati_aziendali(args.azienda)
+    except (OSError, ValueError) as e:
+        logger.error("Dati aziendali non validi (%s): %s", args.azienda, e)
+        return 1
+
+    file_incassi = espandi_file_incassi(args.incassi)
+    if not file_incassi:
+        logger.error("Nessun file incassi trovato")
+        return 1
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+
+    limiti = limiti_da_argomenti(args)
+    diagnostica = opzioni_diagnostica(args)
+    errori = 0
+    usati = set()
+    for percorso in file_incassi:
+        destinazione = Path(args.output_dir) / nome_file_output(percorso, timestamp)
+        if destinazione in usati:
+            # Stesso nome con estensione diversa (es. incassi.csv e incassi.xlsx)
+            destinazione = destinazione.with_name(f"{destinazione.stem}_{percorso.suffix.lstrip('.')}.xml")
+        usati.add(destinazione)
+        try:
+            riepilogo = genera_flusso_da_file(dati_aziendali, percorso, args.data_addebito,
+                                              args.id_flusso, destinazione, args.indent,
+                                              dimensione_blocco=args.blocchi, limiti=limiti,
+                                              processi=args.processi,
+                                              strumentazione=Strumentazione(**diagnostica) if diagnostica else None,
+                                              registro_mandati=args.registro_mandati,
+                                              indice_incrementale=args.incrementale,
+                                              compressione=args.comprimi,
+                                              verifica=args.verifica, xsd=args.xsd,
+                                              indice_esiti=args.indice_esiti, allocatore=args.allocatore,
+                                              ammetti_duplicati=args.ammetti_duplicati)
+        except Exception as e:
+            errori += 1
+            logger.error("%s: %s", percorso, e)
+            continue
+        print(f"{riepilogo['output']}: {riepilogo['nb_of_txs']} transazioni, totale {riepilogo['ctrl_sum']} EUR")
+        if "frst" in riepilogo:
+            print(f"  sequenza: {riepilogo['frst']} FRST, {riepilogo['rcur']} RCUR")
+        if "variazioni" in riepilogo:
+            print(f"  variazioni: {riepilogo['aggiunto']} aggiunti, {riepilogo['modificato']} modificati, "
+                  f"{riepilogo['rimosso']} rimossi, {riepilogo['invariato']} invariati")
+        if "verifica" in riepilogo:
+            print("  verifica: OK" + (f" (avvisi in {riepilogo['verifica']})" if riepilogo["verifica"] else ""))
+        if "diagnostica" in riepilogo:
+            logger.info("Diagnostica: %s", riepilogo["diagnostica"])
+
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
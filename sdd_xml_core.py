@@ -0,0 +1,4360 @@
+"""
+Nucleo del generatore XML SEPA SDD CBI - sdd_xml_core.py
+Descrizione: funzioni pure di lettura, normalizzazione, aggregazione e generazione XML,
+importabili senza Streamlit (usate dall'app e dalla riga di comando)
+"""
+
+import codecs
+import cProfile
+import csv
+import gzip
+import hashlib
+import html
+import io
+import json
+import logging
+import mmap
+import os
+import platform
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import xml.etree.ElementTree as ET
+import zipfile
+import zlib
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+import re
+import sqlite3
+from array import array
+from itertools import accumulate, chain, islice, repeat
+from pathlib import Path
+from typing import NamedTuple
+from xml.parsers import expat
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:  # Windows: niente picco RSS nella diagnostica
+    resource = None
+
+try:
+    import openpyxl
+except ImportError:  # senza openpyxl niente file Excel
+    openpyxl = None
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:  # senza lxml niente validazione XSD dei flussi generati
+    lxml_etree = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.feather
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:  # senza pyarrow niente file Parquet/Arrow
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+_LIVELLI_LOG = {
+    "info": logging.INFO,
+    "write": logging.DEBUG,
+    "success": logging.INFO,
+    "warning": logging.WARNING,
+    "error": logging.ERROR,
+}
+
+
+def notifica_log(livello: str, messaggio: str):
+    """Notifica di default: inoltra i messaggi diagnostici al logger del modulo."""
+    logger.log(_LIVELLI_LOG.get(livello, logging.INFO), messaggio)
+
+
+# ---------------- STRUMENTAZIONE ----------------
+
+def _rss_massimo() -> int:
+    """Picco di memoria residente del processo in byte (None se non disponibile)."""
+    if resource is None:
+        return None
+    picco = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return picco if sys.platform == "darwin" else picco * 1024
+
+
+class Strumentazione:
+    """Misura tempo, righe elaborate e memoria di ogni fase della pipeline.
+
+    Si usa come context manager attorno all'intera elaborazione (può essere
+    riaperto, ad es. prima per la lettura e poi per l'XML); le fasi con lo
+    stesso nome, come i blocchi di un file letto a pezzi, si sommano.
+    Il picco RSS (ru_maxrss) è del processo e non scende mai: il report lo
+    riporta una volta per l'esecuzione e, per ogni fase, di quanto la fase
+    lo ha alzato (zero se è rimasta sotto il picco precedente). Con
+    ``memoria`` si misura anche il picco della fase
+    con tracemalloc: è globale al processo (con più thread include le loro
+    allocazioni), non vede i buffer interni di pyarrow e rallenta
+    l'elaborazione di diverse volte, quindi i tempi vanno presi da una
+    misura senza. Con ``profilo`` l'elaborazione è registrata anche da
+    cProfile (solo il thread chiamante, con un rallentamento analogo).
+    """
+
+    def __init__(self, memoria: bool = False, profilo: bool = False):
+        self.memoria = memoria
+        self.profilo = cProfile.Profile() if profilo else None
+        self.fasi = {}
+        self.secondi = 0.0
+        self._inizio = None
+        self._tracemalloc_avviato = False
+
+    def __enter__(self):
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc_avviato = True
+        if self.profilo is not None:
+            self.profilo.enable()
+        self._inizio = time.perf_counter()
+        return self
+
+    def __exit__(self, *eccezione):
+        self.secondi += time.perf_counter() - self._inizio
+        if self.profilo is not None:
+            self.profilo.disable()
+        if self._tracemalloc_avviato:
+            tracemalloc.stop()
+            self._tracemalloc_avviato = False
+        return False
+
+    @contextmanager
+    def fase(self, nome: str, righe: int = None):
+        """Misura il blocco ``with`` come fase ``nome``.
+
+        Restituisce un dict in cui le ``righe`` possono essere impostate
+        quando sono note solo a fine fase. Le fasi non vanno annidate.
+        """
+        misura = {"righe": righe}
+        memoria = self.memoria and tracemalloc.is_tracing()
+        if memoria:
+            tracemalloc.reset_peak()
+        rss_iniziale = _rss_massimo()
+        inizio = time.perf_counter()
+        try:
+            yield misura
+        finally:
+            secondi = time.perf_counter() - inizio
+            voce = self.fasi.setdefault(nome, {"secondi": 0.0, "righe": None, "chiamate": 0,
+                                               "picco_byte": None, "rss_aumento_byte": None})
+            voce["secondi"] += secondi
+            if rss_iniziale is not None:
+                voce["rss_aumento_byte"] = (voce["rss_aumento_byte"] or 0) + _rss_massimo() - rss_iniziale
+            voce["chiamate"] += 1
+            if misura["righe"] is not None:
+                voce["righe"] = (voce["righe"] or 0) + misura["righe"]
+            if memoria:
+                voce["picco_byte"] = max(voce["picco_byte"] or 0, tracemalloc.get_traced_memory()[1])
+
+    def itera(self, nome: str, iterabile):
+        """Itera ``iterabile`` misurando ogni passo come fase ``nome``
+        (righe = lunghezza di ogni elemento, ad es. un blocco di DataFrame)."""
+        iteratore = iter(iterabile)
+        try:
+            while True:
+                with self.fase(nome) as misura:
+                    try:
+                        elemento = next(iteratore)
+                    except StopIteration:
+                        return
+                    misura["righe"] = len(elemento)
+                yield elemento
+        finally:
+            if hasattr(iteratore, "close"):
+                iteratore.close()
+
+    def testo_profilo(self, righe: int = 30) -> str:
+        """Le ``righe`` funzioni con il tempo cumulativo più alto (vuoto senza profilo)."""
+        if self.profilo is None:
+            return ""
+        buffer = io.StringIO()
+        pstats.Stats(self.profilo, stream=buffer).sort_stats("cumulative").print_stats(righe)
+        return buffer.getvalue()
+
+    def report(self, righe_profilo: int = 30) -> dict:
+        """Report serializzabile in JSON: una voce per fase, nell'ordine di esecuzione."""
+        fasi = []
+        for nome, voce in self.fasi.items():
+            fasi.append({
+                "fase": nome,
+                "secondi": round(voce["secondi"], 4),
+                "righe": voce["righe"],
+                "righe_al_secondo": (round(voce["righe"] / voce["secondi"])
+                                     if voce["righe"] and voce["secondi"] else None),
+                "picco_mb": round(voce["picco_byte"] / 1e6, 2) if voce["picco_byte"] is not None else None,
+                "rss_aumento_mb": (round(voce["rss_aumento_byte"] / 1e6, 1)
+                                   if voce["rss_aumento_byte"] is not None else None),
+                "chiamate": voce["chiamate"],
+            })
+        picchi = [f["picco_mb"] for f in fasi if f["picco_mb"] is not None]
+        rss = _rss_massimo()
+        return {
+            "data": datetime.now().isoformat(timespec="seconds"),
+            "secondi_totali": round(self.secondi or sum(v["secondi"] for v in self.fasi.values()), 4),
+            # Con tracemalloc o cProfile attivi i tempi sono gonfiati
+            "tracemalloc": self.memoria,
+            "cprofile": self.profilo is not None,
+            "picco_mb": max(picchi) if picchi else None,
+            "rss_max_mb": round(rss / 1e6, 1) if rss is not None else None,
+            "ambiente": {
+                "python": platform.python_version(),
+                "pandas": pd.__version__,
+                "piattaforma": platform.platform(),
+                "processori": os.cpu_count(),
+            },
+            "fasi": fasi,
+            "profilo": self.testo_profilo(righe_profilo) if self.profilo is not None else None,
+        }
+
+    def salva_json(self, percorso, righe_profilo: int = 30):
+        with open(percorso, "w", encoding="utf-8") as f:
+            json.dump(self.report(righe_profilo), f, indent=2, ensure_ascii=False)
+
+
+class _SenzaStrumentazione:
+    """Strumentazione che non misura nulla: default delle funzioni della pipeline."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        return False
+
+    def fase(self, nome: str, righe: int = None):
+        return nullcontext({"righe": righe})
+
+    def itera(self, nome: str, iterabile):
+        return iterabile
+
+
+NESSUNA_STRUMENTAZIONE = _SenzaStrumentazione()
+
+
+FORMATI_DATA = [
+    "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y",
+    "%d.%m.%Y", "%Y/%m/%d", "%d/%m/%y",
+    "%d-%m-%y", "%d.%m.%y",
+    # Date e ore di Excel in colonne miste (testo e date)
+    "%Y-%m-%d %H:%M:%S"
+]
+
+
+def pulisci_iban(iban: str) -> str:
+    """Rimuove spazi dall'IBAN e lo normalizza in maiuscolo."""
+    return re.sub(r"\s+", "", str(iban).upper().strip())
+
+
+def normalizza_data(data_str) -> str:
+    """Normalizza una data nel formato YYYY-MM-DD. Se vuota/NaN -> data odierna."""
+    if pd.isna(data_str) or str(data_str).strip() == "":
+        return datetime.now().strftime("%Y-%m-%d")
+
+    data_str = str(data_str).strip()
+
+    for formato in FORMATI_DATA:
+        try:
+            data_obj = datetime.strptime(data_str, formato)
+            return data_obj.strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def normalizza_importo(importo_str) -> str:
+    """Normalizza un importo nel formato xxxx.xx"""
+    if pd.isna(importo_str):
+        return "0.00"
+
+    importo_str = str(importo_str).strip()
+    importo_str = importo_str.replace(" ", "").replace(",", ".")
+
+    try:
+        importo_float = float(importo_str)
+        return f"{importo_float:.2f}"
+    except ValueError:
+        return "0.00"
+
+
+# Importi già nella forma "interi[.decimali]" con al massimo due decimali
+_RE_IMPORTO_SEMPLICE = r"^([0-9]*)(?:\.([0-9]{0,2}))?$"
+
+
+def pulisci_iban_serie(serie: pd.Series) -> pd.Series:
+    """Versione vettoriale di pulisci_iban su un'intera colonna."""
+    return serie.astype(str).str.upper().str.replace(r"\s+", "", regex=True)
+
+
+def rileva_formati_data(serie: pd.Series, campione: int = 1000) -> list:
+    """Ordina FORMATI_DATA per frequenza su un campione della colonna.
+
+    I formati mai riconosciuti nel campione vengono messi in coda, così le
+    righe rare con un formato diverso vengono comunque convertite.
+    """
+    estratto = serie.head(campione)
+    conteggi = {
+        formato: int(pd.to_datetime(estratto, format=formato, errors="coerce").notna().sum())
+        for formato in FORMATI_DATA
+    }
+    return sorted(FORMATI_DATA, key=lambda formato: -conteggi[formato])
+
+
+def normalizza_date_serie(serie: pd.Series) -> pd.Series:
+    """Versione vettoriale di normalizza_data: una to_datetime per formato.
+
+    Le colonne già di tipo data (Excel, Parquet) sono solo formattate.
+    """
+    oggi = datetime.now().strftime("%Y-%m-%d")
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        return serie.dt.strftime("%Y-%m-%d").astype(object).where(serie.notna(), oggi)
+    testo = serie.astype(str).str.strip()
+    da_convertire = serie.notna() & (testo != "")
+    risultato = pd.Series(oggi, index=serie.index, dtype=object)
+
+    valori = testo[da_convertire]
+    for formato in rileva_formati_data(valori):
+        if valori.empty:
+            break
+        date = pd.to_datetime(valori, format=formato, errors="coerce")
+        riconosciute = date.notna()
+        if riconosciute.any():
+            risultato.loc[date.index[riconosciute]] = date[riconosciute].dt.strftime("%Y-%m-%d")
+            valori = valori[~riconosciute]
+
+    return risultato
+
+
+def normalizza_importi_serie(serie: pd.Series) -> pd.Series:
+    """Versione vettoriale di normalizza_importo.
+
+    Gli importi semplici (al massimo due decimali, senza segno) vengono
+    convertiti in centesimi interi e riformattati senza passare dai float;
+    gli altri casi (segno, esponenti, più decimali) ricadono sulla funzione
+    scalare per mantenere lo stesso arrotondamento. I valori numerici
+    (colonne numeriche o celle numeriche di colonne miste di Excel e
+    Parquet) seguono l'arrotondamento di importo_in_centesimi, qualunque sia
+    il tipo della colonna (vedi centesimi_da_numeri).
+    """
+    if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+        valori = serie.astype("float64").to_numpy(na_value=np.nan)
+        mancanti = ~np.isfinite(valori)
+        centesimi = pd.Series(centesimi_da_numeri(np.where(mancanti, 0, valori)), index=serie.index)
+        return formatta_centesimi_serie(centesimi).astype(object).mask(mancanti, "0.00")
+
+    mancanti = serie.isna()
+    testo = serie.astype(str).str.strip().str.replace(" ", "", regex=False).str.replace(",", ".", regex=False)
+    semplici = (
+        testo.str.fullmatch(_RE_IMPORTO_SEMPLICE).fillna(False).astype(bool)
+        & ~testo.isin(["", "."])
+        & (testo.str.len() <= 15)
+        & ~mancanti
+    )
+
+    risultato = pd.Series("0.00", index=serie.index, dtype=object)
+    if semplici.any():
+        valori = testo[semplici]
+        punto = valori.str.find(".")
+        decimali = (valori.str.len() - punto - 1).where(punto >= 0, 0).astype("int64")
+        cifre = pd.to_numeric(valori.str.replace(".", "", regex=False)).astype("int64")
+        risultato.loc[semplici] = formatta_centesimi_serie(cifre * 10 ** (2 - decimali))
+
+    altri = ~semplici & ~mancanti
+    if altri.any():
+        numeri = altri & serie.map(_numero_non_booleano).astype(bool)
+        if numeri.any():
+            valori = serie[numeri].astype("float64").to_numpy()
+            finiti = np.isfinite(valori)
+            centesimi = pd.Series(centesimi_da_numeri(np.where(finiti, valori, 0)), index=serie.index[numeri])
+            risultato.loc[numeri] = formatta_centesimi_serie(centesimi).where(finiti, "0.00")
+        altri &= ~numeri
+        risultato.loc[altri] = serie[altri].map(normalizza_importo)
+    return risultato
+
+
+def _numero_non_booleano(valore) -> bool:
+    return isinstance(valore, (int, float, np.number)) and not isinstance(valore, (bool, np.bool_))
+
+
+def centesimi_da_numeri(valori: np.ndarray) -> np.ndarray:
+    """Centesimi interi di importi numerici, arrotondati come importo_in_centesimi.
+
+    Ogni float vale il decimale più corto che lo rappresenta (come in repr),
+    arrotondato al centesimo half-even: 2.675 diventa 268 centesimi anche se
+    il float 2.675 * 100 vale 267.4999... I valori già al centesimo sono
+    convertiti in blocco; solo gli altri passano da Decimal.
+    """
+    per_cento = np.asarray(valori, dtype="float64") * 100
+    interi = np.round(per_cento)
+    centesimi = interi.astype("int64")
+    for i in np.flatnonzero(np.abs(per_cento - interi) > 1e-6).tolist():
+        centesimi[i] = importo_in_centesimi(float(valori[i]))
+    return centesimi
+
+
+def maschera_campi_vuoti(df: pd.DataFrame, campi: list) -> pd.DataFrame:
+    """Restituisce una maschera booleana (righe x campi) dei valori vuoti o 'nan'."""
+    maschera = {}
+    for campo in campi:
+        colonna = df[campo]
+        testo = colonna.astype(str).str.strip().str.lower()
+        maschera[campo] = colonna.isna() | testo.isin(["", "nan"])
+    return pd.DataFrame(maschera, index=df.index)
+
+
+def importo_in_centesimi(importo) -> int:
+    """Converte un importo (stringa o numero) in centesimi interi, senza passare dai float."""
+    try:
+        valore = Decimal(str(importo).strip().replace(" ", "").replace(",", "."))
+    except InvalidOperation:
+        return 0
+    if not valore.is_finite():
+        return 0
+    return int((valore * 100).to_integral_value(rounding=ROUND_HALF_EVEN))
+
+
+def formatta_centesimi(centesimi: int) -> str:
+    """Formatta un importo in centesimi nel formato xxxx.xx"""
+    segno = "-" if centesimi < 0 else ""
+    intero, decimali = divmod(abs(int(centesimi)), 100)
+    return f"{segno}{intero}.{decimali:02d}"
+
+
+def importi_in_centesimi_serie(serie: pd.Series) -> pd.Series:
+    """Converte una colonna di importi già normalizzati (xxxx.xx) in centesimi interi."""
+    centesimi = pd.to_numeric(serie.astype(str).str.replace(".", "", regex=False), errors="coerce")
+    return centesimi.fillna(0).astype("int64")
+
+
+def formatta_centesimi_serie(serie: pd.Series) -> pd.Series:
+    """Versione vettoriale di formatta_centesimi."""
+    assoluti = serie.abs()
+    testo = (assoluti // 100).astype(str) + "." + (assoluti % 100).astype(str).str.zfill(2)
+    negativi = serie < 0
+    if negativi.any():
+        testo = testo.mask(negativi, "-" + testo)
+    return testo
+
+
+def aggrega_incassi(df: pd.DataFrame) -> pd.DataFrame:
+    """Aggrega le righe per lo stesso debitore (stesso IBAN).
+
+    Gli importi vengono sommati in centesimi interi (colonna ``importo_centesimi``)
+    e i totali del flusso sono salvati in ``attrs["nb_of_txs"]`` e
+    ``attrs["ctrl_sum_centesimi"]``, così non vanno ricalcolati a valle.
+    """
+    df = df.assign(
+        importo_centesimi=importi_in_centesimi_serie(df["importo"]),
+        causale=df["causale"].astype(str),
+    )
+
+    df_aggregato = df.groupby("iban").agg(
+        nome_debitore=("nome_debitore", "first"),
+        codice_fiscale=("codice_fiscale", "first"),
+        importo_centesimi=("importo_centesimi", "sum"),
+        data_firma_mandato=("data_firma_mandato", "first"),
+    )
+
+    # Causali distinte nell'ordine di prima apparizione, concatenate con la somma
+    # di gruppo sulle stringhe (nessuna funzione Python per gruppo)
+    causali = df[["iban", "causale"]].drop_duplicates()
+    causali = (", " + causali["causale"]).groupby(causali["iban"]).sum()
+    df_aggregato["causale"] = "Ft. " + causali.str[2:]
+    df_aggregato["importo"] = formatta_centesimi_serie(df_aggregato["importo_centesimi"])
+
+    df_aggregato = df_aggregato.reset_index()[[
+        "iban", "nome_debitore", "codice_fiscale", "importo", "causale",
+        "data_firma_mandato", "importo_centesimi"
+    ]]
+    df_aggregato.attrs["nb_of_txs"] = len(df_aggregato)
+    df_aggregato.attrs["ctrl_sum_centesimi"] = int(df_aggregato["importo_centesimi"].sum())
+
+    return df_aggregato
+
+
+def totali_incassi(incassi) -> tuple:
+    """Restituisce (NbOfTxs, CtrlSum in centesimi) per una lista di incassi aggregati."""
+    if isinstance(incassi, LottoIncassi):
+        return incassi.totali()
+    if isinstance(incassi, pd.DataFrame) and "nb_of_txs" in incassi.attrs:
+        return incassi.attrs["nb_of_txs"], incassi.attrs["ctrl_sum_centesimi"]
+    return len(incassi), sum(centesimi_incasso(inc) for inc in incassi)
+
+
+def centesimi_incasso(incasso) -> int:
+    """Importo di un incasso aggregato in centesimi."""
+    centesimi = incasso.get("importo_centesimi")
+    if centesimi is None:
+        return importo_in_centesimi(incasso["importo"])
+    return int(centesimi)
+
+
+class ColonnaTesto:
+    """Colonna di stringhe compattata in un unico buffer UTF-8 con offset.
+
+    Occupa poco più dei byte del testo, contro le decine di byte di overhead
+    di ogni oggetto ``str`` Python.
+    """
+
+    __slots__ = ("_dati", "_offset")
+
+    def __init__(self, valori):
+        codificati = [str(valore).encode("utf-8") for valore in valori]
+        self._dati = b"".join(codificati)
+        self._offset = array("q", accumulate((len(c) for c in codificati), initial=0))
+
+    def __len__(self):
+        return len(self._offset) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        return self._dati[self._offset[i]:self._offset[i + 1]].decode("utf-8")
+
+    def __iter__(self):
+        dati = self._dati
+        offset = self._offset
+        for inizio, fine in zip(offset, islice(offset, 1, None)):
+            yield dati[inizio:fine].decode("utf-8")
+
+    def nbytes(self) -> int:
+        """Memoria occupata dai buffer della colonna."""
+        return len(self._dati) + self._offset.itemsize * len(self._offset)
+
+    def lunghezze(self) -> np.ndarray:
+        """Lunghezza in byte UTF-8 di ogni valore."""
+        return np.diff(np.frombuffer(self._offset, dtype=np.int64))
+
+    def valore_byte(self, i: int) -> bytes:
+        """Valore in posizione ``i`` in UTF-8, senza decodificarlo."""
+        return self._dati[self._offset[i]:self._offset[i + 1]]
+
+    def valori_byte(self):
+        """Itera i valori in UTF-8, senza decodificarli."""
+        offset = self._offset
+        return map(self._dati.__getitem__, map(slice, offset, islice(offset, 1, None)))
+
+    def seleziona(self, posizioni) -> "ColonnaTesto":
+        """Nuova colonna con i valori alle ``posizioni`` indicate, senza decodificarli."""
+        dati, offset = self._dati, self._offset
+        return ColonnaTesto.da_byte([dati[offset[i]:offset[i + 1]] for i in posizioni])
+
+    @classmethod
+    def da_byte(cls, pezzi: list) -> "ColonnaTesto":
+        """Colonna dai valori già codificati in UTF-8."""
+        colonna = cls.__new__(cls)
+        colonna._dati = b"".join(pezzi)
+        colonna._offset = array("q", accumulate(map(len, pezzi), initial=0))
+        return colonna
+
+    def buffer(self) -> tuple:
+        """(dati, offset) della colonna in byte, per salvarla (vedi da_buffer)."""
+        return self._dati, self._offset.tobytes()
+
+    @classmethod
+    def da_buffer(cls, dati: bytes, offset: bytes) -> "ColonnaTesto":
+        colonna = cls.__new__(cls)
+        colonna._dati = bytes(dati)
+        colonna._offset = array("q")
+        colonna._offset.frombytes(offset)
+        return colonna
+
+
+class Incasso:
+    """Singolo incasso aggregato (vista su una riga di LottoIncassi).
+
+    Supporta anche l'accesso per chiave (``incasso["iban"]``) come i dict
+    prodotti da ``to_dict("records")``.
+    """
+
+    __slots__ = ("iban", "nome_debitore", "codice_fiscale", "causale", "data_firma_mandato", "importo_centesimi")
+
+    def __init__(self, iban, nome_debitore, codice_fiscale, causale, data_firma_mandato, importo_centesimi):
+        self.iban = iban
+        self.nome_debitore = nome_debitore
+        self.codice_fiscale = codice_fiscale
+        self.causale = causale
+        self.data_firma_mandato = data_firma_mandato
+        self.importo_centesimi = importo_centesimi
+
+    @property
+    def importo(self) -> str:
+        return formatta_centesimi(self.importo_centesimi)
+
+    def __getitem__(self, campo: str):
+        return getattr(self, campo)
+
+    def get(self, campo: str, default=None):
+        return getattr(self, campo, default)
+
+
+class LottoIncassi:
+    """Incassi aggregati in forma colonnare compatta.
+
+    I campi di testo sono ColonnaTesto, gli importi un ``array`` di centesimi
+    interi; NbOfTxs e CtrlSum sono calcolati una sola volta alla creazione.
+    """
+
+    CAMPI_TESTO = ("iban", "nome_debitore", "codice_fiscale", "causale", "data_firma_mandato")
+    __slots__ = CAMPI_TESTO + ("importo_centesimi", "ctrl_sum_centesimi")
+
+    def __init__(self, iban, nome_debitore, codice_fiscale, causale, data_firma_mandato, importo_centesimi):
+        self.iban = ColonnaTesto(iban)
+        self.nome_debitore = ColonnaTesto(nome_debitore)
+        self.codice_fiscale = ColonnaTesto(codice_fiscale)
+        self.causale = ColonnaTesto(causale)
+        self.data_firma_mandato = ColonnaTesto(data_firma_mandato)
+        self.importo_centesimi = array("q", importo_centesimi)
+        self.ctrl_sum_centesimi = sum(self.importo_centesimi)
+
+    @classmethod
+    def da_dataframe(cls, df: pd.DataFrame) -> "LottoIncassi":
+        """Crea il lotto dal DataFrame prodotto da aggrega_incassi."""
+        if "importo_centesimi" in df.columns:
+            centesimi = df["importo_centesimi"].tolist()
+        else:
+            centesimi = [importo_in_centesimi(i) for i in df["importo"].tolist()]
+        return cls(*(df[campo].tolist() for campo in cls.CAMPI_TESTO), centesimi)
+
+    @classmethod
+    def da_record(cls, incassi) -> "LottoIncassi":
+        """Crea il lotto da una sequenza di dict (o Incasso) con i campi degli incassi."""
+        incassi = list(incassi)
+        return cls(
+            *([inc[campo] for inc in incassi] for campo in cls.CAMPI_TESTO),
+            [centesimi_incasso(inc) for inc in incassi],
+        )
+
+    @property
+    def nb_of_txs(self) -> int:
+        return len(self.importo_centesimi)
+
+    def totali(self) -> tuple:
+        """(NbOfTxs, CtrlSum in centesimi)."""
+        return self.nb_of_txs, self.ctrl_sum_centesimi
+
+    def colonne(self):
+        """Iteratore sulle righe come tuple (iban, nome, cf, causale, data, centesimi)."""
+        return zip(self.iban, self.nome_debitore, self.codice_fiscale, self.causale,
+                   self.data_firma_mandato, self.importo_centesimi)
+
+    def seleziona(self, posizioni) -> "LottoIncassi":
+        """Nuovo lotto con le sole transazioni alle ``posizioni`` indicate."""
+        lotto = LottoIncassi.__new__(LottoIncassi)
+        for campo in self.CAMPI_TESTO:
+            setattr(lotto, campo, getattr(self, campo).seleziona(posizioni))
+        centesimi = self.importo_centesimi
+        lotto.importo_centesimi = array("q", (centesimi[i] for i in posizioni))
+        lotto.ctrl_sum_centesimi = sum(lotto.importo_centesimi)
+        return lotto
+
+    def sostituisci(self, **colonne) -> "LottoIncassi":
+        """Nuovo lotto con le colonne di testo indicate sostituite; le altre sono condivise."""
+        lotto = LottoIncassi.__new__(LottoIncassi)
+        for campo in self.__slots__:
+            valore = colonne.pop(campo) if campo in colonne else getattr(self, campo)
+            if campo in self.CAMPI_TESTO and not isinstance(valore, ColonnaTesto):
+                valore = ColonnaTesto(valore)
+            setattr(lotto, campo, valore)
+        if colonne:
+            raise ValueError(f"Colonne non sostituibili: {', '.join(colonne)}")
+        return lotto
+
+    def pagina(self, inizio: int, quanti: int) -> pd.DataFrame:
+        """DataFrame delle sole righe ``inizio .. inizio + quanti - 1`` (numerate da 1)."""
+        fine = min(max(inizio, 0) + quanti, self.nb_of_txs)
+        posizioni = range(max(inizio, 0), fine)
+        df = self.seleziona(posizioni).to_dataframe()
+        df.index = pd.RangeIndex(posizioni.start + 1, posizioni.stop + 1)
+        return df
+
+    def __len__(self):
+        return self.nb_of_txs
+
+    def __getitem__(self, i: int) -> Incasso:
+        return Incasso(*(getattr(self, campo)[i] for campo in self.CAMPI_TESTO), self.importo_centesimi[i])
+
+    def __iter__(self):
+        for riga in self.colonne():
+            yield Incasso(*riga)
+
+    def to_dataframe(self) -> pd.DataFrame:
+        """DataFrame per la visualizzazione (stesse colonne di aggrega_incassi)."""
+        df = pd.DataFrame({campo: list(getattr(self, campo)) for campo in self.CAMPI_TESTO})
+        df["importo_centesimi"] = pd.Series(self.importo_centesimi, dtype="int64")
+        df.insert(3, "importo", formatta_centesimi_serie(df["importo_centesimi"]))
+        return df
+
+    def nbytes(self) -> int:
+        """Memoria occupata dai buffer del lotto."""
+        return (sum(getattr(self, campo).nbytes() for campo in self.CAMPI_TESTO)
+                + self.importo_centesimi.itemsize * len(self.importo_centesimi))
+
+
+FORMATO_TIMESTAMP_MSG_ID = "%Y%m%d%H%M%S"
+
+
+# Ultimo timestamp assegnato da genera_message_id per ogni prefisso, nel processo
+_ULTIMI_MESSAGE_ID = {}
+_LOCK_MESSAGE_ID = threading.Lock()
+
+
+def genera_message_id(prefix: str) -> str:
+    """Genera un Message ID ``{prefix}{timestamp}`` unico nel processo.
+
+    Il timestamp è l'ora corrente o, se per ``prefix`` è già stato
+    assegnato, il secondo successivo all'ultimo: due flussi generati nello
+    stesso secondo (anche da thread diversi) hanno MsgId diversi. Tra
+    processi diversi l'unicità va garantita assegnando i MsgId nel processo
+    padre o con AllocatoreIdentificativi.
+    """
+    adesso = datetime.now().replace(microsecond=0)
+    with _LOCK_MESSAGE_ID:
+        ultimo = _ULTIMI_MESSAGE_ID.get(prefix)
+        if ultimo is not None:
+            adesso = max(adesso, ultimo + timedelta(seconds=1))
+        _ULTIMI_MESSAGE_ID[prefix] = adesso
+    return f"{prefix}{adesso.strftime(FORMATO_TIMESTAMP_MSG_ID)}"
+
+
+def genera_end_to_end_id(msg_id: str, idx: int) -> str:
+    """Genera un End-to-End ID."""
+    return f"{msg_id}-{idx:07d}"
+
+
+def genera_mandate_id(prefix: str, codice_fiscale: str) -> str:
+    """Genera un Mandate ID basato sul CF."""
+    cf = str(codice_fiscale).strip().upper()
+    return f"{prefix}{cf}"
+
+
+def crea_template_aziendale() -> str:
+    """Crea il template CSV per i dati aziendali."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["nome_azienda", "indirizzo_azienda", "iban", "abi", "creditor_id", "prefisso_mandato"])
+    writer.writerow(["ESEMPIO SRL", "Via Esempio 1", "IT87X0123411101000000123456", "01234",
+                     "IT00ZZZ0000000000000000", "EXM001"])
+    return output.getvalue()
+
+
+def crea_template_incassi() -> str:
+    """Crea il template CSV per gli incassi."""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(["nome_debitore", "codice_fiscale", "iban", "importo", "causale", "data_firma_mandato"])
+    writer.writerow(["Mario Rossi", "RSSMRA80A01H501U", "IT07X0542811101000000654321", "100.00",
+                     "Fattura 001/2025 del 15/01/2025", "15/01/2024"])
+    writer.writerow(["Mario Rossi", "RSSMRA80A01H501U", "IT07X0542811101000000654321", "50.00",
+                     "Fattura 002/2025 del 20/01/2025", "15/01/2024"])
+    writer.writerow(["Laura Bianchi", "BNCLRA85M45F205P", "IT61X0306909606100000012345", "150.50",
+                     "Abbonamento annuale 2025", "10/02/2024"])
+    return output.getvalue()
+
+
+def valida_dati_aziendali(df: pd.DataFrame):
+    """Valida i dati aziendali."""
+    required_fields = ["nome_azienda", "indirizzo_azienda", "iban", "abi", "creditor_id", "prefisso_mandato"]
+    for field in required_fields:
+        if field not in df.columns:
+            return False, f"Campo mancante: {field}"
+        if df[field].iloc[0] == "" or pd.isna(df[field].iloc[0]):
+            return False, f"Campo vuoto: {field}"
+
+    df["abi"] = df["abi"].astype(str).str.zfill(5)
+    return True, "OK"
+
+
+ID_FLUSSO_MAX = 12
+
+
+def valida_id_flusso(id_flusso: str):
+    """Valida l'ID flusso già normalizzato in maiuscolo.
+
+    Restituisce (valido, messaggio): con ``valido`` True il messaggio è "OK"
+    oppure un avviso non bloccante.
+    """
+    if not id_flusso:
+        return False, "L'ID Flusso non può essere vuoto"
+    if len(id_flusso) > ID_FLUSSO_MAX:
+        return False, f"L'ID Flusso deve essere massimo {ID_FLUSSO_MAX} caratteri"
+    if not re.match(r"^[A-Z0-9]+$", id_flusso):
+        return True, "L'ID Flusso dovrebbe contenere solo lettere maiuscole e numeri"
+    return True, "OK"
+
+
+def valida_data_addebito(data_addebito: str):
+    """Valida la data di addebito YYYY-MM-DD: non può essere nel passato.
+
+    Restituisce (valido, messaggio) come valida_id_flusso.
+    """
+    try:
+        data = datetime.strptime(data_addebito, "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return False, f"data non valida '{data_addebito}' (formato atteso YYYY-MM-DD)"
+    if data < datetime.now().date():
+        return False, f"la data di addebito {data_addebito} è nel passato"
+    return True, "OK"
+
+
+COLONNE_INCASSI = ["nome_debitore", "codice_fiscale", "iban", "importo", "causale", "data_firma_mandato"]
+CAMPI_OBBLIGATORI_INCASSI = ["nome_debitore", "codice_fiscale", "iban", "importo", "causale"]
+
+
+def mappa_colonne_incassi(df: pd.DataFrame, notifica=None):
+    """Assegna o mappa le intestazioni standard: restituisce (df, errore)."""
+    notifica = notifica or notifica_log
+    required_fields = COLONNE_INCASSI
+
+    notifica("write", f"🔍 Prime colonne rilevate: {list(df.columns[:3])}")
+
+    # Se il dataframe non ha i nomi delle colonne corretti, assegnali/mappali
+    if len(df.columns) == len(required_fields):
+        # colonne numeriche => CSV senza header
+        if isinstance(df.columns[0], int):
+            df.columns = required_fields
+            notifica("success", "✅ Intestazioni colonne aggiunte automaticamente (CSV senza intestazioni)")
+        else:
+            prima_colonna = str(df.columns[0]).lower().strip()
+            notifica("write", f"🔍 Prima riga dati: {df.iloc[0].to_dict()}")
+
+            if prima_colonna not in ["nome_debitore", "nome", "debitore"]:
+                colonne_valide = any(
+                    str(col).lower().strip() in [
+                        "nome_debitore", "nome", "debitore", "codice_fiscale", "cf",
+                        "iban", "importo", "causale", "data", "data_firma_mandato"
+                    ] for col in df.columns
+                )
+
+                if not colonne_valide:
+                    df.columns = required_fields
+                    notifica("success", "✅ Intestazioni colonne aggiunte automaticamente")
+                else:
+                    mapping = {}
+                    for col in df.columns:
+                        col_lower = str(col).lower().strip()
+                        if "nome" in col_lower or "debitore" in col_lower:
+                            mapping[col] = "nome_debitore"
+                        elif "codice" in col_lower or "fiscale" in col_lower or "cf" in col_lower or "piva" in col_lower or "partita" in col_lower:
+                            mapping[col] = "codice_fiscale"
+                        elif "iban" in col_lower:
+                            mapping[col] = "iban"
+                        elif "importo" in col_lower or "ammontare" in col_lower or "totale" in col_lower:
+                            mapping[col] = "importo"
+                        elif "causale" in col_lower or "descrizione" in col_lower or "motivo" in col_lower:
+                            mapping[col] = "causale"
+                        elif "data" in col_lower or "firma" in col_lower or "mandato" in col_lower:
+                            mapping[col] = "data_firma_mandato"
+
+                    if len(set(mapping.values())) == len(required_fields):
+                        df = df.rename(columns=mapping)
+                        notifica("success", "✅ Intestazioni colonne mappate automaticamente")
+                    else:
+                        df.columns = required_fields
+                        notifica("warning", "⚠️ Alcune intestazioni non riconosciute, applicate intestazioni standard")
+    else:
+        return None, f"Il CSV deve avere {len(required_fields)} colonne, ne ha {len(df.columns)}"
+
+    return df, None
+
+
+
+def normalizza_incassi(df: pd.DataFrame) -> pd.DataFrame:
+    """Normalizza CF, IBAN, date e importi una colonna alla volta."""
+    df["codice_fiscale"] = df["codice_fiscale"].astype(str).str.strip()
+    df["iban"] = pulisci_iban_serie(df["iban"])
+    df["data_firma_mandato"] = normalizza_date_serie(df["data_firma_mandato"])
+    df["importo"] = normalizza_importi_serie(df["importo"])
+    return df
+
+
+# ---------------- VALIDAZIONE ----------------
+
+# Lunghezza dell'IBAN nei paesi dell'area SEPA
+LUNGHEZZE_IBAN = {
+    "AD": 24, "AL": 28, "AT": 20, "BE": 16, "BG": 22, "CH": 21, "CY": 28, "CZ": 24, "DE": 22,
+    "DK": 18, "EE": 20, "ES": 24, "FI": 18, "FR": 27, "GB": 22, "GI": 23, "GR": 27, "HR": 21,
+    "HU": 28, "IE": 22, "IS": 26, "IT": 27, "LI": 21, "LT": 20, "LU": 20, "LV": 21, "MC": 27,
+    "MD": 24, "ME": 22, "MK": 19, "MT": 31, "NL": 18, "NO": 15, "PL": 28, "PT": 25, "RO": 24,
+    "SE": 24, "SI": 19, "SK": 24, "SM": 27, "VA": 22,
+}
+NM_MAX = 70
+USTRD_MAX = 140
+# Prefisso "{idx:019d} - " aggiunto alla causale nell'Ustrd
+USTRD_PREFISSO = 22
+
+_RE_IBAN = r"[A-Z]{2}[0-9]{2}[A-Z0-9]{11,30}"
+_RE_CODICE_FISCALE = r"[A-Z]{6}[0-9LMNPQRSTUV]{2}[ABCDEHLMPRST][0-9LMNPQRSTUV]{2}[A-Z][0-9LMNPQRSTUV]{3}[A-Z]"
+_RE_PARTITA_IVA = r"[0-9]{11}"
+# Set di caratteri latino di base ammesso dallo schema SEPA
+_RE_CARATTERI_SEPA = r"[A-Za-z0-9/\-?:().,'+ ]*"
+
+# Valori dei caratteri in posizione dispari per il carattere di controllo del codice fiscale
+_CF_DISPARI = dict(zip("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+                       [1, 0, 5, 7, 9, 13, 15, 17, 19, 21, 1, 0, 5, 7, 9, 13, 15, 17, 19, 21,
+                        2, 4, 18, 20, 11, 3, 6, 8, 12, 14, 16, 10, 22, 25, 24, 23]))
+_CF_PARI = {c: int(c, 36) % 10 if c.isdigit() else ord(c) - 65 for c in "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+
+COLONNE_REPORT_VALIDAZIONE = ["riga", "campo", "valore", "errore", "gravita"]
+
+
+def _matrice_ascii(serie: pd.Series, larghezza: int, riempimento: str = "0") -> np.ndarray:
+    """Matrice (righe x larghezza) dei codici ASCII di stringhe già validate nel formato."""
+    testo = "".join(serie.str.rjust(larghezza, riempimento).tolist())
+    return np.frombuffer(testo.encode("ascii"), dtype=np.uint8).reshape(len(serie), larghezza)
+
+
+def _tabella(valori: dict) -> np.ndarray:
+    tabella = np.zeros(128, dtype=np.int64)
+    for carattere, valore in valori.items():
+        tabella[ord(carattere)] = valore
+    return tabella
+
+
+_TABELLA_CF_DISPARI = _tabella(_CF_DISPARI)
+_TABELLA_CF_PARI = _tabella(_CF_PARI)
+# Nel calcolo mod-97 le cifre valgono sé stesse, le lettere 10..35 (due cifre)
+_IBAN_VALORI = _tabella({c: int(c, 36) for c in "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"})
+_IBAN_MOLTIPLICATORI = _tabella({c: 10 if c.isdigit() else 100 for c in "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"})
+
+
+def iban_check_validi(iban: pd.Series) -> pd.Series:
+    """Verifica mod-97 (ISO 13616) di IBAN già nel formato corretto, su tutta la colonna.
+
+    Le cifre zero aggiunte a sinistra per ottenere una larghezza fissa non
+    cambiano il resto, quindi il calcolo procede una colonna di caratteri alla volta.
+    """
+    if iban.empty:
+        return pd.Series(True, index=iban.index)
+    matrice = np.ascontiguousarray(_matrice_ascii(iban.str[4:] + iban.str[:4], 34).T)
+    resto = np.zeros(len(iban), dtype=np.int64)
+    for posizione, codici in enumerate(matrice, 1):
+        resto = resto * _IBAN_MOLTIPLICATORI[codici] + _IBAN_VALORI[codici]
+        # Sei passi (al più 100**6 volte il resto) stanno comodamente in int64
+        if posizione % 6 == 0:
+            resto %= 97
+    return pd.Series(resto % 97 == 1, index=iban.index)
+
+
+def codici_fiscali_validi(cf: pd.Series) -> pd.Series:
+    """Carattere di controllo di codici fiscali di 16 caratteri già nel formato corretto."""
+    if cf.empty:
+        return pd.Series(True, index=cf.index)
+    matrice = _matrice_ascii(cf, 16)
+    somma = _TABELLA_CF_DISPARI[matrice[:, 0:15:2]].sum(axis=1) + _TABELLA_CF_PARI[matrice[:, 1:15:2]].sum(axis=1)
+    return pd.Series(matrice[:, 15] == 65 + somma % 26, index=cf.index)
+
+
+def partite_iva_valide(piva: pd.Series) -> pd.Series:
+    """Cifra di controllo di partite IVA di 11 cifre già nel formato corretto."""
+    if piva.empty:
+        return pd.Series(True, index=piva.index)
+    cifre = _matrice_ascii(piva, 11).astype(np.int64) - 48
+    doppi = cifre[:, 1:10:2] * 2
+    somma = cifre[:, 0:10:2].sum(axis=1) + (doppi - 9 * (doppi > 9)).sum(axis=1)
+    return pd.Series((10 - somma % 10) % 10 == cifre[:, 10], index=piva.index)
+
+
+def _righe_report(df: pd.DataFrame, maschera: pd.Series, campo: str, errore, gravita: str = "errore"):
+    """Righe del report per i valori di ``campo`` selezionati da ``maschera``."""
+    selezionati = df.loc[maschera, campo]
+    return pd.DataFrame({
+        "riga": selezionati.index + 2,
+        "campo": campo,
+        "valore": selezionati.astype(str).to_numpy(),
+        "errore": errore if isinstance(errore, str) else errore[maschera].to_numpy(),
+        "gravita": gravita,
+    })
+
+
+def valida_incassi(df: pd.DataFrame) -> pd.DataFrame:
+    """Valida in blocco le righe normalizzate e restituisce il report degli errori.
+
+    Controlla campi obbligatori, IBAN (formato, paese SEPA, lunghezza,
+    mod-97), codice fiscale o partita IVA (carattere di controllo), importo
+    positivo, lunghezza del nome e set di caratteri SEPA. Ogni controllo è
+    vettoriale sulla colonna. Le righe del report hanno ``gravita`` "errore"
+    (bloccante) o "avviso"; ``riga`` è numerata come nel file con intestazioni.
+    """
+    parti = []
+    vuoti = maschera_campi_vuoti(df, CAMPI_OBBLIGATORI_INCASSI)
+    for campo in CAMPI_OBBLIGATORI_INCASSI:
+        if vuoti[campo].any():
+            parti.append(_righe_report(df, vuoti[campo], campo, "campo obbligatorio vuoto"))
+
+    iban = df["iban"].astype(str)
+    formato = iban.str.fullmatch(_RE_IBAN).fillna(False).astype(bool)
+    paese = iban.str[:2]
+    lunghezza_attesa = paese.map(LUNGHEZZE_IBAN)
+    da_controllare = ~vuoti["iban"]
+    fuori_sepa = da_controllare & formato & lunghezza_attesa.isna()
+    lunghezza_errata = da_controllare & formato & lunghezza_attesa.notna() & (iban.str.len() != lunghezza_attesa)
+    parti.append(_righe_report(df, da_controllare & ~formato, "iban", "formato IBAN non valido"))
+    parti.append(_righe_report(df, fuori_sepa, "iban", "paese IBAN " + paese + " fuori dall'area SEPA"))
+    parti.append(_righe_report(df, lunghezza_errata, "iban", "lunghezza IBAN errata per " + paese + " (attesa "
+                               + lunghezza_attesa.fillna(0).astype(int).astype(str) + ")"))
+    ben_formati = da_controllare & formato & ~fuori_sepa & ~lunghezza_errata
+    check = pd.Series(True, index=df.index)
+    check[ben_formati] = iban_check_validi(iban[ben_formati])
+    parti.append(_righe_report(df, ~check, "iban", "cifre di controllo IBAN errate"))
+
+    cf = df["codice_fiscale"].astype(str).str.upper()
+    da_controllare = ~vuoti["codice_fiscale"]
+    persona = cf.str.fullmatch(_RE_CODICE_FISCALE).fillna(False).astype(bool) & da_controllare
+    azienda = cf.str.fullmatch(_RE_PARTITA_IVA).fillna(False).astype(bool) & da_controllare
+    controllo = pd.Series(True, index=df.index)
+    controllo[persona] = codici_fiscali_validi(cf[persona])
+    controllo[azienda] = partite_iva_valide(cf[azienda])
+    parti.append(_righe_report(df, da_controllare & ~persona & ~azienda, "codice_fiscale",
+                               "formato non valido (attesi codice fiscale di 16 caratteri o partita IVA)"))
+    parti.append(_righe_report(df, ~controllo, "codice_fiscale", "carattere di controllo errato"))
+
+    # Gli importi normalizzati sono "interi.decimali"; quelli illeggibili diventano "0.00"
+    importi = df["importo"].astype(str)
+    non_positivi = (importi == "0.00") | importi.str.startswith("-")
+    parti.append(_righe_report(df, ~vuoti["importo"] & non_positivi, "importo",
+                               "importo nullo, negativo o non leggibile"))
+
+    nome = df["nome_debitore"].astype(str).str.strip()
+    parti.append(_righe_report(df, nome.str.len() > NM_MAX, "nome_debitore", f"nome oltre {NM_MAX} caratteri"))
+    for campo in ("nome_debitore", "causale"):
+        testo = df[campo].astype(str)
+        fuori_set = ~vuoti[campo] & ~testo.str.fullmatch(_RE_CARATTERI_SEPA).fillna(False).astype(bool)
+        parti.append(_righe_report(df, fuori_set, campo, "caratteri fuori dal set SEPA (accenti, simboli)", "avviso"))
+
+    return _unisci_report(parti)
+
+
+def valida_causali_aggregate(iban: pd.Series, causale: pd.Series) -> pd.DataFrame:
+    """Avvisi per le causali aggregate troncate nell'Ustrd (vedi causale_ustrd)."""
+    lunghezze = causale.astype(str).str.len() + USTRD_PREFISSO
+    troppo_lunghe = lunghezze > USTRD_MAX
+    report = pd.DataFrame({
+        "riga": pd.NA,
+        "campo": "causale",
+        "valore": iban[troppo_lunghe].astype(str).to_numpy(),
+        "errore": ("Ustrd di " + lunghezze[troppo_lunghe].astype(str)
+                   + f" caratteri oltre il limite di {USTRD_MAX}: causali aggregate troncate").to_numpy(),
+        "gravita": "avviso",
+    })
+    return _unisci_report([report])
+
+
+def _unisci_report(parti: list) -> pd.DataFrame:
+    parti = [parte for parte in parti if len(parte)]
+    if not parti:
+        return pd.DataFrame(columns=COLONNE_REPORT_VALIDAZIONE)
+    return pd.concat(parti, ignore_index=True)[COLONNE_REPORT_VALIDAZIONE]
+
+
+def riepilogo_validazione(report: pd.DataFrame) -> str:
+    """Messaggio d'errore riassuntivo per gli errori bloccanti del report."""
+    errori = report[report["gravita"] == "errore"]
+    primo = errori.sort_values("riga", kind="stable").iloc[0]
+    return (f"{len(errori)} errori di validazione in {errori['riga'].nunique()} righe "
+            f"(primo: riga {primo['riga']}, {primo['campo']}: {primo['errore']})")
+
+
+def processa_csv_incassi(df: pd.DataFrame, notifica=None, errori: list = None,
+                         strumentazione: Strumentazione = None):
+    """Processa il CSV degli incassi: normalizza date, importi, valida e aggrega.
+
+    ``notifica(livello, messaggio)`` riceve i messaggi diagnostici
+    (livelli: info, write, success, warning, error); di default vanno nel log.
+    Se ``errori`` è una lista, vi viene aggiunto il report di validazione
+    (vedi valida_incassi); con errori bloccanti non si aggrega.
+    ``strumentazione`` misura le fasi normalizzazione, validazione e aggregazione.
+    """
+    notifica = notifica or notifica_log
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    notifica("info", f"📊 CSV caricato: {len(df.columns)} colonne, {len(df)} righe")
+
+    with strumentazione.fase("normalizzazione", len(df)):
+        df, errore = mappa_colonne_incassi(df, notifica)
+        if errore:
+            return None, errore
+        df = normalizza_incassi(df)
+
+    with strumentazione.fase("validazione", len(df)):
+        report = valida_incassi(df)
+    if (report["gravita"] == "errore").any():
+        if errori is not None:
+            errori.append(report)
+        return None, riepilogo_validazione(report)
+
+    with strumentazione.fase("aggregazione", len(df)):
+        df_aggregato = aggrega_incassi(df)
+    with strumentazione.fase("validazione"):
+        report = _unisci_report([report, valida_causali_aggregate(df_aggregato["iban"], df_aggregato["causale"])])
+    if errori is not None:
+        errori.append(report)
+    _notifica_avvisi(report, notifica)
+    return df_aggregato, "OK"
+
+
+def _notifica_avvisi(report: pd.DataFrame, notifica):
+    if len(report):
+        notifica("warning", f"⚠️ {len(report)} avvisi di validazione (vedi report)")
+
+
+class AggregatoIncassi:
+    """Aggregato incrementale per IBAN, alimentato un blocco di righe alla volta.
+
+    Per ogni debitore conserva solo nome, CF e data mandato della prima
+    occorrenza, il totale in centesimi e le causali distinte: la memoria
+    dipende dal numero di debitori, non dal numero di righe lette.
+    """
+
+    def __init__(self):
+        self._debitori = {}
+        self.righe = 0
+
+    def aggiungi(self, df: pd.DataFrame):
+        """Aggiunge un blocco già normalizzato e validato."""
+        self.righe += len(df)
+        df = df.assign(
+            importo_centesimi=importi_in_centesimi_serie(df["importo"]),
+            causale=df["causale"].astype(str),
+        )
+        parziale = df.groupby("iban", sort=False).agg(
+            nome_debitore=("nome_debitore", "first"),
+            codice_fiscale=("codice_fiscale", "first"),
+            data_firma_mandato=("data_firma_mandato", "first"),
+            importo_centesimi=("importo_centesimi", "sum"),
+        )
+
+        debitori = self._debitori
+        for iban, nome, cf, data, centesimi in zip(
+            parziale.index.tolist(), parziale["nome_debitore"].tolist(), parziale["codice_fiscale"].tolist(),
+            parziale["data_firma_mandato"].tolist(), parziale["importo_centesimi"].tolist()
+        ):
+            voce = debitori.get(iban)
+            if voce is None:
+                debitori[iban] = [nome, cf, data, centesimi, {}]
+            else:
+                voce[3] += centesimi
+
+        coppie = df[["iban", "causale"]].drop_duplicates()
+        for iban, causale in zip(coppie["iban"].tolist(), coppie["causale"].tolist()):
+            debitori[iban][4].setdefault(causale)
+
+    def lotto(self) -> "LottoIncassi":
+        """Incassi aggregati come LottoIncassi, senza passare da un DataFrame."""
+        ibans = sorted(self._debitori)
+        voci = [self._debitori[iban] for iban in ibans]
+        return LottoIncassi(
+            ibans,
+            [v[0] for v in voci],
+            [v[1] for v in voci],
+            ["Ft. " + ", ".join(v[4]) for v in voci],
+            [v[2] for v in voci],
+            [v[3] for v in voci],
+        )
+
+    def risultato(self) -> pd.DataFrame:
+        """DataFrame aggregato nello stesso formato di aggrega_incassi."""
+        ibans = sorted(self._debitori)
+        voci = [self._debitori[iban] for iban in ibans]
+        df_aggregato = pd.DataFrame({
+            "iban": ibans,
+            "nome_debitore": [v[0] for v in voci],
+            "codice_fiscale": [v[1] for v in voci],
+            "causale": ["Ft. " + ", ".join(v[4]) for v in voci],
+            "data_firma_mandato": [v[2] for v in voci],
+            "importo_centesimi": pd.Series([v[3] for v in voci], dtype="int64"),
+        })
+        df_aggregato.insert(3, "importo", formatta_centesimi_serie(df_aggregato["importo_centesimi"]))
+        df_aggregato.attrs["nb_of_txs"] = len(df_aggregato)
+        df_aggregato.attrs["ctrl_sum_centesimi"] = int(df_aggregato["importo_centesimi"].sum())
+        return df_aggregato
+
+
+def processa_csv_incassi_a_blocchi(blocchi, notifica=None, errori: list = None,
+                                   strumentazione: Strumentazione = None):
+    """Come processa_csv_incassi, ma su un iterabile di blocchi di righe.
+
+    Ogni blocco viene normalizzato, validato e incorporato in un
+    AggregatoIncassi, poi scartato. Dopo il primo errore di validazione i
+    blocchi successivi vengono solo validati, così il report (aggiunto a
+    ``errori`` se è una lista) copre tutto il file. Restituisce
+    (df_aggregato, messaggio).
+    """
+    notifica = notifica or notifica_log
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    aggregato = AggregatoIncassi()
+    colonne = None
+    report = []
+
+    try:
+        for blocco in blocchi:
+            with strumentazione.fase("normalizzazione", len(blocco)):
+                if colonne is None:
+                    blocco, errore = mappa_colonne_incassi(blocco, notifica)
+                    if errore:
+                        return None, errore
+                    colonne = list(blocco.columns)
+                else:
+                    blocco.columns = colonne
+                blocco = normalizza_incassi(blocco)
+
+            with strumentazione.fase("validazione", len(blocco)):
+                report.append(valida_incassi(blocco))
+            if aggregato is not None and (report[-1]["gravita"] == "errore").any():
+                aggregato = None
+            if aggregato is not None:
+                with strumentazione.fase("aggregazione", len(blocco)):
+                    aggregato.aggiungi(blocco)
+    finally:
+        # Chiude subito il lettore se ci si ferma a metà file
+        if hasattr(blocchi, "close"):
+            blocchi.close()
+
+    if colonne is None:
+        return None, "Il file non contiene righe"
+
+    report = _unisci_report(report)
+    if aggregato is None:
+        if errori is not None:
+            errori.append(report)
+        return None, riepilogo_validazione(report)
+
+    notifica("info", f"📊 CSV caricato: {len(colonne)} colonne, {aggregato.righe} righe")
+    with strumentazione.fase("aggregazione"):
+        df_aggregato = aggregato.risultato()
+    with strumentazione.fase("validazione"):
+        report = _unisci_report([report, valida_causali_aggregate(df_aggregato["iban"], df_aggregato["causale"])])
+    if errori is not None:
+        errori.append(report)
+    _notifica_avvisi(report, notifica)
+    return df_aggregato, "OK"
+
+
+# Caratteri non ammessi in un documento XML 1.0
+_CARATTERI_NON_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+
+XML_DICHIARAZIONE = '<?xml version="1.0" encoding="UTF-8"?>'
+
+
+def escape_xml(testo) -> str:
+    """Applica l'escape dei caratteri speciali come nel pretty-print di minidom."""
+    testo = str(testo)
+    if _CARATTERI_NON_XML.search(testo):
+        raise ValueError(f"Carattere non valido per XML nel valore: {testo!r}")
+    if "\r" in testo:
+        testo = testo.replace("\r\n", "\n").replace("\r", "\n")
+    return (
+        testo.replace("&", "&amp;")
+        .replace("<", "&lt;")
+        .replace("\"", "&quot;")
+        .replace(">", "&gt;")
+    )
+
+
+def riga_campo(rientro: str, tag: str, testo, attr: str = "") -> str:
+    """Riga (preceduta da a capo) di un elemento foglia con il suo testo."""
+    testo = escape_xml(testo)
+    if not testo:
+        return f"\n{rientro}<{tag}{attr}/>"
+    riga = f"{rientro}<{tag}{attr}>{testo}</{tag}>"
+    if "\n" in riga:
+        # Il vecchio post-processing eliminava le righe vuote anche dentro il testo
+        riga = "\n".join(r for r in riga.split("\n") if r.strip())
+    return "\n" + riga
+
+
+def rendi_transazione(r: list, msg_id: str, prefisso_mandato: str, idx: int,
+                      iban, nome_debitore, codice_fiscale, causale, data_firma_mandato,
+                      importo_centesimi: int) -> str:
+    """Frammento XML di un DrctDbtTxInf; ``r`` sono i prefissi di indentazione per livello."""
+    corpo = corpo_transazione(r, prefisso_mandato, iban, nome_debitore, codice_fiscale, causale,
+                              data_firma_mandato, importo_centesimi)
+    return timbra_transazione(r, escape_xml(msg_id), idx, corpo)
+
+
+def timbra_transazione(r: list, msg_id_xml: str, idx: int, corpo: str) -> str:
+    """Completa il corpo di un DrctDbtTxInf con InstrId, EndToEndId e progressivo dell'Ustrd.
+
+    ``msg_id_xml`` deve essere già passato da escape_xml.
+    """
+    inizio_ustrd = corpo.index("<Ustrd>") + 7
+    return "".join((
+        f"\n{r[0]}<DrctDbtTxInf>\n{r[1]}<PmtId>\n{r[2]}<InstrId>{idx:07d}</InstrId>",
+        f"\n{r[2]}<EndToEndId>{genera_end_to_end_id(msg_id_xml, idx)}</EndToEndId>",
+        corpo[:inizio_ustrd], f"{idx:019d}", corpo[inizio_ustrd:],
+    ))
+
+
+# Livello dei DrctDbtTxInf nel documento (figli di PmtInf)
+LIVELLO_TRANSAZIONI = 4
+
+
+def rientri_transazione(indent: str) -> list:
+    """Prefissi di indentazione usati per i DrctDbtTxInf, come ScrittoreXml.rientri(5) dentro PmtInf."""
+    return [indent * (LIVELLO_TRANSAZIONI + k) for k in range(6)]
+
+
+def causale_ustrd(causale) -> str:
+    """Causale dell'Ustrd, troncata con "..." se con il progressivo supera USTRD_MAX caratteri."""
+    causale = str(causale)
+    massimo = USTRD_MAX - USTRD_PREFISSO
+    if len(causale) <= massimo:
+        return causale
+    return causale[:massimo - 3].rstrip() + "..."
+
+
+def corpo_transazione(r: list, prefisso_mandato: str, iban, nome_debitore, codice_fiscale, causale,
+                      data_firma_mandato, importo_centesimi: int) -> str:
+    """DrctDbtTxInf senza gli identificativi (vedi timbra_transazione).
+
+    Dipende solo dai dati del debitore, quindi si può riusare tra un flusso e l'altro.
+    """
+    return "".join((
+        f"\n{r[1]}</PmtId>",
+        riga_campo(r[1], "InstdAmt", formatta_centesimi(importo_centesimi), ' Ccy="EUR"'),
+        f"\n{r[1]}<DrctDbtTx>\n{r[2]}<MndtRltdInf>",
+        riga_campo(r[3], "MndtId", genera_mandate_id(prefisso_mandato, codice_fiscale)),
+        riga_campo(r[3], "DtOfSgntr", data_firma_mandato),
+        f"\n{r[2]}</MndtRltdInf>\n{r[1]}</DrctDbtTx>\n{r[1]}<Dbtr>",
+        riga_campo(r[2], "Nm", nome_debitore),
+        f"\n{r[2]}<Id>\n{r[3]}<OrgId>\n{r[4]}<Othr>",
+        riga_campo(r[5], "Id", codice_fiscale),
+        f"\n{r[5]}<Issr>ADE</Issr>\n{r[4]}</Othr>\n{r[3]}</OrgId>\n{r[2]}</Id>\n{r[1]}</Dbtr>",
+        f"\n{r[1]}<DbtrAcct>\n{r[2]}<Id>",
+        riga_campo(r[3], "IBAN", pulisci_iban(iban)),
+        f"\n{r[2]}</Id>\n{r[1]}</DbtrAcct>\n{r[1]}<RmtInf>",
+        # Il progressivo va subito dopo <Ustrd>: la prima riga non è mai vuota
+        riga_campo(r[2], "Ustrd", f" - {causale_ustrd(causale)}"),
+        f"\n{r[1]}</RmtInf>\n{r[0]}</DrctDbtTxInf>",
+    ))
+
+
+class ScrittoreXml:
+    """Scrittore XML in streaming: emette una riga per elemento su un sink di byte.
+
+    Con ``indent=""`` produce lo stesso output del pretty-print minidom
+    usato storicamente (una riga per tag, nessuna indentazione).
+    """
+
+    def __init__(self, sink, indent: str = "", righe_per_blocco: int = 2000):
+        self.sink = sink
+        self.indent = indent
+        self.livello = 0
+        self.righe_per_blocco = righe_per_blocco
+        self._buffer = [XML_DICHIARAZIONE]
+
+    def _riga(self, riga: str):
+        self._buffer.append("\n" + self.indent * self.livello + riga)
+        if len(self._buffer) >= self.righe_per_blocco:
+            self.flush()
+
+    def apri(self, tag: str, attributi: dict = None):
+        """Apre un elemento contenitore."""
+        attr = "".join(f' {nome}="{escape_xml(valore)}"' for nome, valore in (attributi or {}).items())
+        self._riga(f"<{tag}{attr}>")
+        self.livello += 1
+
+    def chiudi(self, tag: str):
+        """Chiude l'elemento contenitore aperto per ultimo."""
+        self.livello -= 1
+        self._riga(f"</{tag}>")
+
+    def campo(self, tag: str, testo, attributi: dict = None):
+        """Scrive un elemento foglia con il suo testo."""
+        attr = "".join(f' {nome}="{escape_xml(valore)}"' for nome, valore in (attributi or {}).items())
+        self.blocco(riga_campo(self.indent * self.livello, tag, testo, attr))
+
+    def rientri(self, profondita: int) -> list:
+        """Prefissi di indentazione dal livello corrente fino a ``profondita`` livelli sotto."""
+        return [self.indent * (self.livello + k) for k in range(profondita + 1)]
+
+    def blocco(self, testo: str):
+        """Accoda un frammento XML già formattato (che inizia con un a capo)."""
+        self._buffer.append(testo)
+        if len(self._buffer) >= self.righe_per_blocco:
+            self.flush()
+
+    def blocco_byte(self, dati: bytes):
+        """Scrive sul sink un frammento XML già formattato e codificato in UTF-8."""
+        self.flush()
+        self.sink.write(dati)
+
+    def flush(self):
+        """Scrive sul sink le righe accumulate."""
+        if self._buffer:
+            self.sink.write("".join(self._buffer).encode("utf-8"))
+            self._buffer = []
+
+
+SEQ_TP_DEFAULT = "RCUR"
+
+
+class Sottodistinta(NamedTuple):
+    """Transazioni di un PmtInf (sottodistinta), scritte come un messaggio logico.
+
+    ``posizioni`` sono le posizioni delle transazioni nel lotto, ``primo_idx``
+    l'indice progressivo (InstrId) della prima transazione nel flusso.
+    """
+    numero: int
+    posizioni: object
+    primo_idx: int
+    data_addebito: str
+    seq_tp: str
+    nb_of_txs: int
+    ctrl_sum_centesimi: int
+
+
+def _apri_documento(w: ScrittoreXml, numero_messaggi: int):
+    """Apre il messaggio fisico CBIBdySDDReq con ``numero_messaggi`` messaggi logici."""
+    w.apri("CBIBdySDDReq", {
+        "xmlns": "urn:CBI:xsd:CBIBdySDDReq.00.01.00",
+        "xmlns:xsi": "http://www.w3.org/2001/XMLSchema-instance",
+        "xsi:schemaLocation": "urn:CBI:xsd:CBIBdySDDReq.00.01.00 CBIBdySDDReq.00.01.00.xsd",
+    })
+
+    w.apri("PhyMsgInf")
+    w.campo("PhyMsgTpCd", "INC-SDDC-01")
+    w.campo("NbOfLogMsg", str(numero_messaggi))
+    w.chiudi("PhyMsgInf")
+
+
+def _scrivi_messaggio_logico(w: ScrittoreXml, dati_aziendali, id_flusso: str, msg_id: str, cre_dt_tm: str,
+                             sottodistinta: "Sottodistinta", righe, msg_id_flusso: str = None,
+                             frammenti=None):
+    """Scrive un messaggio logico (GrpHdr + un PmtInf) con le transazioni ``righe``.
+
+    ``righe`` sono tuple (iban, nome, cf, causale, data, centesimi) oppure corpi
+    già pronti (vedi corpo_transazione); InstrId ed
+    EndToEndId partono da ``sottodistinta.primo_idx`` e usano ``msg_id_flusso``
+    (default ``msg_id``), così restano univoci in tutto il flusso.
+    In alternativa ``frammenti`` dà, in ordine, i DrctDbtTxInf di tutta la
+    sottodistinta già timbrati e codificati (vedi _frammenti_in_parallelo).
+    """
+    nome_azienda = dati_aziendali["nome_azienda"]
+    prefisso_mandato = dati_aziendali["prefisso_mandato"]
+    msg_id_flusso = msg_id_flusso or msg_id
+
+    w.apri("CBIEnvelSDDReqLogMsg")
+    w.apri("CBISDDReqLogMsg")
+
+    w.apri("GrpHdr", {"xmlns": "urn:CBI:xsd:CBISDDReqLogMsg.00.01.00"})
+    w.campo("MsgId", msg_id)
+    w.campo("CreDtTm", cre_dt_tm)
+    w.campo("NbOfTxs", str(sottodistinta.nb_of_txs))
+    w.campo("CtrlSum", formatta_centesimi(sottodistinta.ctrl_sum_centesimi))
+    w.apri("InitgPty")
+    w.campo("Nm", nome_azienda)
+    w.apri("Id")
+    w.apri("OrgId")
+    w.apri("Othr")
+    w.campo("Id", id_flusso)
+    w.campo("Issr", "CBI")
+    w.chiudi("Othr")
+    w.chiudi("OrgId")
+    w.chiudi("Id")
+    w.chiudi("InitgPty")
+    w.chiudi("GrpHdr")
+
+    w.apri("PmtInf", {"xmlns": "urn:CBI:xsd:CBISDDReqLogMsg.00.01.00"})
+    w.campo("PmtInfId", f"SOTTODISTINTA{sottodistinta.numero}")
+    w.campo("PmtMtd", "DD")
+    w.apri("PmtTpInf")
+    w.apri("SvcLvl")
+    w.campo("Cd", "SEPA")
+    w.chiudi("SvcLvl")
+    w.apri("LclInstrm")
+    w.campo("Cd", "CORE")
+    w.chiudi("LclInstrm")
+    w.campo("SeqTp", sottodistinta.seq_tp)
+    w.chiudi("PmtTpInf")
+
+    w.campo("ReqdColltnDt", sottodistinta.data_addebito)
+
+    w.apri("Cdtr")
+    w.campo("Nm", nome_azienda)
+    w.apri("PstlAdr")
+    w.campo("Ctry", "IT")
+    w.campo("AdrLine", dati_aziendali["indirizzo_azienda"])
+    w.chiudi("PstlAdr")
+    w.chiudi("Cdtr")
+
+    w.apri("CdtrAcct")
+    w.apri("Id")
+    w.campo("IBAN", pulisci_iban(dati_aziendali["iban"]))
+    w.chiudi("Id")
+    w.chiudi("CdtrAcct")
+
+    w.apri("CdtrAgt")
+    w.apri("FinInstnId")
+    w.apri("ClrSysMmbId")
+    w.campo("MmbId", str(dati_aziendali["abi"]).zfill(5))
+    w.chiudi("ClrSysMmbId")
+    w.chiudi("FinInstnId")
+    w.chiudi("CdtrAgt")
+
+    w.apri("CdtrSchmeId")
+    w.campo("Nm", nome_azienda)
+    w.apri("Id")
+    w.apri("PrvtId")
+    w.apri("Othr")
+    w.campo("Id", dati_aziendali["creditor_id"])
+    w.apri("SchmeNm")
+    w.campo("Prtry", "SEPA")
+    w.chiudi("SchmeNm")
+    w.chiudi("Othr")
+    w.chiudi("PrvtId")
+    w.chiudi("Id")
+    w.chiudi("CdtrSchmeId")
+
+    if frammenti is not None:
+        for frammento in frammenti:
+            w.blocco_byte(frammento)
+    else:
+        rientri = w.rientri(5)
+        msg_id_xml = escape_xml(msg_id_flusso)
+        for idx, riga in enumerate(righe, sottodistinta.primo_idx):
+            corpo = riga if isinstance(riga, str) else corpo_transazione(rientri, prefisso_mandato, *riga)
+            w.blocco(timbra_transazione(rientri, msg_id_xml, idx, corpo))
+
+    w.chiudi("PmtInf")
+    w.chiudi("CBISDDReqLogMsg")
+    w.chiudi("CBIEnvelSDDReqLogMsg")
+
+
+# Transazioni per blocco nella generazione su più processi: sotto MIN_TRANSAZIONI_BLOCCO
+# per processo non conviene avviare il pool
+TRANSAZIONI_PER_BLOCCO = 20000
+MIN_TRANSAZIONI_BLOCCO = 5000
+
+
+def processi_generazione(processi: int, numero_transazioni: int) -> int:
+    """Processi da usare per generare ``numero_transazioni`` transazioni (None: tutti i core)."""
+    processi = processi or os.cpu_count() or 1
+    return max(1, min(processi, numero_transazioni // MIN_TRANSAZIONI_BLOCCO))
+
+
+def _rendi_frammento(dati, primo_idx: int, msg_id_flusso: str, prefisso_mandato: str, indent: str) -> bytes:
+    """DrctDbtTxInf di un blocco di transazioni, già timbrati (eseguito nei processi del pool).
+
+    ``dati`` è un LottoIncassi oppure una ColonnaTesto di corpi già pronti.
+    """
+    rientri = rientri_transazione(indent)
+    msg_id_xml = escape_xml(msg_id_flusso)
+    if isinstance(dati, ColonnaTesto):
+        corpi = iter(dati)
+    else:
+        corpi = (corpo_transazione(rientri, prefisso_mandato, *riga) for riga in dati.colonne())
+    return "".join([timbra_transazione(rientri, msg_id_xml, idx, corpo)
+                    for idx, corpo in enumerate(corpi, primo_idx)]).encode("utf-8")
+
+
+def _frammenti_in_parallelo(pool, processi: int, lotto: "LottoIncassi", corpi, posizioni, primo_idx: int,
+                            msg_id_flusso: str, prefisso_mandato: str, indent: str, avanzamento=None):
+    """Genera nel ``pool`` i DrctDbtTxInf delle ``posizioni`` e li restituisce in ordine.
+
+    Le transazioni sono divise in blocchi contigui; ogni blocco riceve solo
+    i propri dati e l'indice globale della sua prima transazione, quindi
+    InstrId, EndToEndId e numerazione dell'Ustrd sono quelli della
+    generazione in un solo processo.
+    """
+    posizioni = np.asarray(posizioni)
+    dimensione = max(1, min(TRANSAZIONI_PER_BLOCCO, -(-len(posizioni) // processi)))
+    blocchi = []
+    for inizio in range(0, len(posizioni), dimensione):
+        selezione = posizioni[inizio:inizio + dimensione].tolist()
+        dati = corpi.seleziona(selezione) if corpi is not None else lotto.seleziona(selezione)
+        blocchi.append((pool.submit(_rendi_frammento, dati, primo_idx + inizio, msg_id_flusso,
+                                    prefisso_mandato, indent), len(selezione)))
+    for future, numero in blocchi:
+        yield future.result()
+        if avanzamento is not None:
+            avanzamento(numero)
+
+
+def scrivi_xml_cbi(destinazione, dati_aziendali, incassi, data_addebito: str, id_flusso: str,
+                   indent: str = "", totali: tuple = None, avanzamento=None, processi: int = 1,
+                   msg_id: str = None) -> int:
+    """Scrive il file XML SEPA SDD CBI in streaming su un file o un sink di byte.
+
+    ``destinazione`` può essere un percorso oppure un oggetto con metodo ``write``
+    che accetta bytes. ``incassi`` è un LottoIncassi (oppure una sequenza di
+    dict, convertita al volo). ``totali`` è la coppia (NbOfTxs, CtrlSum in centesimi)
+    prodotta dall'aggregazione; se assente viene calcolata dagli incassi.
+    Tutte le transazioni finiscono in un'unica sottodistinta (vedi
+    partiziona_incassi per suddividerle). ``avanzamento(n)`` è chiamata man
+    mano con il numero di transazioni appena scritte. Con ``processi`` > 1
+    (None: tutti i core) le transazioni sono generate a blocchi in processi
+    separati, con output identico byte per byte. ``msg_id`` (default:
+    generato dall'ID flusso) è il MsgId, ad es. assegnato da
+    AllocatoreIdentificativi. Restituisce il numero di transazioni scritte.
+    """
+    if isinstance(destinazione, (str, os.PathLike)):
+        with open(destinazione, "wb") as f:
+            return scrivi_xml_cbi(f, dati_aziendali, incassi, data_addebito, id_flusso, indent, totali,
+                                  avanzamento, processi, msg_id)
+
+    lotto = incassi if isinstance(incassi, LottoIncassi) else LottoIncassi.da_record(incassi)
+    numero_transazioni, totale_centesimi = totali if totali is not None else lotto.totali()
+    sottodistinta = Sottodistinta(1, range(numero_transazioni), 1, data_addebito, SEQ_TP_DEFAULT,
+                                  numero_transazioni, totale_centesimi)
+
+    msg_id = msg_id or genera_message_id(id_flusso)
+    cre_dt_tm = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+
+    processi = processi_generazione(processi, numero_transazioni)
+    with (ProcessPoolExecutor(max_workers=processi) if processi > 1 else nullcontext()) as pool:
+        righe = frammenti = None
+        if pool is not None:
+            frammenti = _frammenti_in_parallelo(pool, processi, lotto, None, range(numero_transazioni), 1,
+                                                msg_id, dati_aziendali["prefisso_mandato"], indent, avanzamento)
+        else:
+            righe = lotto.colonne()
+            if avanzamento is not None:
+                righe = _con_avanzamento(righe, avanzamento)
+        w = ScrittoreXml(destinazione, indent)
+        _apri_documento(w, 1)
+        _scrivi_messaggio_logico(w, dati_aziendali, id_flusso, msg_id, cre_dt_tm, sottodistinta, righe,
+                                 frammenti=frammenti)
+        w.chiudi("CBIBdySDDReq")
+        w.flush()
+    return numero_transazioni
+
+
+def genera_xml_cbi(dati_aziendali, incassi, data_addebito: str, id_flusso: str, indent: str = "",
+                   totali: tuple = None, avanzamento=None, processi: int = 1) -> bytes:
+    """Genera il file XML SEPA SDD in formato CBI."""
+    buffer = io.BytesIO()
+    scrivi_xml_cbi(buffer, dati_aziendali, incassi, data_addebito, id_flusso, indent, totali, avanzamento,
+                   processi)
+    return buffer.getvalue()
+
+
+# ---------------- SUDDIVISIONE IN SOTTODISTINTE E FILE ----------------
+
+class LimitiPartizione(NamedTuple):
+    """Limiti di suddivisione del flusso (None = nessun limite)."""
+    max_tx_sottodistinta: int = None
+    max_tx_file: int = None
+    max_byte_file: int = None
+
+
+# Margine sulla stima dei byte per l'escape dei caratteri speciali
+_MARGINE_STIMA_BYTE = 1.02
+
+
+class _SinkConteggio:
+    """Sink di byte che ne conta soltanto la dimensione."""
+
+    def __init__(self):
+        self.byte = 0
+
+    def write(self, dati: bytes):
+        self.byte += len(dati)
+
+
+def _stima_byte(lotto: LottoIncassi, dati_aziendali, data_addebito: str, indent: str):
+    """Stima per eccesso dei byte di un file: (documento vuoto, messaggio logico vuoto, array per transazione)."""
+    segnaposto_msg_id = "M" * 35
+    vuota = Sottodistinta(1, range(0), 1, data_addebito, SEQ_TP_DEFAULT, 0, 0)
+
+    def byte_documento(messaggi: int) -> int:
+        sink = _SinkConteggio()
+        w = ScrittoreXml(sink, indent)
+        _apri_documento(w, 10 ** 6)
+        for _ in range(messaggi):
+            _scrivi_messaggio_logico(w, dati_aziendali, segnaposto_msg_id, segnaposto_msg_id,
+                                     "0" * 19, vuota, ())
+        w.chiudi("CBIBdySDDReq")
+        w.flush()
+        return sink.byte
+
+    documento = byte_documento(0)
+    messaggio = byte_documento(1) - documento + 16
+
+    # Parte fissa di una transazione: sei segnaposto "X" (il CF compare due volte) e l'importo "0.00"
+    fissa = len(rendi_transazione(rientri_transazione(indent), segnaposto_msg_id, dati_aziendali["prefisso_mandato"],
+                                  10 ** 6, "X", "X", "X", "X", "X", 0).encode("utf-8")) - 6 - 4
+    larghezza_importo = len(formatta_centesimi(max(map(abs, lotto.importo_centesimi), default=0))) + 1
+    variabile = (lotto.iban.lunghezze() + lotto.nome_debitore.lunghezze() + 2 * lotto.codice_fiscale.lunghezze()
+                 + lotto.causale.lunghezze() + lotto.data_firma_mandato.lunghezze())
+    transazioni = np.ceil((fissa + larghezza_importo + variabile) * _MARGINE_STIMA_BYTE).astype(np.int64)
+    return documento, messaggio, transazioni
+
+
+def partiziona_incassi(lotto: LottoIncassi, dati_aziendali, data_addebito: str, limiti: LimitiPartizione = None,
+                       indent: str = "", seq_tp=None, date_addebito=None) -> list:
+    """Suddivide il lotto in file e sottodistinte rispettando ``limiti``.
+
+    Le transazioni sono raggruppate per (data di addebito, SeqTp): ``date_addebito``
+    e ``seq_tp`` sono sequenze facoltative allineate al lotto (default:
+    ``data_addebito`` e RCUR per tutte). Ogni gruppo è diviso in sottodistinte
+    di al più ``max_tx_sottodistinta`` transazioni, poi le sottodistinte sono
+    distribuite in file che non superano ``max_tx_file`` transazioni né
+    (secondo una stima per eccesso) ``max_byte_file`` byte.
+    Restituisce la lista dei file, ognuno una lista di Sottodistinta.
+    """
+    limiti = limiti or LimitiPartizione()
+    n = len(lotto)
+    centesimi = np.frombuffer(lotto.importo_centesimi, dtype=np.int64) if n else np.zeros(0, dtype=np.int64)
+
+    if seq_tp is None and date_addebito is None:
+        gruppi = [((data_addebito, SEQ_TP_DEFAULT), np.arange(n))]
+    else:
+        chiavi = pd.DataFrame({
+            "data": list(date_addebito) if date_addebito is not None else data_addebito,
+            "seq_tp": list(seq_tp) if seq_tp is not None else SEQ_TP_DEFAULT,
+        }, index=range(n))
+        gruppi = [(chiave, np.asarray(posizioni)) for chiave, posizioni in chiavi.groupby(["data", "seq_tp"]).indices.items()]
+
+    if limiti.max_byte_file:
+        byte_documento, byte_messaggio, byte_transazioni = _stima_byte(lotto, dati_aziendali, data_addebito, indent)
+    else:
+        byte_documento = byte_messaggio = 0
+        byte_transazioni = np.zeros(n, dtype=np.int64)
+
+    file_partizioni = []
+    corrente, tx_file, byte_file = [], 0, byte_documento
+    numero, idx = 1, 1
+
+    for (data, tipo), posizioni in gruppi:
+        passo = limiti.max_tx_sottodistinta or len(posizioni) or 1
+        for inizio in range(0, len(posizioni), passo):
+            resto = posizioni[inizio:inizio + passo]
+            while len(resto):
+                disponibili = len(resto)
+                if limiti.max_tx_file:
+                    disponibili = min(disponibili, limiti.max_tx_file - tx_file)
+                if limiti.max_byte_file and disponibili > 0:
+                    spazio = limiti.max_byte_file - byte_file - byte_messaggio
+                    cumulati = np.cumsum(byte_transazioni[resto[:disponibili]])
+                    disponibili = int(np.searchsorted(cumulati, spazio, side="right"))
+                if disponibili <= 0:
+                    if corrente:
+                        file_partizioni.append(corrente)
+                        corrente, tx_file, byte_file = [], 0, byte_documento
+                        continue
+                    # Una sola transazione oltre il limite: la si scrive comunque da sola
+                    disponibili = 1
+
+                parte, resto = resto[:disponibili], resto[disponibili:]
+                corrente.append(Sottodistinta(numero, parte, idx, data, tipo, len(parte),
+                                              int(centesimi[parte].sum())))
+                numero += 1
+                idx += len(parte)
+                tx_file += len(parte)
+                byte_file += byte_messaggio + int(byte_transazioni[parte].sum())
+
+    if not corrente and not file_partizioni:
+        # Lotto vuoto: un file con una sottodistinta vuota, come scrivi_xml_cbi
+        corrente = [Sottodistinta(1, np.arange(0), 1, data_addebito, SEQ_TP_DEFAULT, 0, 0)]
+    if corrente:
+        file_partizioni.append(corrente)
+    return file_partizioni
+
+
+def nomi_file_partizioni(destinazione, numero_file: int) -> list:
+    """Percorsi dei file di un flusso suddiviso: ``nome_001.xml``, ``nome_002.xml``...
+
+    Con un solo file il percorso resta ``destinazione``.
+    """
+    if numero_file == 1:
+        return [destinazione]
+    percorso = Path(destinazione)
+    return [percorso.with_name(f"{percorso.stem}_{n:03d}{percorso.suffix}") for n in range(1, numero_file + 1)]
+
+
+def scrivi_file_partizionato(destinazione, dati_aziendali, lotto: LottoIncassi, sottodistinte: list,
+                             id_flusso: str, msg_id: str, cre_dt_tm: str, indent: str = "",
+                             numera_msg_id: bool = True, corpi: ColonnaTesto = None,
+                             avanzamento=None, processi: int = 1) -> int:
+    """Scrive un file del flusso con le sue sottodistinte, una per messaggio logico.
+
+    Con ``numera_msg_id`` il MsgId di ogni sottodistinta è ``{msg_id}-{numero}``;
+    gli EndToEndId usano sempre ``msg_id`` e l'indice progressivo nel flusso.
+    ``corpi``, se presente, contiene il corpo già pronto di ogni transazione
+    del lotto (vedi corpo_transazione). ``avanzamento(n)`` è chiamata man mano
+    con il numero di transazioni appena scritte. Con ``processi`` > 1 le
+    transazioni sono generate a blocchi in processi separati (vedi
+    scrivi_xml_cbi). ``destinazione`` è un percorso oppure un sink di byte.
+    Restituisce il numero di transazioni scritte.
+    """
+    if isinstance(destinazione, (str, os.PathLike)):
+        with open(destinazione, "wb") as f:
+            return scrivi_file_partizionato(f, dati_aziendali, lotto, sottodistinte, id_flusso,
+                                            msg_id, cre_dt_tm, indent, numera_msg_id, corpi, avanzamento,
+                                            processi)
+
+    numero_transazioni = sum(s.nb_of_txs for s in sottodistinte)
+    processi = processi_generazione(processi, numero_transazioni)
+    colonne = [getattr(lotto, campo) for campo in LottoIncassi.CAMPI_TESTO] + [lotto.importo_centesimi]
+    with (ProcessPoolExecutor(max_workers=processi) if processi > 1 else nullcontext()) as pool:
+        w = ScrittoreXml(destinazione, indent)
+        _apri_documento(w, len(sottodistinte))
+        for sottodistinta in sottodistinte:
+            righe = frammenti = None
+            if pool is not None:
+                frammenti = _frammenti_in_parallelo(pool, processi, lotto, corpi, sottodistinta.posizioni,
+                                                    sottodistinta.primo_idx, msg_id,
+                                                    dati_aziendali["prefisso_mandato"], indent, avanzamento)
+            else:
+                posizioni = np.asarray(sottodistinta.posizioni).tolist()
+                if corpi is not None:
+                    righe = (corpi[i] for i in posizioni)
+                else:
+                    righe = (tuple(colonna[i] for colonna in colonne) for i in posizioni)
+                if avanzamento is not None:
+                    righe = _con_avanzamento(righe, avanzamento)
+            msg_id_sottodistinta = f"{msg_id}-{sottodistinta.numero}" if numera_msg_id else msg_id
+            _scrivi_messaggio_logico(w, dati_aziendali, id_flusso, msg_id_sottodistinta, cre_dt_tm,
+                                     sottodistinta, righe, msg_id, frammenti)
+        w.chiudi("CBIBdySDDReq")
+        w.flush()
+    return numero_transazioni
+
+
+def _con_avanzamento(righe, avanzamento, passo: int = 1000):
+    """Inoltra ``righe`` chiamando ``avanzamento(n)`` ogni ``passo`` righe e alla fine."""
+    contate = 0
+    for riga in righe:
+        yield riga
+        contate += 1
+        if contate == passo:
+            avanzamento(contate)
+            contate = 0
+    if contate:
+        avanzamento(contate)
+
+
+def _scrivi_partizione(destinazione, *argomenti):
+    """Scrive un file partizionato (eseguito nei processi del pool).
+
+    Senza destinazione restituisce i byte, con un percorso il percorso come
+    stringa, con un sink il sink stesso.
+    """
+    if destinazione is None:
+        buffer = io.BytesIO()
+        scrivi_file_partizionato(buffer, *argomenti)
+        return buffer.getvalue()
+    scrivi_file_partizionato(destinazione, *argomenti)
+    return str(destinazione) if isinstance(destinazione, (str, os.PathLike)) else destinazione
+
+
+def _ricolloca(sottodistinte: list):
+    """Posizioni di un file e sottodistinte riferite al lotto ridotto a quelle sole posizioni."""
+    posizioni = np.concatenate([s.posizioni for s in sottodistinte]) if sottodistinte else np.zeros(0, np.int64)
+    ricollocate, inizio = [], 0
+    for s in sottodistinte:
+        ricollocate.append(s._replace(posizioni=np.arange(inizio, inizio + s.nb_of_txs)))
+        inizio += s.nb_of_txs
+    return posizioni, ricollocate
+
+
+def scrivi_flusso_partizionato(destinazioni, dati_aziendali, incassi, partizioni: list, id_flusso: str,
+                               indent: str = "", processi: int = None, msg_id: str = None,
+                               corpi: ColonnaTesto = None, avanzamento=None) -> list:
+    """Scrive in parallelo i file di un flusso suddiviso con partiziona_incassi.
+
+    ``destinazioni`` ha un percorso (o un sink di byte, ad es. FileGenerato)
+    per ogni file; con ``None`` i file sono restituiti come bytes. Ogni file riceve solo le proprie transazioni e viene
+    scritto in un processo separato (``processi`` default: tutti i core; con
+    1 tutto avviene nel processo corrente); un flusso di un solo file usa
+    invece i processi per generarne le transazioni a blocchi. MsgId e CreDtTm sono gli stessi
+    per tutto il flusso (``msg_id`` default: generato dall'ID flusso).
+    ``corpi`` sono i corpi già pronti delle transazioni e ``avanzamento(n)``
+    riceve le transazioni scritte (vedi scrivi_file_partizionato; con più
+    processi è chiamata a ogni file completato). Restituisce i percorsi
+    scritti o i contenuti.
+    """
+    lotto = incassi if isinstance(incassi, LottoIncassi) else LottoIncassi.da_record(incassi)
+    destinazioni = list(destinazioni) if destinazioni is not None else [None] * len(partizioni)
+    if len(destinazioni) != len(partizioni):
+        raise ValueError(f"Servono {len(partizioni)} destinazioni, ricevute {len(destinazioni)}")
+
+    msg_id = msg_id or genera_message_id(id_flusso)
+    cre_dt_tm = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+    numera_msg_id = sum(len(sottodistinte) for sottodistinte in partizioni) > 1
+    processi = processi or os.cpu_count() or 1
+    if len(partizioni) == 1:
+        # Il file viene scritto qui (anche su un sink), le transazioni generate nei processi
+        return [_scrivi_partizione(destinazioni[0], dati_aziendali, lotto, partizioni[0], id_flusso, msg_id,
+                                   cre_dt_tm, indent, numera_msg_id, corpi, avanzamento, processi)]
+    processi = min(processi, len(partizioni))
+    if any(d is not None and not isinstance(d, (str, os.PathLike)) for d in destinazioni):
+        # I sink non possono passare ad altri processi
+        processi = 1
+
+    if processi <= 1:
+        return [_scrivi_partizione(destinazione, dati_aziendali, lotto, sottodistinte, id_flusso, msg_id,
+                                   cre_dt_tm, indent, numera_msg_id, corpi, avanzamento)
+                for destinazione, sottodistinte in zip(destinazioni, partizioni)]
+
+    with ProcessPoolExecutor(max_workers=processi) as pool:
+        futures = []
+        for destinazione, sottodistinte in zip(destinazioni, partizioni):
+            posizioni, ricollocate = _ricolloca(sottodistinte)
+            posizioni = posizioni.tolist()
+            futures.append(pool.submit(_scrivi_partizione, destinazione, dati_aziendali,
+                                       lotto.seleziona(posizioni), ricollocate,
+                                       id_flusso, msg_id, cre_dt_tm, indent, numera_msg_id,
+                                       corpi.seleziona(posizioni) if corpi is not None else None))
+        risultati = []
+        for future, sottodistinte in zip(futures, partizioni):
+            risultati.append(future.result())
+            if avanzamento is not None:
+                avanzamento(sum(s.nb_of_txs for s in sottodistinte))
+        return risultati
+
+
+# ---------------- REGISTRO MANDATI ----------------
+
+SEQ_TP_PRIMO = "FRST"
+
+_SCHEMA_REGISTRO = """
+CREATE TABLE IF NOT EXISTS mandati (
+    mandato TEXT PRIMARY KEY,
+    iban TEXT NOT NULL,
+    codice_fiscale TEXT NOT NULL,
+    data_firma TEXT,
+    incassi INTEGER NOT NULL DEFAULT 0,
+    primo_incasso TEXT,
+    ultimo_incasso TEXT
+);
+CREATE INDEX IF NOT EXISTS mandati_iban ON mandati (iban);
+CREATE TABLE IF NOT EXISTS incassi (
+    end_to_end_id TEXT PRIMARY KEY,
+    mandato TEXT NOT NULL,
+    iban TEXT NOT NULL,
+    seq_tp TEXT NOT NULL,
+    data_addebito TEXT NOT NULL,
+    importo_centesimi INTEGER NOT NULL,
+    id_flusso TEXT NOT NULL,
+    registrato TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS incassi_mandato ON incassi (mandato);
+"""
+
+_CONSULTA_REGISTRO = """
+SELECT r.posizione,
+       m.iban AS iban_registrato,
+       m.data_firma,
+       coalesce(m.incassi, 0) AS incassi,
+       (SELECT a.mandato FROM mandati a WHERE a.iban = r.iban AND a.mandato <> r.mandato LIMIT 1) AS altro_mandato
+FROM temp.richiesta r LEFT JOIN mandati m ON m.mandato = r.mandato
+ORDER BY r.posizione
+"""
+
+
+class RegistroMandati:
+    """Registro locale (SQLite) dei mandati e degli incassi già presentati.
+
+    Serve a scegliere FRST/RCUR, a rilevare i cambi di IBAN e a riusare le
+    date di firma note. Le consultazioni sono in blocco: i mandati del lotto
+    vanno in una tabella temporanea e lo stato si legge con un'unica join
+    sugli indici (mandato e IBAN), non con una query per transazione.
+    """
+
+    def __init__(self, percorso, timeout: float = 30.0):
+        self.percorso = str(percorso)
+        # Il timeout copre i lavori batch che registrano sullo stesso file
+        self._db = sqlite3.connect(self.percorso, timeout=timeout)
+        # Cache di pagine più ampia: gli inserimenti in blocco toccano gli indici in ordine sparso
+        self._db.execute("PRAGMA cache_size = -65536")
+        self._db.executescript(_SCHEMA_REGISTRO)
+
+    def chiudi(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+        return False
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM mandati").fetchone()[0]
+
+    def consulta(self, mandati, iban) -> pd.DataFrame:
+        """Stato nel registro di ogni coppia (mandato, IBAN), nell'ordine ricevuto.
+
+        Colonne: ``iban_registrato`` e ``data_firma`` (None se il mandato non è
+        registrato), ``incassi`` già presentati e ``altro_mandato`` (un altro
+        mandato registrato con lo stesso IBAN, se esiste).
+        """
+        self._db.execute("CREATE TEMP TABLE IF NOT EXISTS richiesta "
+                         "(posizione INTEGER PRIMARY KEY, mandato TEXT NOT NULL, iban TEXT NOT NULL)")
+        with self._db:
+            self._db.execute("DELETE FROM temp.richiesta")
+            self._db.executemany("INSERT INTO temp.richiesta VALUES (?, ?, ?)",
+                                 zip(range(len(mandati)), mandati, iban))
+            stato = pd.read_sql_query(_CONSULTA_REGISTRO, self._db, index_col="posizione")
+            self._db.execute("DELETE FROM temp.richiesta")
+        return stato.reset_index(drop=True)
+
+    def registra_flusso(self, lotto: LottoIncassi, mandati: list, partizioni: list, msg_id: str,
+                        id_flusso: str) -> int:
+        """Registra in un'unica transazione gli incassi di un flusso generato.
+
+        Aggiorna i mandati (IBAN corrente, data di firma se mancante, numero e
+        date degli incassi) e annota ogni transazione con il suo EndToEndId:
+        se uno di questi è già registrato nulla viene salvato. Restituisce il
+        numero di incassi registrati.
+        """
+        registrato = datetime.now().isoformat(timespec="seconds")
+        iban, codici_fiscali, date_firma = list(lotto.iban), list(lotto.codice_fiscale), list(lotto.data_firma_mandato)
+        incassi, aggiornamenti = [], []
+        for sottodistinte in partizioni:
+            for s in sottodistinte:
+                for idx, i in enumerate(np.asarray(s.posizioni).tolist(), s.primo_idx):
+                    incassi.append((genera_end_to_end_id(msg_id, idx), mandati[i], iban[i], s.seq_tp,
+                                    s.data_addebito, lotto.importo_centesimi[i], id_flusso, registrato))
+                    aggiornamenti.append((mandati[i], iban[i], codici_fiscali[i], date_firma[i],
+                                          s.data_addebito, s.data_addebito))
+
+        with self._db:
+            self._db.executemany("INSERT INTO incassi VALUES (?, ?, ?, ?, ?, ?, ?, ?)", incassi)
+            self._db.executemany(
+                """INSERT INTO mandati (mandato, iban, codice_fiscale, data_firma, incassi,
+                                        primo_incasso, ultimo_incasso)
+                   VALUES (?, ?, ?, ?, 1, ?, ?)
+                   ON CONFLICT (mandato) DO UPDATE SET
+                       iban = excluded.iban,
+                       data_firma = coalesce(mandati.data_firma, excluded.data_firma),
+                       incassi = mandati.incassi + 1,
+                       primo_incasso = coalesce(mandati.primo_incasso, excluded.primo_incasso),
+                       ultimo_incasso = max(coalesce(mandati.ultimo_incasso, ''), excluded.ultimo_incasso)""",
+                aggiornamenti,
+            )
+        return len(incassi)
+
+
+class SequenzaMandati(NamedTuple):
+    """Esito della consultazione del registro per un lotto (allineato al lotto)."""
+    lotto: LottoIncassi
+    mandati: list
+    seq_tp: list
+    report: pd.DataFrame
+
+
+def applica_registro_mandati(lotto: LottoIncassi, prefisso_mandato: str,
+                             registro: RegistroMandati) -> SequenzaMandati:
+    """Decide FRST/RCUR di ogni transazione e completa le date di firma dal registro.
+
+    È FRST il primo incasso di un mandato e quello su un IBAN diverso da
+    quello registrato (il registro non sa se è cambiata anche la banca del
+    debitore), RCUR tutti gli altri. Per i mandati registrati la data di
+    firma è quella del registro. Cambi di IBAN, IBAN già usati da un altro
+    mandato e date di firma diverse sono segnalati come avvisi nel report.
+    """
+    mandati = [genera_mandate_id(prefisso_mandato, cf) for cf in lotto.codice_fiscale]
+    iban = pd.Series(list(lotto.iban), dtype=object)
+    date_csv = pd.Series(list(lotto.data_firma_mandato), dtype=object)
+    stato = registro.consulta(mandati, iban.tolist())
+
+    registrato = stato["iban_registrato"].notna()
+    iban_cambiato = registrato & (stato["iban_registrato"] != iban)
+    primo = (stato["incassi"] == 0) | iban_cambiato
+    seq_tp = np.where(primo, SEQ_TP_PRIMO, SEQ_TP_DEFAULT).tolist()
+
+    data_nota = stato["data_firma"].notna()
+    date = stato["data_firma"].where(data_nota, date_csv)
+    data_diversa = data_nota & (stato["data_firma"] != date_csv)
+    altro_mandato = stato["altro_mandato"].notna()
+
+    def avvisi(maschera, campo, valore, errore):
+        return pd.DataFrame({"riga": pd.NA, "campo": campo, "valore": valore[maschera].to_numpy(),
+                             "errore": errore[maschera].to_numpy(), "gravita": "avviso"})
+
+    report = _unisci_report([
+        avvisi(iban_cambiato, "iban", iban,
+               "IBAN diverso da quello del registro (" + stato["iban_registrato"].fillna("") + "): sequenza FRST"),
+        avvisi(altro_mandato, "iban", iban, "IBAN già registrato per il mandato " + stato["altro_mandato"].fillna("")),
+        avvisi(data_diversa, "data_firma_mandato", date_csv,
+               "Data di firma diversa dal registro: usata " + stato["data_firma"].fillna("")),
+    ])
+    return SequenzaMandati(lotto.sostituisci(data_firma_mandato=date.tolist()), mandati, seq_tp, report)
+
+
+# ---------------- GENERAZIONE INCREMENTALE ----------------
+
+_SCHEMA_INDICE_INCREMENTALE = """
+CREATE TABLE IF NOT EXISTS parametri (
+    chiave TEXT PRIMARY KEY,
+    valore TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS colonne (
+    nome TEXT PRIMARY KEY,
+    dati BLOB NOT NULL,
+    offset BLOB
+);
+"""
+
+COLONNE_VARIAZIONI = ["iban", "variazione"]
+
+
+def impronte_lotto(lotto: LottoIncassi) -> np.ndarray:
+    """Impronta (8 byte) dei campi di testo che finiscono nel DrctDbtTxInf di ogni debitore.
+
+    Gli importi sono confrontati a parte (vedi IndiceIncrementale.confronta).
+    """
+    blake2b = hashlib.blake2b
+    righe = zip(*(getattr(lotto, campo).valori_byte() for campo in LottoIncassi.CAMPI_TESTO))
+    impronte = b"".join([blake2b(b"\x1f".join(riga), digest_size=8).digest() for riga in righe])
+    return np.frombuffer(impronte, dtype=np.uint64)
+
+
+class ConfrontoIncrementale(NamedTuple):
+    """Differenze di un lotto rispetto all'esecuzione precedente.
+
+    ``stati`` è allineato al lotto ("aggiunto", "modificato" o "invariato");
+    ``origine`` è la posizione in ``corpi_precedenti`` del corpo riusabile
+    (vedi corpo_transazione) di ogni debitore, -1 se va generato.
+    """
+    impronte: np.ndarray
+    stati: list
+    rimossi: list
+    origine: np.ndarray
+    corpi_precedenti: ColonnaTesto
+
+    def conteggi(self) -> dict:
+        conteggi = {stato: self.stati.count(stato) for stato in ("aggiunto", "modificato", "invariato")}
+        conteggi["rimosso"] = len(self.rimossi)
+        return conteggi
+
+    def variazioni(self, lotto: LottoIncassi) -> pd.DataFrame:
+        """Report dei debitori aggiunti, modificati e rimossi."""
+        variati = [(iban, stato) for iban, stato in zip(lotto.iban, self.stati) if stato != "invariato"]
+        variati += [(iban, "rimosso") for iban in self.rimossi]
+        return pd.DataFrame(variati, columns=COLONNE_VARIAZIONI)
+
+
+class IndiceIncrementale:
+    """Indice (SQLite) dei debitori aggregati dell'ultima esecuzione.
+
+    Conserva per colonne IBAN, impronta dei dati e corpo del DrctDbtTxInf
+    già generato (compresso): i debitori invariati non vengono rigenerati,
+    se ne aggiornano solo gli identificativi. I corpi dipendono da prefisso
+    mandato e indentazione, salvati come parametri dell'indice.
+    """
+
+    def __init__(self, percorso, timeout: float = 30.0):
+        self.percorso = str(percorso)
+        self._db = sqlite3.connect(self.percorso, timeout=timeout)
+        self._db.executescript(_SCHEMA_INDICE_INCREMENTALE)
+
+    def chiudi(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+        return False
+
+    def parametri(self) -> dict:
+        return dict(self._db.execute("SELECT chiave, valore FROM parametri"))
+
+    def _colonne(self) -> dict:
+        return {nome: (dati, offset) for nome, dati, offset in self._db.execute("SELECT nome, dati, offset FROM colonne")}
+
+    def confronta(self, lotto: LottoIncassi, parametri: dict) -> ConfrontoIncrementale:
+        """Confronta il lotto con l'esecuzione precedente, per IBAN."""
+        impronte = impronte_lotto(lotto)
+        importi = np.frombuffer(lotto.importo_centesimi, dtype=np.int64)
+        colonne = self._colonne()
+        if "iban" in colonne:
+            iban_precedenti = ColonnaTesto.da_buffer(*colonne["iban"])
+            impronte_precedenti = np.frombuffer(colonne["impronte"][0], dtype=np.uint64)
+            importi_precedenti = np.frombuffer(colonne["importi"][0], dtype=np.int64)
+        else:
+            iban_precedenti = ColonnaTesto([])
+            impronte_precedenti = importi_precedenti = np.zeros(1, dtype=np.int64)
+
+        # Confronto sugli IBAN in UTF-8, senza decodificarli
+        posizioni = dict(zip(iban_precedenti.valori_byte(), range(len(iban_precedenti))))
+        precedente = np.fromiter(map(posizioni.get, lotto.iban.valori_byte(), repeat(-1)),
+                                 dtype=np.int64, count=len(lotto))
+        noto = precedente >= 0
+        allineato = np.where(noto, precedente, 0)
+        invariato = noto & (impronte_precedenti[allineato] == impronte) & (importi_precedenti[allineato] == importi)
+        stati = np.where(invariato, "invariato", np.where(noto, "modificato", "aggiunto")).tolist()
+        ancora_presenti = np.zeros(len(iban_precedenti), dtype=bool)
+        ancora_presenti[precedente[noto]] = True
+        rimossi = [iban_precedenti[j] for j in np.flatnonzero(~ancora_presenti).tolist()]
+
+        corpi_precedenti = None
+        if "corpi" in colonne and self.parametri() == parametri:
+            dati, offset = colonne["corpi"]
+            corpi_precedenti = ColonnaTesto.da_buffer(zlib.decompress(dati), offset)
+        origine = np.where(invariato, precedente, -1) if corpi_precedenti is not None else np.full(len(lotto), -1)
+        return ConfrontoIncrementale(impronte, stati, rimossi, origine, corpi_precedenti)
+
+    def aggiorna(self, lotto: LottoIncassi, confronto: ConfrontoIncrementale, corpi: ColonnaTesto,
+                 parametri: dict):
+        """Sostituisce in un'unica transazione il contenuto dell'indice con il lotto appena generato."""
+        dati_corpi, offset_corpi = corpi.buffer()
+        colonne = [("iban", *lotto.iban.buffer()),
+                   ("impronte", confronto.impronte.tobytes(), None),
+                   ("importi", lotto.importo_centesimi.tobytes(), None),
+                   ("corpi", zlib.compress(dati_corpi, 1), offset_corpi)]
+        with self._db:
+            self._db.execute("DELETE FROM colonne")
+            self._db.executemany("INSERT INTO colonne VALUES (?, ?, ?)", colonne)
+            self._db.execute("DELETE FROM parametri")
+            self._db.executemany("INSERT INTO parametri VALUES (?, ?)", parametri.items())
+
+
+def parametri_incrementali(dati_aziendali, indent: str) -> dict:
+    """Parametri da cui dipendono i corpi memorizzati nell'indice incrementale."""
+    return {"prefisso_mandato": str(dati_aziendali["prefisso_mandato"]), "indent": indent, "ustrd_max": str(USTRD_MAX)}
+
+
+def corpi_incrementali(lotto: LottoIncassi, confronto: ConfrontoIncrementale, prefisso_mandato: str,
+                       indent: str = "") -> ColonnaTesto:
+    """Corpi di tutte le transazioni: quelli memorizzati per gli invariati, generati per gli altri."""
+    rientri = rientri_transazione(indent)
+    origine = confronto.origine.tolist()
+    pezzi = [confronto.corpi_precedenti.valore_byte(j) if j >= 0 else None for j in origine] \
+        if confronto.corpi_precedenti is not None else [None] * len(origine)
+    colonne = [getattr(lotto, campo) for campo in LottoIncassi.CAMPI_TESTO] + [lotto.importo_centesimi]
+    for i in np.flatnonzero(confronto.origine < 0).tolist():
+        riga = [colonna[i] for colonna in colonne]
+        pezzi[i] = corpo_transazione(rientri, prefisso_mandato, *riga).encode("utf-8")
+    return ColonnaTesto.da_byte(pezzi)
+
+
+# ---------------- IDENTIFICATIVI E DUPLICATI ----------------
+
+_SCHEMA_ALLOCATORE = """
+CREATE TABLE IF NOT EXISTS message_id (
+    id_flusso TEXT PRIMARY KEY,
+    ultimo TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS incassi_generati (
+    impronta INTEGER PRIMARY KEY,
+    msg_id TEXT NOT NULL,
+    data_addebito TEXT NOT NULL,
+    registrato TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS incassi_generati_msg_id ON incassi_generati (msg_id);
+"""
+
+
+def impronte_incassi(lotto: LottoIncassi, data_addebito: str) -> np.ndarray:
+    """Impronta (8 byte) di IBAN, importo, causale e data di addebito di ogni transazione del lotto."""
+    blake2b = hashlib.blake2b
+    data = data_addebito.encode("utf-8")
+    importi = (str(centesimi).encode("ascii") for centesimi in lotto.importo_centesimi)
+    righe = zip(lotto.iban.valori_byte(), importi, lotto.causale.valori_byte(), repeat(data))
+    impronte = b"".join([blake2b(b"\x1f".join(riga), digest_size=8).digest() for riga in righe])
+    return np.frombuffer(impronte, dtype=np.int64)
+
+
+class AllocatoreIdentificativi:
+    """Assegna MsgId univoci e blocca gli incassi già generati (SQLite locale condiviso).
+
+    Il database può essere usato da più processi (batch, servizio HTTP,
+    esecuzioni da cron sovrapposte): ogni operazione è una transazione
+    ``BEGIN IMMEDIATE``, che prende il lock in scrittura del file prima di
+    leggere, quindi assegnazioni e controlli concorrenti sono serializzati.
+    Le impronte degli incassi generati (vedi impronte_incassi) sono la chiave
+    primaria intera della tabella: il controllo di un lotto è un'unica join.
+    """
+
+    def __init__(self, percorso, timeout: float = 30.0):
+        self.percorso = str(percorso)
+        # Transazioni gestite esplicitamente (vedi _transazione)
+        self._db = sqlite3.connect(self.percorso, timeout=timeout, isolation_level=None)
+        self._db.executescript(_SCHEMA_ALLOCATORE)
+
+    def chiudi(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+        return False
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM incassi_generati").fetchone()[0]
+
+    @contextmanager
+    def _transazione(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+
+    def nuovo_message_id(self, id_flusso: str, adesso: datetime = None) -> str:
+        """MsgId ``{id_flusso}{timestamp}`` mai assegnato prima per ``id_flusso``.
+
+        Il timestamp è l'ora corrente o, se è già stato assegnato, il secondo
+        successivo all'ultimo: resta nel formato di genera_message_id ed è
+        monotono. Essendo a lunghezza fissa, MsgId di ID flusso diversi non
+        possono coincidere.
+        """
+        adesso = (adesso or datetime.now()).replace(microsecond=0)
+        with self._transazione():
+            riga = self._db.execute("SELECT ultimo FROM message_id WHERE id_flusso = ?", (id_flusso,)).fetchone()
+            if riga is not None:
+                adesso = max(adesso, datetime.strptime(riga[0], FORMATO_TIMESTAMP_MSG_ID) + timedelta(seconds=1))
+            ultimo = adesso.strftime(FORMATO_TIMESTAMP_MSG_ID)
+            self._db.execute("INSERT INTO message_id VALUES (?, ?) "
+                             "ON CONFLICT (id_flusso) DO UPDATE SET ultimo = excluded.ultimo", (id_flusso, ultimo))
+        return f"{id_flusso}{ultimo}"
+
+    def prenota_incassi(self, impronte: np.ndarray, msg_id: str, data_addebito: str,
+                        ammetti_duplicati: bool = False) -> pd.DataFrame:
+        """Controlla in blocco se gli incassi ``impronte`` sono già stati generati e li registra.
+
+        Se nessuno è già registrato (o con ``ammetti_duplicati``) le impronte
+        nuove sono registrate per ``msg_id`` nella stessa transazione del
+        controllo, così due generazioni concorrenti dello stesso file non
+        passano entrambe. Restituisce i duplicati: ``posizione`` nel lotto,
+        ``msg_id`` e ``data_addebito`` del flusso che li contiene già.
+        """
+        registrato = datetime.now().isoformat(timespec="seconds")
+        with self._transazione():
+            self._db.execute("CREATE TEMP TABLE IF NOT EXISTS richiesta_impronte "
+                             "(posizione INTEGER PRIMARY KEY, impronta INTEGER NOT NULL)")
+            self._db.execute("DELETE FROM temp.richiesta_impronte")
+            self._db.executemany("INSERT INTO temp.richiesta_impronte VALUES (?, ?)",
+                                 enumerate(np.asarray(impronte).tolist()))
+            duplicati = pd.read_sql_query(
+                "SELECT r.posizione, g.msg_id, g.data_addebito FROM temp.richiesta_impronte r "
+                "JOIN incassi_generati g ON g.impronta = r.impronta ORDER BY r.posizione", self._db)
+            if ammetti_duplicati or not len(duplicati):
+                self._db.execute("INSERT OR IGNORE INTO incassi_generati "
+                                 "SELECT impronta, ?, ?, ? FROM temp.richiesta_impronte",
+                                 (msg_id, data_addebito, registrato))
+            self._db.execute("DELETE FROM temp.richiesta_impronte")
+        return duplicati
+
+    def annulla(self, msg_id: str) -> int:
+        """Dimentica gli incassi registrati per ``msg_id`` (flusso non generato)."""
+        with self._transazione():
+            return self._db.execute("DELETE FROM incassi_generati WHERE msg_id = ?", (msg_id,)).rowcount
+
+
+def report_duplicati(lotto: LottoIncassi, duplicati: pd.DataFrame, gravita: str = "errore") -> pd.DataFrame:
+    """Righe del report di validazione per gli incassi già generati (vedi prenota_incassi)."""
+    posizioni = duplicati["posizione"].tolist()
+    return pd.DataFrame({
+        "riga": pd.NA,
+        "campo": "iban",
+        "valore": [lotto.iban[i] for i in posizioni],
+        "errore": ("Incasso già generato nel flusso " + duplicati["msg_id"] + " con addebito "
+                   + duplicati["data_addebito"] + " (stessi IBAN, importo, causale e data di addebito)").tolist(),
+        "gravita": gravita,
+    }, columns=COLONNE_REPORT_VALIDAZIONE)
+
+
+# ---------------- ANTEPRIMA ----------------
+
+_INIZIO_TRANSAZIONE = re.compile(re.escape(b"<DrctDbtTxInf>"))
+_FINE_TRANSAZIONE = b"</DrctDbtTxInf>"
+
+
+class IndiceTransazioni:
+    """Indice degli offset in byte dei DrctDbtTxInf di un XML generato.
+
+    Permette di mostrare l'XML a pagine di transazioni decodificando solo i
+    byte richiesti. ``dati`` è qualsiasi oggetto bytes-like (bytes, mmap...).
+    """
+
+    def __init__(self, dati):
+        self.dati = dati
+        self.inizi = array("q", (m.start() for m in _INIZIO_TRANSAZIONE.finditer(dati)))
+        if self.inizi:
+            # Tutte le transazioni hanno lo stesso rientro: si parte dall'inizio della riga
+            rientro = self.inizi[0] - dati.rfind(b"\n", 0, self.inizi[0]) - 1
+            if rientro:
+                self.inizi = array("q", (inizio - rientro for inizio in self.inizi))
+        self.fine = dati.rfind(_FINE_TRANSAZIONE) + len(_FINE_TRANSAZIONE) if self.inizi else 0
+
+    @classmethod
+    def da_file(cls, percorso) -> "IndiceTransazioni":
+        """Indicizza un file XML su disco mappandolo in memoria (senza leggerlo tutto)."""
+        with open(percorso, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.inizi)
+
+    @property
+    def dimensione(self) -> int:
+        return len(self.dati)
+
+    def numero_pagine(self, per_pagina: int) -> int:
+        return max(1, -(-len(self) // per_pagina))
+
+    def _testo(self, inizio: int, fine: int) -> str:
+        return bytes(self.dati[inizio:fine]).decode("utf-8")
+
+    def intestazione(self) -> str:
+        """XML prima della prima transazione (testate del flusso e della prima sottodistinta)."""
+        return self._testo(0, self.inizi[0] if self.inizi else len(self.dati))
+
+    def coda(self) -> str:
+        """XML dopo l'ultima transazione."""
+        return self._testo(self.fine, len(self.dati)) if self.inizi else ""
+
+    def pagina(self, numero: int, per_pagina: int) -> str:
+        """XML delle transazioni della pagina ``numero`` (da 1), con le eventuali
+        testate delle sottodistinte comprese tra di esse."""
+        primo = (numero - 1) * per_pagina
+        if not 0 <= primo < len(self):
+            return ""
+        ultimo = min(primo + per_pagina, len(self))
+        fine = self.inizi[ultimo] if ultimo < len(self) else self.fine
+        testo = self._testo(self.inizi[primo], fine)
+        return testo[:testo.rfind(_FINE_TRANSAZIONE.decode()) + len(_FINE_TRANSAZIONE)]
+
+
+# ---------------- VERIFICA FLUSSI GENERATI ----------------
+
+COLONNE_REPORT_VERIFICA = ["messaggio", "transazione", "campo", "valore", "errore", "gravita"]
+# Max35Text degli identificativi e Max70Text delle righe di indirizzo
+ID_MAX = 35
+ADR_LINE_MAX = 70
+SEQ_TP_AMMESSI = ("FRST", "RCUR", "FNAL", "OOFF")
+BLOCCO_VERIFICA = 16 * 1024 * 1024
+
+# DrctDbtTxInf come lo scrive corpo_transazione, a meno di spazi e a capo tra i tag.
+# Le transazioni scritte diversamente (altri elementi, altro ordine, tag vuoti)
+# passano da ElementTree: più lento, ma indipendente dalla formattazione.
+_RE_TRANSAZIONE = re.compile(
+    rb"<DrctDbtTxInf>\s*<PmtId>\s*<InstrId>([^<]*)</InstrId>\s*<EndToEndId>([^<]*)</EndToEndId>\s*</PmtId>"
+    rb'\s*<InstdAmt Ccy="([^"]*)">([^<]*)</InstdAmt>'
+    rb"\s*<DrctDbtTx>\s*<MndtRltdInf>\s*<MndtId>([^<]*)</MndtId>\s*<DtOfSgntr>([^<]*)</DtOfSgntr>"
+    rb"\s*</MndtRltdInf>\s*</DrctDbtTx>"
+    rb"\s*<Dbtr>\s*<Nm>([^<]*)</Nm>\s*<Id>\s*<OrgId>\s*<Othr>\s*<Id>([^<]*)</Id>\s*<Issr>([^<]*)</Issr>"
+    rb"\s*</Othr>\s*</OrgId>\s*</Id>\s*</Dbtr>"
+    rb"\s*<DbtrAcct>\s*<Id>\s*<IBAN>([^<]*)</IBAN>\s*</Id>\s*</DbtrAcct>"
+    rb"\s*<RmtInf>\s*<Ustrd>([^<]*)</Ustrd>\s*</RmtInf>\s*</DrctDbtTxInf>"
+)
+# Campi catturati da _RE_TRANSAZIONE, con il percorso usato nel report ("@Ccy" è l'attributo di InstdAmt)
+_CAMPI_TRANSAZIONE = [
+    "PmtId/InstrId", "PmtId/EndToEndId", "InstdAmt/@Ccy", "InstdAmt",
+    "DrctDbtTx/MndtRltdInf/MndtId", "DrctDbtTx/MndtRltdInf/DtOfSgntr",
+    "Dbtr/Nm", "Dbtr/Id/OrgId/Othr/Id", "Dbtr/Id/OrgId/Othr/Issr", "DbtrAcct/Id/IBAN", "RmtInf/Ustrd",
+]
+# Campi di testo delle transazioni: lunghezza massima e controllo del set SEPA
+_LIMITI_TRANSAZIONE = {
+    "PmtId/InstrId": (ID_MAX, True),
+    "PmtId/EndToEndId": (ID_MAX, True),
+    "DrctDbtTx/MndtRltdInf/MndtId": (ID_MAX, True),
+    "Dbtr/Nm": (NM_MAX, True),
+    "Dbtr/Id/OrgId/Othr/Id": (ID_MAX, True),
+    "Dbtr/Id/OrgId/Othr/Issr": (ID_MAX, False),
+    "RmtInf/Ustrd": (USTRD_MAX, True),
+}
+_IDENTIFICATIVI_UNIVOCI = ("PmtId/InstrId", "PmtId/EndToEndId")
+
+_INIZIO_TRANSAZIONE_BYTE = b"<DrctDbtTxInf>"
+_RE_SPAN_TRANSAZIONE = re.compile(rb"<DrctDbtTxInf>.*?</DrctDbtTxInf>", re.DOTALL)
+# Intestazioni: PhyMsgInf e GrpHdr interi, di PmtInf la parte prima delle transazioni
+_RE_INTESTAZIONI = [
+    (re.compile(rb"<PhyMsgInf[\s>].*?</PhyMsgInf>", re.DOTALL), "PhyMsgInf"),
+    (re.compile(rb"<GrpHdr[\s>].*?</GrpHdr>", re.DOTALL), "GrpHdr"),
+    (re.compile(rb"<PmtInf[\s>].*?(?=<DrctDbtTxInf>|</PmtInf>)", re.DOTALL), "PmtInf"),
+]
+_RE_FUORI_SET_SEPA = re.compile(r"[^A-Za-z0-9/\-?:().,'+ \x00]")
+_RE_IMPORTI_CANONICI = re.compile(rb"(?:[0-9]{1,9}\.[0-9]{2}\n)*")
+_RE_IMPORTO_XML = re.compile(r"([0-9]{1,9})(?:\.([0-9]{1,2}))?")
+_RE_DATA_ISO = re.compile(r"[0-9]{4}-[0-9]{2}-[0-9]{2}")
+_RE_CTRL_SUM = re.compile(r"([0-9]{1,16})(?:\.([0-9]{1,2}))?")
+# Moltiplicatori (dispari, fissi: le impronte devono coincidere tra processi) dell'impronta degli identificativi
+_PESI_IMPRONTA = np.random.default_rng(13616).integers(1, 2 ** 63, size=256, dtype=np.uint64) | np.uint64(1)
+
+
+def _testi(valori) -> tuple:
+    """Decodifica una colonna di valori (byte UTF-8 con entità XML): (testi, testo unito da NUL)."""
+    unito = b"\x00".join(valori).decode("utf-8", errors="replace")
+    if "&" in unito:
+        unito = html.unescape(unito)
+    return (unito.split("\x00") if len(valori) else []), unito
+
+
+def _problemi_testo(valori, campo: str, massimo: int, set_sepa: bool, problemi: list):
+    """Campi vuoti, troppo lunghi o fuori dal set SEPA in una colonna di una transazione."""
+    testi, unito = _testi(valori)
+    lunghezze = np.fromiter(map(len, testi), dtype=np.int64, count=len(testi))
+    for i in np.flatnonzero(lunghezze == 0).tolist():
+        problemi.append((i, campo, "", "campo vuoto o mancante", "errore"))
+    for i in np.flatnonzero(lunghezze > massimo).tolist():
+        problemi.append((i, campo, testi[i], f"{lunghezze[i]} caratteri oltre il limite di {massimo}", "errore"))
+    if set_sepa and _RE_FUORI_SET_SEPA.search(unito):
+        for i, testo in enumerate(testi):
+            if _RE_FUORI_SET_SEPA.search(testo):
+                problemi.append((i, campo, testo, "caratteri fuori dal set SEPA", "avviso"))
+
+
+def _problemi_valore(testo, massimo: int, set_sepa: bool = True) -> list:
+    """Come _problemi_testo per un singolo campo di intestazione: lista di (errore, gravita)."""
+    if not testo:
+        return [("campo vuoto o mancante", "errore")]
+    problemi = []
+    if len(testo) > massimo:
+        problemi.append((f"{len(testo)} caratteri oltre il limite di {massimo}", "errore"))
+    if set_sepa and _RE_FUORI_SET_SEPA.search(testo):
+        problemi.append(("caratteri fuori dal set SEPA", "avviso"))
+    return problemi
+
+
+def _centesimi_verifica(valori, campo: str, problemi: list) -> np.ndarray:
+    """Importi di una colonna in centesimi; quelli non validi valgono 0 e finiscono nei problemi."""
+    if not len(valori):
+        return np.zeros(0, dtype=np.int64)
+    unito = b"\n".join(valori) + b"\n"
+    if _RE_IMPORTI_CANONICI.fullmatch(unito):
+        centesimi = np.array(unito[:-1].replace(b".", b"").split(b"\n")).astype(np.int64)
+    else:
+        centesimi = np.zeros(len(valori), dtype=np.int64)
+        for i, testo in enumerate(_testi(valori)[0]):
+            m = _RE_IMPORTO_XML.fullmatch(testo)
+            if m is None:
+                problemi.append((i, campo, testo, "importo non valido (massimo 9 cifre intere e 2 decimali)",
+                                 "errore"))
+            else:
+                centesimi[i] = int(m.group(1)) * 100 + int((m.group(2) or "").ljust(2, "0"))
+                if centesimi[i] == 0:
+                    problemi.append((i, campo, testo, "importo nullo", "errore"))
+        return centesimi
+    for i in np.flatnonzero(centesimi == 0).tolist():
+        problemi.append((i, campo, valori[i].decode(), "importo nullo", "errore"))
+    return centesimi
+
+
+def _data_iso(testo: str) -> int:
+    """Data YYYY-MM-DD come intero YYYYMMDD (0 se non valida)."""
+    if _RE_DATA_ISO.fullmatch(testo):
+        try:
+            datetime.fromisoformat(testo)
+        except ValueError:
+            return 0
+        return int(testo.replace("-", ""))
+    return 0
+
+
+def _date_verifica(valori, campo: str, problemi: list) -> np.ndarray:
+    """Date di una colonna come interi YYYYMMDD; quelle non valide valgono 0 e finiscono nei problemi."""
+    if not len(valori):
+        return np.zeros(0, dtype=np.int64)
+    # Le date distinte sono poche: ognuna è interpretata una sola volta
+    distinte, posizioni = np.unique(np.array(valori, dtype="S16"), return_inverse=True)
+    date = np.array([_data_iso(v.decode("utf-8", errors="replace")) for v in distinte], dtype=np.int64)[posizioni]
+    for i in np.flatnonzero(date == 0).tolist():
+        problemi.append((i, campo, valori[i].decode("utf-8", errors="replace"),
+                         "data non valida (attesa YYYY-MM-DD)", "errore"))
+    return date
+
+
+def _errori_iban(iban: pd.Series) -> pd.Series:
+    """Motivo per cui ogni IBAN non è valido (formato, paese SEPA, lunghezza, mod-97); vuoto se valido."""
+    iban = iban.astype(str)
+    formato = iban.str.fullmatch(_RE_IBAN).fillna(False).astype(bool)
+    paese = iban.str[:2]
+    lunghezza_attesa = paese.map(LUNGHEZZE_IBAN)
+    errori = pd.Series("", index=iban.index, dtype=object)
+    errori[~formato] = "formato IBAN non valido"
+    errori[formato & lunghezza_attesa.isna()] = "paese IBAN " + paese + " fuori dall'area SEPA"
+    lunghezza_errata = formato & lunghezza_attesa.notna() & (iban.str.len() != lunghezza_attesa)
+    errori[lunghezza_errata] = "lunghezza IBAN errata per " + paese
+    ben_formati = errori == ""
+    if ben_formati.any():
+        check = iban_check_validi(iban[ben_formati])
+        errori[check.index[~check]] = "cifre di controllo IBAN errate"
+    return errori
+
+
+def _impronte_identificativi(valori) -> np.ndarray:
+    """Impronte a 64 bit degli identificativi, per controllarne l'unicità senza conservarli."""
+    if not len(valori):
+        return np.zeros(0, dtype=np.uint64)
+    matrice = np.array(valori, dtype=f"S{min(max(map(len, valori)) or 1, len(_PESI_IMPRONTA))}")
+    larghezza = matrice.dtype.itemsize
+    codici = matrice.view(np.uint8).reshape(len(valori), larghezza).astype(np.uint64)
+    return (codici * _PESI_IMPRONTA[:larghezza]).sum(axis=1, dtype=np.uint64)
+
+
+def _campi_xml(elemento, percorso: str = "", campi: dict = None) -> dict:
+    """Testo degli elementi foglia per percorso relativo (nomi senza namespace), primo per percorso."""
+    campi = {} if campi is None else campi
+    for figlio in elemento:
+        nome = figlio.tag.rpartition("}")[2]
+        percorso_figlio = f"{percorso}/{nome}" if percorso else nome
+        if len(figlio):
+            _campi_xml(figlio, percorso_figlio, campi)
+        else:
+            campi.setdefault(percorso_figlio, figlio.text or "")
+        for attributo, valore in figlio.attrib.items():
+            campi.setdefault(f"{percorso_figlio}/@{attributo}", valore)
+    return campi
+
+
+def _campi_intestazione(testo: bytes, tipo: str) -> dict:
+    try:
+        elemento = ET.fromstring(testo + b"</PmtInf>" if tipo == "PmtInf" else testo)
+    except ET.ParseError as e:
+        return {"": f"{tipo} non leggibile: {e}"}
+    return _campi_xml(elemento)
+
+
+def _transazione_generica(testo: bytes) -> tuple:
+    """Campi di un DrctDbtTxInf non canonico letti con ElementTree (vuoti se mancanti)."""
+    campi = _campi_xml(ET.fromstring(testo))
+    return tuple(campi.get(campo, "").encode("utf-8") for campo in _CAMPI_TRANSAZIONE)
+
+
+def _colonne_transazioni(blocco: bytes, problemi: list) -> list:
+    """Valori (byte) dei campi di _CAMPI_TRANSAZIONE per ogni DrctDbtTxInf del blocco, per colonna."""
+    righe = _RE_TRANSAZIONE.findall(blocco)
+    aperte = blocco.count(_INIZIO_TRANSAZIONE_BYTE)
+    if len(righe) != aperte or blocco.count(_FINE_TRANSAZIONE) != aperte:
+        righe = []
+        for i, m in enumerate(_RE_SPAN_TRANSAZIONE.finditer(blocco)):
+            canonica = _RE_TRANSAZIONE.fullmatch(m.group())
+            if canonica is not None:
+                righe.append(canonica.groups())
+                continue
+            try:
+                righe.append(_transazione_generica(m.group()))
+            except ET.ParseError as e:
+                problemi.append((i, "DrctDbtTxInf", "", f"transazione non leggibile: {e}", "errore"))
+                righe.append((b"",) * len(_CAMPI_TRANSAZIONE))
+        if len(righe) != aperte:
+            problemi.append((len(righe), "DrctDbtTxInf", "", "transazione non chiusa", "errore"))
+    if not righe:
+        return [[] for _ in _CAMPI_TRANSAZIONE]
+    return [list(colonna) for colonna in zip(*righe)]
+
+
+class _VerificaBlocco(NamedTuple):
+    """Esito della verifica di un blocco di file; le posizioni sono relative al blocco."""
+    intestazioni: list
+    transazioni: int
+    centesimi: np.ndarray
+    date_firma: np.ndarray
+    impronte: dict
+    problemi: list
+
+
+def _verifica_blocco(blocco: bytes) -> _VerificaBlocco:
+    """Verifica le transazioni di un blocco di file (eseguita anche nei processi del pool).
+
+    ``intestazioni`` sono tuple (transazioni che le precedono nel blocco, tipo,
+    campi); ``problemi`` tuple (transazione nel blocco o None, campo, valore,
+    errore, gravita).
+    """
+    intestazioni = []
+    for espressione, tipo in _RE_INTESTAZIONI:
+        for m in espressione.finditer(blocco):
+            intestazioni.append((m.start(), blocco.count(_INIZIO_TRANSAZIONE_BYTE, 0, m.start()), tipo,
+                                 _campi_intestazione(m.group(), tipo)))
+    intestazioni.sort(key=lambda intestazione: intestazione[0])
+
+    problemi = []
+    colonne = dict(zip(_CAMPI_TRANSAZIONE, _colonne_transazioni(blocco, problemi)))
+    for campo, (massimo, set_sepa) in _LIMITI_TRANSAZIONE.items():
+        _problemi_testo(colonne[campo], campo, massimo, set_sepa, problemi)
+    for i, valuta in enumerate(colonne["InstdAmt/@Ccy"]):
+        if valuta != b"EUR":
+            problemi.append((i, "InstdAmt/@Ccy", valuta.decode("utf-8", errors="replace"), "valuta diversa da EUR",
+                             "errore"))
+    centesimi = _centesimi_verifica(colonne["InstdAmt"], "InstdAmt", problemi)
+    date_firma = _date_verifica(colonne["DrctDbtTx/MndtRltdInf/DtOfSgntr"], "DrctDbtTx/MndtRltdInf/DtOfSgntr",
+                                problemi)
+    iban = pd.Series(_testi(colonne["DbtrAcct/Id/IBAN"])[0], dtype=object)
+    errori = _errori_iban(iban)
+    for i in np.flatnonzero((errori != "").to_numpy()).tolist():
+        problemi.append((i, "DbtrAcct/Id/IBAN", iban[i], errori[i], "errore"))
+
+    return _VerificaBlocco(
+        [(posizione, tipo, campi) for _, posizione, tipo, campi in intestazioni],
+        len(centesimi), centesimi, date_firma,
+        {campo: _impronte_identificativi(colonne[campo]) for campo in _IDENTIFICATIVI_UNIVOCI},
+        problemi,
+    )
+
+
+class EsitoVerifica(NamedTuple):
+    """Risultato di verifica_flusso: totali ricalcolati e report dei problemi."""
+    messaggi: int
+    nb_of_txs: int
+    ctrl_sum_centesimi: int
+    report: pd.DataFrame
+    xsd: bool
+
+    @property
+    def errori(self) -> int:
+        return int((self.report["gravita"] == "errore").sum())
+
+    @property
+    def avvisi(self) -> int:
+        return len(self.report) - self.errori
+
+    @property
+    def valido(self) -> bool:
+        return self.errori == 0
+
+
+class _VerificaInCorso:
+    """Stato della verifica di un file: messaggio logico e sottodistinta correnti, totali e problemi."""
+
+    def __init__(self):
+        self.problemi = []
+        self.transazioni = 0
+        self.ctrl_sum = 0
+        self.messaggi = []
+        self.inizi_messaggi = []
+        self.data_addebito = 0
+        self.nb_of_log_msg = None
+        self.msg_id = set()
+        self.pmt_inf_id = set()
+        self.impronte = {campo: [] for campo in _IDENTIFICATIVI_UNIVOCI}
+        self.parser = expat.ParserCreate()
+
+    def problema(self, campo: str, valore, errore: str, gravita: str = "errore", transazione=None):
+        self.problemi.append((len(self.messaggi) or None, transazione, campo, valore, errore, gravita))
+
+    def controlla_xml(self, dati: bytes):
+        """Controlla che il file sia XML ben formato (expat, senza costruire elementi)."""
+        if self.parser is None:
+            return
+        try:
+            self.parser.Parse(dati, not dati)
+        except expat.ExpatError as e:
+            self.problema("XML", "", f"XML non ben formato: {e}")
+            self.parser = None
+
+    def _campi_testo(self, campi: dict, limiti: dict):
+        for campo, (massimo, set_sepa, obbligatorio) in limiti.items():
+            if campo in campi or obbligatorio:
+                for errore, gravita in _problemi_valore(campi.get(campo, ""), massimo, set_sepa):
+                    self.problema(campo, campi.get(campo, ""), errore, gravita)
+
+    def _chiudi_messaggio(self):
+        if not self.messaggi:
+            return
+        messaggio = self.messaggi[-1]
+        if messaggio["nb_of_txs"] is not None and messaggio["nb_of_txs"] != messaggio["transazioni"]:
+            self.problema("GrpHdr/NbOfTxs", str(messaggio["nb_of_txs"]),
+                          f"dichiarate {messaggio['nb_of_txs']} transazioni, presenti {messaggio['transazioni']}")
+        if messaggio["ctrl_sum"] is not None and messaggio["ctrl_sum"] != messaggio["centesimi"]:
+            self.problema("GrpHdr/CtrlSum", formatta_centesimi(messaggio["ctrl_sum"]),
+                          f"CtrlSum dichiarato {formatta_centesimi(messaggio['ctrl_sum'])}, somma degli importi "
+                          f"{formatta_centesimi(messaggio['centesimi'])}")
+
+    def _intestazione(self, tipo: str, campi: dict):
+        if "" in campi:
+            self.problema(tipo, "", campi[""])
+            return
+        if tipo == "PhyMsgInf":
+            numero = campi.get("NbOfLogMsg", "")
+            self.nb_of_log_msg = int(numero) if numero.isdigit() else None
+            if self.nb_of_log_msg is None:
+                self.problema("PhyMsgInf/NbOfLogMsg", numero, "numero di messaggi logici non valido")
+        elif tipo == "GrpHdr":
+            self._chiudi_messaggio()
+            self.messaggi.append({"nb_of_txs": None, "ctrl_sum": None, "transazioni": 0, "centesimi": 0})
+            self.inizi_messaggi.append(self.transazioni)
+            messaggio = self.messaggi[-1]
+            self._campi_testo(campi, {"MsgId": (ID_MAX, True, True), "InitgPty/Nm": (NM_MAX, True, True),
+                                      "InitgPty/Id/OrgId/Othr/Id": (ID_MAX, True, False)})
+            msg_id = campi.get("MsgId", "")
+            if msg_id in self.msg_id:
+                self.problema("GrpHdr/MsgId", msg_id, "MsgId ripetuto in più messaggi logici")
+            self.msg_id.add(msg_id)
+            numero = campi.get("NbOfTxs", "")
+            if numero.isdigit():
+                messaggio["nb_of_txs"] = int(numero)
+            else:
+                self.problema("GrpHdr/NbOfTxs", numero, "NbOfTxs non valido")
+            m = _RE_CTRL_SUM.fullmatch(campi.get("CtrlSum", ""))
+            if m is not None:
+                messaggio["ctrl_sum"] = int(m.group(1)) * 100 + int((m.group(2) or "").ljust(2, "0"))
+            else:
+                self.problema("GrpHdr/CtrlSum", campi.get("CtrlSum", ""), "CtrlSum non valido")
+        else:
+            if not self.messaggi:
+                self.problema("PmtInf", "", "PmtInf fuori da un messaggio logico")
+            self._campi_testo(campi, {"PmtInfId": (ID_MAX, True, True), "Cdtr/Nm": (NM_MAX, True, True),
+                                      "Cdtr/PstlAdr/AdrLine": (ADR_LINE_MAX, True, False),
+                                      "CdtrSchmeId/Id/PrvtId/Othr/Id": (ID_MAX, True, True)})
+            pmt_inf_id = campi.get("PmtInfId", "")
+            if pmt_inf_id in self.pmt_inf_id:
+                self.problema("PmtInf/PmtInfId", pmt_inf_id, "PmtInfId ripetuto")
+            self.pmt_inf_id.add(pmt_inf_id)
+            if campi.get("PmtMtd") != "DD":
+                self.problema("PmtInf/PmtMtd", campi.get("PmtMtd", ""), "PmtMtd diverso da DD")
+            seq_tp = campi.get("PmtTpInf/SeqTp", "")
+            if seq_tp not in SEQ_TP_AMMESSI:
+                self.problema("PmtTpInf/SeqTp", seq_tp, f"SeqTp non valido (ammessi: {', '.join(SEQ_TP_AMMESSI)})")
+            self.data_addebito = _data_iso(campi.get("ReqdColltnDt", ""))
+            if not self.data_addebito:
+                self.problema("ReqdColltnDt", campi.get("ReqdColltnDt", ""), "data non valida (attesa YYYY-MM-DD)")
+            iban = campi.get("CdtrAcct/Id/IBAN", "")
+            errore = _errori_iban(pd.Series([iban], dtype=object))[0]
+            if errore:
+                self.problema("CdtrAcct/Id/IBAN", iban, errore)
+            mmb_id = campi.get("CdtrAgt/FinInstnId/ClrSysMmbId/MmbId", "")
+            if not (len(mmb_id) == 5 and mmb_id.isdigit()):
+                self.problema("CdtrAgt/FinInstnId/ClrSysMmbId/MmbId", mmb_id, "codice ABI non valido (5 cifre)")
+
+    def _transazioni(self, esito: _VerificaBlocco, inizio: int, fine: int):
+        if fine <= inizio:
+            return
+        if not self.messaggi:
+            self.problema("DrctDbtTxInf", "", "transazioni fuori da un messaggio logico")
+            return
+        messaggio = self.messaggi[-1]
+        messaggio["transazioni"] += fine - inizio
+        messaggio["centesimi"] += int(esito.centesimi[inizio:fine].sum())
+        if self.data_addebito:
+            date = esito.date_firma[inizio:fine]
+            for i in np.flatnonzero(date > self.data_addebito).tolist():
+                self.problema("DrctDbtTx/MndtRltdInf/DtOfSgntr", str(date[i]),
+                              "data di firma del mandato successiva alla data di addebito",
+                              transazione=self.transazioni + inizio + i + 1)
+
+    def aggiungi(self, esito: _VerificaBlocco):
+        """Incorpora l'esito di un blocco, nell'ordine del file."""
+        inizio = 0
+        for posizione, tipo, campi in esito.intestazioni:
+            self._transazioni(esito, inizio, posizione)
+            self._intestazione(tipo, campi)
+            inizio = posizione
+        self._transazioni(esito, inizio, esito.transazioni)
+        for i, campo, valore, errore, gravita in esito.problemi:
+            self.problemi.append((None, self.transazioni + i + 1, campo, valore, errore, gravita))
+        for campo, impronte in esito.impronte.items():
+            self.impronte[campo].append(impronte)
+        self.ctrl_sum += int(esito.centesimi.sum())
+        self.transazioni += esito.transazioni
+
+    def chiudi(self, xsd: bool) -> EsitoVerifica:
+        self._chiudi_messaggio()
+        if self.nb_of_log_msg is None and not any(p[2] == "PhyMsgInf/NbOfLogMsg" for p in self.problemi):
+            self.problema("PhyMsgInf", "", "PhyMsgInf mancante")
+        elif self.nb_of_log_msg is not None and self.nb_of_log_msg != len(self.messaggi):
+            self.problema("PhyMsgInf/NbOfLogMsg", str(self.nb_of_log_msg),
+                          f"dichiarati {self.nb_of_log_msg} messaggi logici, presenti {len(self.messaggi)}")
+        for campo, parti in self.impronte.items():
+            impronte = np.concatenate(parti) if parti else np.zeros(0, dtype=np.uint64)
+            ordine = np.argsort(impronte, kind="stable")
+            ordinate = impronte[ordine]
+            for k in np.flatnonzero(ordinate[1:] == ordinate[:-1]).tolist():
+                self.problemi.append((None, int(ordine[k + 1]) + 1, campo, "",
+                                      f"{campo.rpartition('/')[2]} uguale a quello della transazione "
+                                      f"{int(ordine[k]) + 1}", "errore"))
+
+        report = pd.DataFrame(self.problemi, columns=COLONNE_REPORT_VERIFICA)
+        transazioni = report["transazione"].notna()
+        if transazioni.any() and self.inizi_messaggi:
+            # Messaggio logico di ogni transazione segnalata dai blocchi
+            numeri = np.searchsorted(self.inizi_messaggi, report.loc[transazioni, "transazione"].to_numpy() - 1,
+                                     side="right")
+            report.loc[transazioni, "messaggio"] = numeri
+        report["messaggio"] = report["messaggio"].astype("Int64")
+        report["transazione"] = report["transazione"].astype("Int64")
+        report = report.sort_values(["messaggio", "transazione"], na_position="first", kind="stable")
+        return EsitoVerifica(len(self.messaggi), self.transazioni, self.ctrl_sum, report.reset_index(drop=True), xsd)
+
+
+def _blocchi_verifica(f, dimensione_blocco: int, controlla_xml):
+    """Blocchi del file che terminano dopo un </DrctDbtTxInf> (l'ultimo con il resto del file)."""
+    resto = b""
+    while True:
+        dati = f.read(dimensione_blocco)
+        controlla_xml(dati)
+        if not dati:
+            if resto:
+                yield resto
+            return
+        dati = resto + dati
+        taglio = dati.rfind(_FINE_TRANSAZIONE)
+        if taglio < 0:
+            resto = dati
+            continue
+        taglio += len(_FINE_TRANSAZIONE)
+        resto = dati[taglio:]
+        yield dati[:taglio]
+
+
+def _in_ordine(funzione, elementi, processi: int):
+    """``funzione`` applicata agli ``elementi`` con ``processi`` processi, nell'ordine e con pochi elementi in volo."""
+    if processi <= 1:
+        yield from map(funzione, elementi)
+        return
+    with ProcessPoolExecutor(max_workers=processi) as pool:
+        in_corso = deque()
+        for elemento in elementi:
+            in_corso.append(pool.submit(funzione, elemento))
+            if len(in_corso) >= 2 * processi:
+                yield in_corso.popleft().result()
+        while in_corso:
+            yield in_corso.popleft().result()
+
+
+def _apri_flusso(sorgente):
+    """File binario del flusso: percorso (anche .gz), FileGenerato o file già aperto, riportato all'inizio."""
+    if isinstance(sorgente, FileGenerato):
+        return sorgente.apri()
+    if hasattr(sorgente, "read"):
+        if hasattr(sorgente, "seekable") and sorgente.seekable():
+            sorgente.seek(0)
+        return nullcontext(sorgente)
+    if str(sorgente).lower().endswith(".gz"):
+        return gzip.open(sorgente, "rb")
+    return open(sorgente, "rb")
+
+
+def valida_xsd(sorgente, xsd) -> list:
+    """Valida il flusso con lo schema XSD ``xsd`` (lxml, in streaming a memoria costante).
+
+    Restituisce i problemi come righe del report di verifica (al più il primo
+    errore: la validazione si ferma lì).
+    """
+    if lxml_etree is None:
+        raise ValueError("Per la validazione XSD serve il pacchetto lxml")
+    try:
+        schema = lxml_etree.XMLSchema(lxml_etree.parse(str(xsd)))
+    except (OSError, lxml_etree.XMLSchemaParseError, lxml_etree.XMLSyntaxError) as e:
+        raise ValueError(f"Schema XSD non valido ({xsd}): {e}")
+    with _apri_flusso(sorgente) as f:
+        try:
+            for _, elemento in lxml_etree.iterparse(f, events=("end",), schema=schema, huge_tree=True):
+                elemento.clear(keep_tail=True)
+                # Elimina i fratelli già letti: in memoria resta solo il ramo corrente
+                while elemento.getprevious() is not None:
+                    del elemento.getparent()[0]
+        except lxml_etree.XMLSyntaxError as e:
+            return [(None, None, "XSD", "", f"riga {e.lineno}: {e.msg}" if e.lineno else e.msg, "errore")]
+    return []
+
+
+def verifica_flusso(sorgente, xsd=None, processi: int = 1,
+                    dimensione_blocco: int = BLOCCO_VERIFICA) -> EsitoVerifica:
+    """Verifica un flusso XML CBI già scritto, leggendolo a blocchi a memoria costante.
+
+    Ricalcola NbOfTxs e CtrlSum di ogni messaggio logico e NbOfLogMsg,
+    controlla l'unicità di InstrId ed EndToEndId nel file (su impronte a 64
+    bit), lunghezze e set di caratteri dei campi, IBAN, date e importi, e che
+    il file sia XML ben formato. Con ``xsd`` (percorso dello schema
+    CBIBdySDDReq, richiede lxml) il file è anche validato con lo schema.
+    ``sorgente`` è un percorso (anche .xml.gz), un FileGenerato o un file binario; con
+    ``processi`` > 1 i blocchi sono verificati in parallelo.
+    """
+    stato = _VerificaInCorso()
+    if xsd:
+        # lxml controlla anche che il file sia ben formato
+        stato.parser = None
+    with _apri_flusso(sorgente) as f:
+        blocchi = _blocchi_verifica(f, dimensione_blocco, stato.controlla_xml)
+        for esito in _in_ordine(_verifica_blocco, blocchi, processi or os.cpu_count() or 1):
+            stato.aggiungi(esito)
+    if xsd:
+        stato.problemi.extend(valida_xsd(sorgente, xsd))
+    return stato.chiudi(bool(xsd))
+
+
+def riepilogo_verifica(esito: EsitoVerifica) -> str:
+    """Riga di riepilogo di una verifica."""
+    totali = (f"{esito.messaggi} messaggi, {esito.nb_of_txs} transazioni, "
+              f"totale {formatta_centesimi(esito.ctrl_sum_centesimi)} EUR")
+    if not len(esito.report):
+        return f"{totali}: OK" + (" (XSD)" if esito.xsd else "")
+    primo = esito.report[esito.report["gravita"] == "errore"].head(1)
+    dettaglio = ""
+    if len(primo):
+        primo = primo.iloc[0]
+        dove = f"transazione {primo['transazione']}, " if not pd.isna(primo["transazione"]) else ""
+        dettaglio = f" (primo: {dove}{primo['campo']}: {primo['errore']})"
+    return f"{totali}: {esito.errori} errori, {esito.avvisi} avvisi{dettaglio}"
+
+
+# ---------------- RICONCILIAZIONE ESITI ----------------
+
+_SCHEMA_ESITI = """
+CREATE TABLE IF NOT EXISTS transazioni (
+    end_to_end_id TEXT PRIMARY KEY,
+    msg_id TEXT NOT NULL,
+    id_flusso TEXT NOT NULL,
+    data_addebito TEXT NOT NULL,
+    seq_tp TEXT NOT NULL,
+    iban TEXT NOT NULL,
+    codice_fiscale TEXT NOT NULL,
+    nome_debitore TEXT NOT NULL,
+    causale TEXT NOT NULL,
+    data_firma_mandato TEXT,
+    mandato TEXT NOT NULL,
+    importo_centesimi INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transazioni_msg_id ON transazioni (msg_id);
+CREATE TABLE IF NOT EXISTS esiti (
+    end_to_end_id TEXT PRIMARY KEY,
+    stato TEXT NOT NULL,
+    motivo TEXT,
+    importo_centesimi INTEGER,
+    data_esito TEXT,
+    file_esito TEXT NOT NULL,
+    ricevuto TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS esiti_file ON esiti (file_esito);
+"""
+
+_REGISTRA_ESITI = """
+INSERT INTO esiti
+SELECT t.end_to_end_id, r.stato, r.motivo, r.importo_centesimi, r.data_esito, :file, :ricevuto
+FROM {sorgente}
+WHERE true
+ORDER BY r.posizione
+ON CONFLICT (end_to_end_id) DO UPDATE SET
+    stato = excluded.stato,
+    motivo = excluded.motivo,
+    importo_centesimi = excluded.importo_centesimi,
+    data_esito = excluded.data_esito,
+    file_esito = excluded.file_esito,
+    ricevuto = excluded.ricevuto
+{condizione}
+"""
+
+_CONSULTA_ESITI = """
+SELECT e.end_to_end_id, t.msg_id, t.id_flusso, t.data_addebito, t.seq_tp, t.nome_debitore, t.codice_fiscale,
+       t.iban, t.mandato, t.causale, t.data_firma_mandato, t.importo_centesimi,
+       e.stato, e.motivo, e.importo_centesimi AS importo_esito_centesimi, e.data_esito, e.file_esito
+FROM esiti e JOIN transazioni t ON t.end_to_end_id = e.end_to_end_id
+WHERE e.file_esito IN ({file})
+ORDER BY e.file_esito, t.msg_id, e.end_to_end_id
+"""
+
+BLOCCO_ESITI = 50_000
+# Stati che indicano un incasso non andato a buon fine (TxSts/GrpSts, RTRN per gli storni)
+STATI_RESPINTI = ("RJCT", "RTRN")
+# Stati di gruppo (GrpSts) validi per tutte le transazioni del messaggio originale
+STATI_GRUPPO = ("RJCT", "ACCP", "ACTC", "ACSC")
+# Codici motivo ISO 20022 più frequenti negli esiti SDD
+MOTIVI_ESITO = {
+    "AC01": "IBAN errato",
+    "AC04": "conto estinto",
+    "AC06": "conto bloccato",
+    "AC13": "conto di un consumatore non ammesso (B2B)",
+    "AG01": "operazione non ammessa sul conto",
+    "AG02": "codice operazione non valido",
+    "AM04": "fondi insufficienti",
+    "AM05": "incasso duplicato",
+    "BE05": "creditore non riconosciuto",
+    "CNOR": "banca del creditore non raggiungibile",
+    "DNOR": "banca del debitore non raggiungibile",
+    "FF01": "formato del file non valido",
+    "MD01": "mandato inesistente o revocato",
+    "MD02": "dati del mandato mancanti o errati",
+    "MD06": "rimborso richiesto dal debitore",
+    "MD07": "debitore deceduto",
+    "MS02": "rifiuto del debitore",
+    "MS03": "motivo non specificato",
+    "RC01": "codice BIC errato",
+    "RR01": "dati del debitore mancanti (regolamentari)",
+    "RR02": "nome o indirizzo del debitore mancanti",
+    "RR03": "nome o indirizzo del creditore mancanti",
+    "RR04": "motivi regolamentari",
+    "SL01": "servizi specifici della banca del debitore",
+}
+# Motivi per cui ripresentare lo stesso incasso non ha senso senza nuovi dati dal debitore
+MOTIVI_NON_RIPRESENTABILI = ("AC01", "AC04", "AC13", "AG01", "AM05", "BE05", "MD01", "MD02", "MD06", "MD07",
+                             "MS02", "RR01", "RR02")
+COLONNE_REPORT_ESITI = ["end_to_end_id", "msg_id", "id_flusso", "data_addebito", "seq_tp", "nome_debitore",
+                        "codice_fiscale", "iban", "mandato", "importo", "stato", "motivo", "descrizione",
+                        "importo_esito", "data_esito", "file_esito", "ripresentabile"]
+# Elementi con l'esito di una transazione: pain.002 (TxInfAndSts), pacs.004 (TxInf), camt.054 (TxDtls)
+_ELEMENTI_ESITO = {"TxInfAndSts", "TxInf", "TxDtls"}
+
+
+class RecordEsito(NamedTuple):
+    """Esito di una transazione (``end_to_end_id``) o di un messaggio logico intero (solo ``msg_id``)."""
+    end_to_end_id: str
+    msg_id: str
+    stato: str
+    motivo: str
+    importo_centesimi: int
+    data_esito: str
+
+
+# Percorsi (relativi all'elemento di esito) dei campi nei vari formati
+_PERCORSI_END_TO_END_ID = ("OrgnlEndToEndId", "Refs/EndToEndId")
+_PERCORSI_MOTIVO = ("StsRsnInf/Rsn/Cd", "StsRsnInf/Rsn/Prtry", "RtrRsnInf/Rsn/Cd", "RtrRsnInf/Rsn/Prtry",
+                    "RtrInf/Rsn/Cd", "RtrInf/Rsn/Prtry")
+_PERCORSI_IMPORTO = ("OrgnlTxRef/Amt/InstdAmt", "RtrdInstdAmt", "RtrdIntrBkSttlmAmt", "AmtDtls/InstdAmt/Amt", "Amt")
+
+
+def _primo(campi: dict, percorsi) -> str:
+    """Primo valore non vuoto tra quelli dei ``percorsi``."""
+    for percorso in percorsi:
+        valore = campi.get(percorso)
+        if valore and valore.strip():
+            return valore.strip()
+    return ""
+
+
+def _centesimi_esito(testo: str):
+    m = _RE_IMPORTO_XML.fullmatch(testo)
+    return int(m.group(1)) * 100 + int((m.group(2) or "").ljust(2, "0")) if m else None
+
+
+def _record_esito(tipo: str, campi: dict, data_esito: str):
+    """RecordEsito di un elemento di esito, None se non riguarda un incasso riconciliabile."""
+    if tipo == "OrgnlGrpInfAndSts":
+        stato = campi.get("GrpSts", "").strip()
+        if stato not in STATI_GRUPPO:
+            # PART, PDNG...: l'esito è nelle singole transazioni
+            return None
+        return RecordEsito(None, campi.get("OrgnlMsgId", "").strip(), stato,
+                           _primo(campi, _PERCORSI_MOTIVO) or None, None, data_esito)
+    end_to_end_id = _primo(campi, _PERCORSI_END_TO_END_ID)
+    stato = campi.get("TxSts", "").strip() or \
+        ("RTRN" if any(campo.startswith(("RtrRsnInf/", "RtrInf/")) for campo in campi) else "")
+    if not end_to_end_id or not stato:
+        # Ad es. movimenti camt.054 senza storno: nulla da riconciliare
+        return None
+    importo = _primo(campi, _PERCORSI_IMPORTO)
+    return RecordEsito(end_to_end_id, campi.get("OrgnlMsgId", "").strip() or None, stato,
+                       _primo(campi, _PERCORSI_MOTIVO) or None, _centesimi_esito(importo), data_esito)
+
+
+def leggi_esiti(sorgente):
+    """Legge in streaming un flusso di esiti (pain.002, pacs.004 o camt.054, anche CBI).
+
+    Restituisce i RecordEsito nell'ordine del file, senza tenere il documento
+    in memoria: ogni elemento di esito è eliminato appena letto.
+    ``sorgente`` è un percorso (anche .gz) o un file binario.
+    """
+    data_esito = None
+    with _apri_flusso(sorgente) as f:
+        aperti = []
+        for evento, elemento in ET.iterparse(f, events=("start", "end")):
+            if evento == "start":
+                aperti.append(elemento)
+                continue
+            aperti.pop()
+            nome = elemento.tag.rpartition("}")[2]
+            if nome == "GrpHdr" and data_esito is None:
+                data_esito = _campi_xml(elemento).get("CreDtTm", "")[:10] or None
+            elif nome in _ELEMENTI_ESITO or nome == "OrgnlGrpInfAndSts":
+                record = _record_esito(nome, _campi_xml(elemento), data_esito)
+                if record is not None:
+                    yield record
+            else:
+                continue
+            # Elemento già letto: è l'ultimo figlio del genitore ancora aperto
+            if aperti:
+                del aperti[-1][-1]
+
+
+class EsitoRiconciliazione(NamedTuple):
+    """Risultato di IndiceRiconciliazione.riconcilia per un file di esiti."""
+    file_esito: str
+    record: int
+    riconciliati: int
+    sconosciuti: list
+
+
+class IndiceRiconciliazione:
+    """Indice locale (SQLite) delle transazioni generate e dei loro esiti.
+
+    Ogni flusso generato registra, per EndToEndId, MsgId del messaggio
+    logico, debitore, IBAN, mandato e importo; gli esiti restituiti dalla
+    banca sono letti in streaming e uniti all'indice in blocchi di
+    BLOCCO_ESITI record tramite una tabella temporanea e un'unica join per
+    blocco. Per ogni EndToEndId è conservato l'ultimo esito ricevuto.
+    """
+
+    def __init__(self, percorso, timeout: float = 30.0):
+        self.percorso = str(percorso)
+        self._db = sqlite3.connect(self.percorso, timeout=timeout)
+        self._db.execute("PRAGMA cache_size = -65536")
+        self._db.executescript(_SCHEMA_ESITI)
+
+    def chiudi(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *eccezione):
+        self.chiudi()
+        return False
+
+    def __len__(self):
+        return self._db.execute("SELECT count(*) FROM transazioni").fetchone()[0]
+
+    def registra_flusso(self, lotto: LottoIncassi, partizioni: list, msg_id: str, id_flusso: str,
+                        mandati: list) -> int:
+        """Registra in un'unica transazione le transazioni di un flusso generato.
+
+        ``partizioni`` e ``msg_id`` sono quelli passati a
+        scrivi_flusso_partizionato: il MsgId registrato è quello del messaggio
+        logico di ogni transazione. Restituisce il numero di transazioni
+        registrate.
+        """
+        colonne = [list(getattr(lotto, campo)) for campo in
+                   ("iban", "codice_fiscale", "nome_debitore", "causale", "data_firma_mandato")]
+        numera_msg_id = sum(len(sottodistinte) for sottodistinte in partizioni) > 1
+        righe = []
+        for sottodistinte in partizioni:
+            for s in sottodistinte:
+                msg_id_sottodistinta = f"{msg_id}-{s.numero}" if numera_msg_id else msg_id
+                for idx, i in enumerate(np.asarray(s.posizioni).tolist(), s.primo_idx):
+                    righe.append((genera_end_to_end_id(msg_id, idx), msg_id_sottodistinta, id_flusso,
+                                  s.data_addebito, s.seq_tp, *(colonna[i] for colonna in colonne), mandati[i],
+                                  lotto.importo_centesimi[i]))
+        with self._db:
+            self._db.executemany("INSERT INTO transazioni VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", righe)
+        return len(righe)
+
+    def _carica(self, tabella: str, record: list):
+        self._db.execute(f"CREATE TEMP TABLE IF NOT EXISTS {tabella} (posizione INTEGER PRIMARY KEY, "
+                         "end_to_end_id TEXT, msg_id TEXT, stato TEXT, motivo TEXT, importo_centesimi INTEGER, "
+                         "data_esito TEXT)")
+        self._db.execute(f"DELETE FROM temp.{tabella}")
+        self._db.executemany(f"INSERT INTO temp.{tabella} VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             ((i, *r) for i, r in enumerate(record)))
+
+    def riconcilia(self, record, file_esito: str) -> EsitoRiconciliazione:
+        """Registra gli esiti ``record`` (RecordEsito, vedi leggi_esiti) di un file di esiti.
+
+        Gli esiti di transazione sono uniti all'indice per EndToEndId; quelli
+        di un messaggio logico intero valgono per tutte le sue transazioni che
+        nello stesso file non hanno un esito proprio. EndToEndId e MsgId
+        non presenti nell'indice sono restituiti in ``sconosciuti``.
+        Ripetere la riconciliazione dello stesso file non cambia il risultato.
+        """
+        parametri = {"file": str(file_esito), "ricevuto": datetime.now().isoformat(timespec="seconds")}
+        totale = riconciliati = 0
+        sconosciuti, gruppi = [], []
+        record = iter(record)
+        while True:
+            blocco = list(islice(record, BLOCCO_ESITI))
+            if not blocco:
+                break
+            totale += len(blocco)
+            transazioni = [r for r in blocco if r.end_to_end_id]
+            gruppi.extend(r for r in blocco if not r.end_to_end_id)
+            with self._db:
+                self._carica("ricevuti", transazioni)
+                riconciliati += self._db.execute(_REGISTRA_ESITI.format(
+                    sorgente="temp.ricevuti r JOIN transazioni t ON t.end_to_end_id = r.end_to_end_id",
+                    condizione=""), parametri).rowcount
+                sconosciuti.extend(riga[0] for riga in self._db.execute(
+                    "SELECT r.end_to_end_id FROM temp.ricevuti r "
+                    "WHERE NOT EXISTS (SELECT 1 FROM transazioni t WHERE t.end_to_end_id = r.end_to_end_id) "
+                    "ORDER BY r.posizione"))
+        if gruppi:
+            with self._db:
+                self._carica("gruppi", gruppi)
+                riconciliati += self._db.execute(_REGISTRA_ESITI.format(
+                    sorgente="temp.gruppi r JOIN transazioni t ON t.msg_id = r.msg_id",
+                    condizione="WHERE esiti.file_esito <> excluded.file_esito"), parametri).rowcount
+                sconosciuti.extend(riga[0] for riga in self._db.execute(
+                    "SELECT r.msg_id FROM temp.gruppi r "
+                    "WHERE NOT EXISTS (SELECT 1 FROM transazioni t WHERE t.msg_id = r.msg_id) ORDER BY r.posizione"))
+        return EsitoRiconciliazione(str(file_esito), totale, riconciliati, sconosciuti)
+
+    def esiti(self, file_esito) -> pd.DataFrame:
+        """Esiti per debitore dei file ``file_esito`` (nomi passati a riconcilia), con i dati dell'indice."""
+        file_esito = [str(f) for f in file_esito]
+        if not file_esito:
+            return pd.DataFrame(columns=COLONNE_REPORT_ESITI)
+        df = pd.read_sql_query(_CONSULTA_ESITI.format(file=", ".join("?" * len(file_esito))), self._db,
+                               params=file_esito)
+        df["importo"] = formatta_centesimi_serie(df["importo_centesimi"])
+        importo_esito = df["importo_esito_centesimi"]
+        df["importo_esito"] = formatta_centesimi_serie(importo_esito.fillna(0).astype("int64")).where(
+            importo_esito.notna(), "")
+        df["descrizione"] = df["motivo"].map(MOTIVI_ESITO).fillna("")
+        df["ripresentabile"] = df["stato"].isin(STATI_RESPINTI) & ~df["motivo"].isin(MOTIVI_NON_RIPRESENTABILI)
+        return df
+
+
+def incassi_da_ripresentare(esiti: pd.DataFrame) -> pd.DataFrame:
+    """Incassi respinti ripresentabili, nel formato del file incassi (COLONNE_INCASSI).
+
+    Il file può essere ridato alla generazione: sono esclusi i motivi in
+    MOTIVI_NON_RIPRESENTABILI, per cui servono prima nuovi dati o un nuovo
+    mandato.
+    """
+    ripresentabili = esiti[esiti["ripresentabile"]].reindex(columns=COLONNE_INCASSI).reset_index(drop=True)
+    # La generazione aggiunge di nuovo il prefisso delle causali aggregate (vedi aggrega_incassi)
+    ripresentabili["causale"] = ripresentabili["causale"].str.removeprefix("Ft. ")
+    return ripresentabili
+
+
+def riepilogo_esiti(esiti: pd.DataFrame) -> str:
+    """Riga di riepilogo degli esiti per stato e dei respinti per motivo."""
+    if not len(esiti):
+        return "nessun esito riconciliato"
+    stati = esiti["stato"].value_counts()
+    testo = ", ".join(f"{stato} {numero}" for stato, numero in stati.items())
+    respinti = esiti[esiti["stato"].isin(STATI_RESPINTI)]
+    if len(respinti):
+        motivi = respinti["motivo"].fillna("?").value_counts().head(5)
+        testo += " (motivi: " + ", ".join(f"{motivo} {numero}" for motivo, numero in motivi.items()) + ")"
+        testo += f"; {int(respinti['ripresentabile'].sum())} ripresentabili"
+    return testo
+
+
+# ---------------- CONSEGNA FILE GENERATI ----------------
+
+FORMATI_COMPRESSIONE = ("zip", "gzip")
+LIVELLO_COMPRESSIONE = 6
+BLOCCO_COPIA = 1024 * 1024
+
+
+class FileGenerato:
+    """File XML generato in un file temporaneo, letto tramite mmap.
+
+    Sostituisce l'oggetto ``bytes`` con il contenuto del file: ScrittoreXml
+    ci scrive in streaming (ha ``write``) e anteprima, download e
+    compressione leggono dalla mappa in memoria, senza copie del contenuto
+    nella memoria del processo. Il file temporaneo è eliminato da ``chiudi``
+    o quando l'oggetto viene distrutto.
+    """
+
+    def __init__(self, nome: str):
+        self.nome = nome
+        self._file = tempfile.TemporaryFile(prefix="sdd_", suffix=".xml")
+        self._mappa = None
+
+    def write(self, dati: bytes) -> int:
+        if self._mappa is not None:
+            raise ValueError(f"{self.nome}: file già chiuso in scrittura")
+        return self._file.write(dati)
+
+    def flush(self):
+        self._file.flush()
+
+    def __len__(self):
+        return len(self.contenuto())
+
+    def contenuto(self) -> mmap.mmap:
+        """Contenuto in sola lettura (bytes-like, vedi IndiceTransazioni); chiude la scrittura."""
+        if self._mappa is None:
+            self._file.flush()
+            self._mappa = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mappa
+
+    def apri(self) -> mmap.mmap:
+        """Lettore indipendente (``read``/``seek``) posizionato all'inizio del file."""
+        self.contenuto()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def leggi(self) -> bytes:
+        """Copia del contenuto come bytes (per chi non accetta altro, es. il download di Streamlit)."""
+        return self.contenuto()[:]
+
+    def chiudi(self):
+        if self._mappa is not None:
+            self._mappa.close()
+        self._file.close()
+
+
+def _apri_sorgente(sorgente):
+    """Apre in lettura binaria un file da comprimere: percorso o FileGenerato."""
+    if isinstance(sorgente, FileGenerato):
+        return sorgente.apri()
+    return open(sorgente, "rb")
+
+
+def _nome_file(file) -> str:
+    """Nome di un file del flusso: percorso o FileGenerato."""
+    return file.nome if isinstance(file, FileGenerato) else str(file)
+
+
+def scrivi_zip(destinazione, file: list, livello: int = LIVELLO_COMPRESSIONE):
+    """Scrive uno ZIP con i ``file`` [(nome nell'archivio, sorgente)], copiati a blocchi.
+
+    ``destinazione`` è un percorso oppure un sink di byte; le sorgenti sono
+    percorsi o FileGenerato.
+    """
+    with zipfile.ZipFile(destinazione, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=livello) as archivio:
+        for nome, sorgente in file:
+            with _apri_sorgente(sorgente) as f, archivio.open(nome, "w", force_zip64=True) as voce:
+                shutil.copyfileobj(f, voce, BLOCCO_COPIA)
+
+
+def scrivi_gzip(destinazione, sorgente, nome: str = "", livello: int = LIVELLO_COMPRESSIONE):
+    """Scrive la ``sorgente`` (percorso o FileGenerato) compressa gzip in ``destinazione``.
+
+    ``nome`` è il nome originale registrato nell'intestazione gzip.
+    """
+    if isinstance(destinazione, (str, os.PathLike)):
+        with open(destinazione, "wb") as f:
+            return scrivi_gzip(f, sorgente, nome or Path(destinazione).stem, livello)
+    # mtime=0: lo stesso XML produce sempre lo stesso file compresso
+    with _apri_sorgente(sorgente) as f, gzip.GzipFile(nome, "wb", livello, destinazione, mtime=0) as compresso:
+        shutil.copyfileobj(f, compresso, BLOCCO_COPIA)
+
+
+def comprimi_flusso(percorsi: list, formato: str, destinazione=None) -> list:
+    """Comprime i file di un flusso ed elimina gli originali; restituisce i file compressi.
+
+    Con ``"zip"`` tutti i file (anche quelli di un flusso suddiviso) finiscono
+    in un unico archivio, di default ``destinazione`` (o il primo file) con
+    estensione ``.zip``; con ``"gzip"`` ogni file diventa ``nome.xml.gz``.
+    """
+    if formato not in FORMATI_COMPRESSIONE:
+        raise ValueError(f"Formato di compressione non supportato: {formato} "
+                         f"(ammessi: {', '.join(FORMATI_COMPRESSIONE)})")
+    percorsi = [Path(p) for p in percorsi]
+    if formato == "zip":
+        archivio = Path(destinazione or percorsi[0]).with_suffix(".zip")
+        scrivi_zip(archivio, [(p.name, p) for p in percorsi])
+        compressi = [archivio]
+    else:
+        compressi = [p.with_name(f"{p.name}.gz") for p in percorsi]
+        for percorso, compresso in zip(percorsi, compressi):
+            scrivi_gzip(compresso, percorso, percorso.name)
+    for percorso in percorsi:
+        percorso.unlink()
+    return [str(p) for p in compressi]
+
+
+# ---------------- LETTURA FILE ----------------
+
+SEPARATORI = [",", ";", "\t", "|"]
+PAROLE_CHIAVE_INCASSI = ["nome_debitore", "debitore", "codice_fiscale", "causale", "data_firma"]
+DIMENSIONE_CAMPIONE = 64 * 1024
+DIMENSIONE_BLOCCO = 100_000
+
+# BOM in ordine di verifica (quello UTF-32 LE inizia come quello UTF-16 LE)
+_BOM = [
+    (codecs.BOM_UTF32_LE, "utf-32"),
+    (codecs.BOM_UTF32_BE, "utf-32"),
+    (codecs.BOM_UTF8, "utf-8-sig"),
+    (codecs.BOM_UTF16_LE, "utf-16"),
+    (codecs.BOM_UTF16_BE, "utf-16"),
+]
+
+
+class FormatoCsv(NamedTuple):
+    """Dialetto di un file CSV rilevato dal prefisso del file."""
+    encoding: str
+    separatore: str
+    intestazioni: bool
+    bom: bool
+
+
+def rileva_encoding(campione: bytes, completo: bool = False):
+    """Rileva l'encoding dai primi byte del file: restituisce (encoding, bom).
+
+    Senza BOM, l'UTF-16 viene riconosciuto solo dalla distribuzione dei byte
+    nulli (testo ASCII); poi si prova UTF-8 stretto e infine cp1252/latin-1.
+    """
+    for bom, encoding in _BOM:
+        if campione.startswith(bom):
+            return encoding, True
+
+    if campione:
+        pari = campione[0::2].count(0)
+        dispari = campione[1::2].count(0)
+        meta = len(campione) / 2
+        if dispari > meta * 0.3 and pari < meta * 0.05:
+            return "utf-16-le", False
+        if pari > meta * 0.3 and dispari < meta * 0.05:
+            return "utf-16-be", False
+
+    try:
+        campione.decode("utf-8")
+        return "utf-8", False
+    except UnicodeDecodeError as e:
+        # Un carattere multibyte troncato dalla fine del campione non conta
+        if not completo and e.start >= len(campione) - 3 and e.reason == "unexpected end of data":
+            return "utf-8", False
+
+    try:
+        campione.decode("cp1252")
+        return "cp1252", False
+    except UnicodeDecodeError:
+        return "latin-1", False
+
+
+def rileva_separatore(testo: str) -> str:
+    """Rileva il separatore con il numero di campi più costante tra le righe."""
+    righe = [riga for riga in testo.splitlines()[:100] if riga.strip()]
+    migliore, punteggio_migliore = ",", (0, 0)
+    for sep in SEPARATORI:
+        if not any(sep in riga for riga in righe):
+            continue
+        campi = [len(r) for r in csv.reader(righe, delimiter=sep)]
+        moda = max(set(campi), key=campi.count)
+        if moda < 2:
+            continue
+        punteggio = (campi.count(moda) / len(campi), moda)
+        if punteggio > punteggio_migliore:
+            migliore, punteggio_migliore = sep, punteggio
+    return migliore
+
+
+def ha_intestazioni(prima_riga: str, parole_chiave=PAROLE_CHIAVE_INCASSI) -> bool:
+    """Indica se la prima riga contiene le intestazioni delle colonne."""
+    prima_riga = prima_riga.lower()
+    conteggio = sum(1 for parola in parole_chiave if parola in prima_riga)
+    return conteggio >= 2
+
+
+def rileva_formato_csv(file_obj, parole_chiave=PAROLE_CHIAVE_INCASSI,
+                       dimensione_campione: int = DIMENSIONE_CAMPIONE) -> FormatoCsv:
+    """Legge una sola volta un prefisso limitato del file e ne rileva BOM,
+    encoding, separatore e presenza delle intestazioni. Il file viene
+    riportato all'inizio."""
+    file_obj.seek(0)
+    campione = file_obj.read(dimensione_campione)
+    file_obj.seek(0)
+
+    completo = len(campione) < dimensione_campione
+    encoding, bom = rileva_encoding(campione, completo)
+
+    testo = campione.decode(encoding, errors="ignore")
+    if not completo and "\n" in testo:
+        # Scarta l'ultima riga, probabilmente troncata dal campione
+        testo = testo[:testo.rindex("\n")]
+    testo = testo.lstrip("\ufeff")
+
+    prima_riga = testo.split("\n", 1)[0]
+    return FormatoCsv(
+        encoding=encoding,
+        separatore=rileva_separatore(testo),
+        intestazioni=ha_intestazioni(prima_riga, parole_chiave),
+        bom=bom,
+    )
+
+
+def _leggi_csv(file_obj, formato: FormatoCsv, notifica, **kwargs) -> pd.DataFrame:
+    """Esegue il parsing con il formato rilevato.
+
+    Se l'UTF-8 del prefisso si rivela sbagliato più avanti nel file, riprova
+    una sola volta con cp1252.
+    """
+    file_obj.seek(0)
+    try:
+        return pd.read_csv(file_obj, encoding=formato.encoding, sep=formato.separatore, **kwargs)
+    except UnicodeDecodeError:
+        if formato.encoding != "utf-8":
+            raise
+        notifica("warning", "⚠️ Caratteri non UTF-8 oltre l'inizio del file: riletto come cp1252")
+        file_obj.seek(0)
+        return pd.read_csv(file_obj, encoding="cp1252", sep=formato.separatore, **kwargs)
+
+
+def leggi_csv_aziendale(file_obj, notifica=None) -> pd.DataFrame:
+    """Legge il CSV dei dati aziendali (sempre con intestazioni)."""
+    notifica = notifica or notifica_log
+    formato = rileva_formato_csv(file_obj)
+    return _leggi_csv(file_obj, formato, notifica)
+
+
+def leggi_csv_incassi(file_obj, notifica=None, strumentazione: Strumentazione = None):
+    """Legge il CSV degli incassi rilevando encoding, separatore e intestazioni.
+
+    Il file viene analizzato una sola volta. Restituisce il DataFrame letto
+    oppure None se il file è vuoto o illeggibile.
+    """
+    notifica = notifica or notifica_log
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    with strumentazione.fase("rilevamento_formato"):
+        formato = rileva_formato_csv(file_obj)
+
+    try:
+        with strumentazione.fase("lettura") as misura:
+            df_incassi = _leggi_csv(file_obj, formato, notifica, header=0 if formato.intestazioni else None)
+            misura["righe"] = len(df_incassi)
+    except (UnicodeDecodeError, pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+        notifica("error", f"⚠️ Parsing non riuscito ({formato.encoding}, separatore '{formato.separatore}'): {e}")
+        return None
+
+    intestazioni = "Con intestazioni" if formato.intestazioni else "Senza intestazioni"
+    notifica("info", f"🔍 Rilevato separatore: '{formato.separatore}' | Encoding: {formato.encoding} | {intestazioni}")
+
+    if len(df_incassi) > 0 and not df_incassi.iloc[0].isna().all():
+        return df_incassi
+    return None
+
+
+def leggi_csv_incassi_a_blocchi(file_obj, dimensione_blocco: int = DIMENSIONE_BLOCCO, notifica=None,
+                                strumentazione: Strumentazione = None):
+    """Legge il CSV degli incassi a blocchi di ``dimensione_blocco`` righe.
+
+    Il formato è rilevato una sola volta dal prefisso del file; restituisce
+    un generatore di DataFrame.
+    """
+    notifica = notifica or notifica_log
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    with strumentazione.fase("rilevamento_formato"):
+        formato = rileva_formato_csv(file_obj)
+    intestazioni = "Con intestazioni" if formato.intestazioni else "Senza intestazioni"
+    notifica("info", f"🔍 Rilevato separatore: '{formato.separatore}' | Encoding: {formato.encoding} | {intestazioni}")
+
+    file_obj.seek(0)
+    lettore = pd.read_csv(file_obj, encoding=formato.encoding, sep=formato.separatore,
+                          header=0 if formato.intestazioni else None, chunksize=dimensione_blocco)
+    try:
+        with lettore:
+            yield from strumentazione.itera("lettura", lettore)
+    except UnicodeDecodeError as e:
+        raise ValueError(f"Il file contiene caratteri non validi per l'encoding {formato.encoding}: {e}")
+    except pd.errors.EmptyDataError:
+        return
+
+
+# ---------------- LETTURA EXCEL E PARQUET ----------------
+
+ESTENSIONI_FILE = ["csv", "xlsx", "parquet", "arrow", "arrows", "feather"]
+TIPI_FILE = {"csv": "CSV", "xlsx": "Excel", "parquet": "Parquet", "arrow": "Arrow",
+             "arrow_stream": "Arrow (stream)", "feather": "Feather v1"}
+
+# Firme iniziali dei formati binari: tutto il resto è trattato come CSV
+_FIRME_FILE = [
+    (b"PK\x03\x04", "xlsx"),
+    (b"PAR1", "parquet"),
+    (b"ARROW1", "arrow"),
+    # Formato stream IPC: ogni messaggio inizia con il marcatore di continuazione
+    (b"\xff\xff\xff\xff", "arrow_stream"),
+    (b"FEA1", "feather"),
+]
+
+
+def rileva_tipo_file(file_obj) -> str:
+    """Tipo del file ("csv", "xlsx", "parquet", "arrow", "arrow_stream" o "feather") dai primi byte.
+
+    Il file viene riportato all'inizio.
+    """
+    file_obj.seek(0)
+    firma = file_obj.read(8)
+    file_obj.seek(0)
+    for prefisso, tipo in _FIRME_FILE:
+        if firma.startswith(prefisso):
+            return tipo
+    return "csv"
+
+
+def _righe_xlsx(file_obj, parole_chiave, intestazioni: bool = None):
+    """Colonne e iteratore sulle righe non vuote del primo foglio di un file xlsx.
+
+    Il foglio è letto in modalità read-only, una riga alla volta. Le celle
+    restano tipizzate (numeri, date); le colonne sono le intestazioni della
+    prima riga se riconosciute (o ``intestazioni`` è True), altrimenti
+    numerate da 0 come in read_csv senza intestazioni.
+    """
+    if openpyxl is None:
+        raise ValueError("Per leggere i file Excel serve il pacchetto openpyxl")
+    file_obj.seek(0)
+    try:
+        cartella = openpyxl.load_workbook(file_obj, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, KeyError, OSError, ValueError) as e:
+        raise ValueError(f"File Excel non leggibile: {e}")
+
+    def righe():
+        try:
+            for riga in cartella.active.iter_rows(values_only=True):
+                if any(valore is not None for valore in riga):
+                    yield riga
+        finally:
+            cartella.close()
+
+    iteratore = righe()
+    prima = next(iteratore, None)
+    if prima is None:
+        return [], iteratore
+    larghezza = max(i + 1 for i, valore in enumerate(prima) if valore is not None)
+    prima = prima[:larghezza]
+    if intestazioni is None:
+        intestazioni = ha_intestazioni(" ".join(str(v) for v in prima if v is not None), parole_chiave)
+    if intestazioni:
+        colonne = [str(v).strip() if v is not None else f"colonna_{i}" for i, v in enumerate(prima)]
+        return colonne, (riga[:larghezza] for riga in iteratore)
+    return list(range(larghezza)), (riga[:larghezza] for riga in chain([prima], iteratore))
+
+
+def _blocchi_xlsx(file_obj, dimensione_blocco: int, parole_chiave=PAROLE_CHIAVE_INCASSI, intestazioni: bool = None):
+    colonne, righe = _righe_xlsx(file_obj, parole_chiave, intestazioni)
+    inizio = 0
+    while True:
+        blocco = list(islice(righe, dimensione_blocco))
+        if not blocco:
+            return
+        df = pd.DataFrame.from_records(blocco, columns=colonne)
+        # Indice progressivo come nei blocchi di read_csv (numeri di riga del report)
+        df.index = pd.RangeIndex(inizio, inizio + len(df))
+        inizio += len(df)
+        yield df
+
+
+def _blocchi_arrow(file_obj, tipo: str, dimensione_blocco: int):
+    if pa is None:
+        raise ValueError(f"Per leggere i file {TIPI_FILE[tipo]} serve il pacchetto pyarrow")
+    file_obj.seek(0)
+    try:
+        if tipo == "parquet":
+            lotti = pa.parquet.ParquetFile(file_obj).iter_batches(batch_size=dimensione_blocco)
+        elif tipo == "arrow_stream":
+            lotti = (lotto.slice(inizio, dimensione_blocco) for lotto in pa.ipc.open_stream(file_obj)
+                     for inizio in range(0, lotto.num_rows, dimensione_blocco))
+        elif tipo == "feather":
+            # Il formato Feather v1 non ha lotti: è letto per intero
+            lotti = pa.feather.read_table(file_obj).to_batches(max_chunksize=dimensione_blocco)
+        else:
+            lettore = pa.ipc.open_file(file_obj)
+            lotti = (lotto.slice(inizio, dimensione_blocco)
+                     for lotto in map(lettore.get_batch, range(lettore.num_record_batches))
+                     for inizio in range(0, lotto.num_rows, dimensione_blocco))
+        inizio = 0
+        for lotto in lotti:
+            # Date come datetime64 (non oggetti date) per formattarle in blocco
+            df = lotto.to_pandas(date_as_object=False)
+            df.index = pd.RangeIndex(inizio, inizio + len(df))
+            inizio += len(df)
+            yield df
+    except pa.ArrowException as e:
+        raise ValueError(f"File {TIPI_FILE[tipo]} non leggibile: {e}")
+
+
+def leggi_file_tipizzato_a_blocchi(file_obj, tipo: str, dimensione_blocco: int = DIMENSIONE_BLOCCO,
+                                   parole_chiave=PAROLE_CHIAVE_INCASSI, intestazioni: bool = None):
+    """Legge un file xlsx, Parquet o Arrow a blocchi di ``dimensione_blocco`` righe.
+
+    Le colonne mantengono i tipi del file: importi numerici e date non
+    passano dal riconoscimento del testo in normalizza_incassi. Solleva
+    ValueError se il file non è leggibile.
+    """
+    if tipo == "xlsx":
+        return _blocchi_xlsx(file_obj, dimensione_blocco, parole_chiave, intestazioni)
+    return _blocchi_arrow(file_obj, tipo, dimensione_blocco)
+
+
+def leggi_incassi_a_blocchi(file_obj, dimensione_blocco: int = DIMENSIONE_BLOCCO, notifica=None,
+                            strumentazione: Strumentazione = None):
+    """Come leggi_csv_incassi_a_blocchi, per file CSV, xlsx, Parquet o Arrow."""
+    notifica = notifica or notifica_log
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    tipo = rileva_tipo_file(file_obj)
+    if tipo == "csv":
+        yield from leggi_csv_incassi_a_blocchi(file_obj, dimensione_blocco, notifica, strumentazione)
+        return
+    notifica("info", f"🔍 Rilevato file {TIPI_FILE[tipo]}: colonne lette con i loro tipi")
+    yield from strumentazione.itera("lettura", leggi_file_tipizzato_a_blocchi(file_obj, tipo, dimensione_blocco))
+
+
+def leggi_incassi(file_obj, notifica=None, strumentazione: Strumentazione = None):
+    """Come leggi_csv_incassi, per file CSV, xlsx, Parquet o Arrow."""
+    notifica = notifica or notifica_log
+    tipo = rileva_tipo_file(file_obj)
+    if tipo == "csv":
+        return leggi_csv_incassi(file_obj, notifica, strumentazione)
+
+    strumentazione = strumentazione or NESSUNA_STRUMENTAZIONE
+    try:
+        with strumentazione.fase("lettura") as misura:
+            blocchi = list(leggi_file_tipizzato_a_blocchi(file_obj, tipo, DIMENSIONE_BLOCCO))
+            df_incassi = pd.concat(blocchi) if blocchi else None
+            misura["righe"] = len(df_incassi) if df_incassi is not None else 0
+    except ValueError as e:
+        notifica("error", f"⚠️ {e}")
+        return None
+    notifica("info", f"🔍 Rilevato file {TIPI_FILE[tipo]}: colonne lette con i loro tipi")
+    return df_incassi if df_incassi is not None and len(df_incassi) else None
+
+
+def leggi_dati_aziendali(file_obj, notifica=None) -> pd.DataFrame:
+    """Come leggi_csv_aziendale, per file CSV, xlsx, Parquet o Arrow (sempre con intestazioni)."""
+    tipo = rileva_tipo_file(file_obj)
+    if tipo == "csv":
+        return leggi_csv_aziendale(file_obj, notifica)
+    blocchi = list(leggi_file_tipizzato_a_blocchi(file_obj, tipo, DIMENSIONE_BLOCCO, intestazioni=True))
+    if not blocchi:
+        raise ValueError(f"Il file {TIPI_FILE[tipo]} dei dati aziendali è vuoto")
+    return pd.concat(blocchi)
+
+
+# ---------------- CACHE ELABORAZIONI ----------------
+
+CACHE_MAX_BYTE = 512 * 1024 * 1024
+
+
+def impronta_file(file_obj, dimensione_blocco: int = 1024 * 1024) -> str:
+    """SHA-256 del contenuto del file, letto a blocchi. Il file viene riportato all'inizio."""
+    file_obj.seek(0)
+    impronta = hashlib.sha256()
+    for blocco in iter(lambda: file_obj.read(dimensione_blocco), b""):
+        impronta.update(blocco)
+    file_obj.seek(0)
+    return impronta.hexdigest()
+
+
+class CacheElaborazioni:
+    """Cache LRU dei file già elaborati, limitata dalla memoria occupata.
+
+    Le chiavi sono (impronta del contenuto, opzioni di lettura); i valori
+    vanno trattati come immutabili perché possono essere condivisi tra più
+    sessioni. Thread-safe.
+    """
+
+    def __init__(self, max_byte: int = CACHE_MAX_BYTE):
+        self.max_byte = max_byte
+        self._voci = OrderedDict()
+        self._byte = 0
+        self._lock = threading.Lock()
+        self.hit = 0
+        self.miss = 0
+
+    def get(self, chiave):
+        """Restituisce il valore in cache (o None) e lo segna come usato di recente."""
+        with self._lock:
+            voce = self._voci.get(chiave)
+            if voce is None:
+                self.miss += 1
+                return None
+            self._voci.move_to_end(chiave)
+            self.hit += 1
+            return voce[0]
+
+    def put(self, chiave, valore, dimensione: int):
+        """Inserisce un valore, eliminando i meno usati oltre ``max_byte``.
+
+        Un valore più grande dell'intera cache non viene conservato.
+        """
+        if dimensione > self.max_byte:
+            return
+        with self._lock:
+            vecchia = self._voci.pop(chiave, None)
+            if vecchia is not None:
+                self._byte -= vecchia[1]
+            self._voci[chiave] = (valore, dimensione)
+            self._byte += dimensione
+            while self._byte > self.max_byte:
+                _, (_, liberati) = self._voci.popitem(last=False)
+                self._byte -= liberati
+
+    def ottieni(self, chiave, calcola, dimensione):
+        """Valore in cache per ``chiave``, altrimenti ``calcola()`` e lo memorizza.
+
+        ``dimensione(valore)`` stima i byte occupati dal valore.
+        """
+        valore = self.get(chiave)
+        if valore is None:
+            valore = calcola()
+            self.put(chiave, valore, dimensione(valore))
+        return valore
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._byte = 0
+
+    def statistiche(self) -> dict:
+        with self._lock:
+            return {"voci": len(self._voci), "byte": self._byte, "max_byte": self.max_byte,
+                    "hit": self.hit, "miss": self.miss}
+
+
+def _registra_in(notifiche: list):
+    """Notifica che accumula i messaggi (livello, messaggio) in ``notifiche``."""
+    def notifica(livello: str, messaggio: str):
+        notifiche.append((livello, messaggio))
+    return notifica
+
+
+class ElaborazioneIncassi(NamedTuple):
+    """Risultato (memorizzabile in cache) della lettura di un file incassi."""
+    lotto: "LottoIncassi"
+    messaggio: str
+    notifiche: tuple
+    errori: pd.DataFrame
+
+
+class ElaborazioneAziendale(NamedTuple):
+    """Risultato (memorizzabile in cache) della lettura del CSV aziendale."""
+    dati: dict
+    messaggio: str
+    notifiche: tuple
+
+
+def elabora_incassi(file_obj, dimensione_blocco: int = DIMENSIONE_BLOCCO, cache: CacheElaborazioni = None,
+                    strumentazione: Strumentazione = None):
+    """Legge, normalizza, valida e aggrega un file incassi a blocchi.
+
+    ``errori`` è il report di validazione (vedi valida_incassi). I messaggi
+    diagnostici sono raccolti in ``notifiche`` (da ripresentare anche
+    quando il risultato arriva dalla cache). Con ``cache`` un file già
+    elaborato con le stesse opzioni non viene riletto; con ``strumentazione``
+    viene invece sempre rielaborato (le misure riguardano l'elaborazione
+    vera e propria) e la cache aggiornata.
+    """
+    def calcola():
+        notifiche, errori = [], []
+        blocchi = leggi_incassi_a_blocchi(file_obj, dimensione_blocco, _registra_in(notifiche), strumentazione)
+        df_processato, messaggio = processa_csv_incassi_a_blocchi(blocchi, _registra_in(notifiche), errori,
+                                                                  strumentazione)
+        lotto = None
+        if df_processato is not None:
+            with (strumentazione or NESSUNA_STRUMENTAZIONE).fase("lotto", len(df_processato)):
+                lotto = LottoIncassi.da_dataframe(df_processato)
+        return ElaborazioneIncassi(lotto, messaggio, tuple(notifiche), _unisci_report(errori))
+
+    def dimensione(r):
+        return (1024 + (r.lotto.nbytes() if r.lotto is not None else 0)
+                + int(r.errori.memory_usage(deep=True).sum()))
+
+    if cache is None:
+        return calcola()
+    # Le date di firma mancanti diventano la data odierna (normalizza_date_serie): il
+    # risultato vale solo per il giorno in cui è stato calcolato
+    chiave = (impronta_file(file_obj), "incassi", dimensione_blocco, datetime.now().strftime("%Y-%m-%d"))
+    if strumentazione is not None:
+        risultato = calcola()
+        cache.put(chiave, risultato, dimensione(risultato))
+        return risultato
+    return cache.ottieni(chiave, calcola, dimensione)
+
+
+def elabora_dati_aziendali(file_obj, cache: CacheElaborazioni = None):
+    """Legge e valida il CSV aziendale; ``dati`` è None se non valido."""
+    def calcola():
+        notifiche = []
+        df_aziendale = leggi_dati_aziendali(file_obj, _registra_in(notifiche))
+        valido, messaggio = valida_dati_aziendali(df_aziendale)
+        dati = df_aziendale.iloc[0].to_dict() if valido else None
+        return ElaborazioneAziendale(dati, messaggio, tuple(notifiche))
+
+    if cache is None:
+        return calcola()
+    return cache.ottieni((impronta_file(file_obj), "aziendale"), calcola, lambda r: 4096)
+
+
+# ---------------- LAVORI IN BACKGROUND ----------------
+
+LAVORO_IN_CODA = "in_coda"
+LAVORO_IN_CORSO = "in_corso"
+LAVORO_COMPLETATO = "completato"
+LAVORO_FALLITO = "errore"
+
+
+class Lavoro:
+    """Lavoro eseguito in background da CodaLavori.
+
+    Il thread che lo esegue aggiorna ``fase`` e l'avanzamento (``completate``
+    su ``totale`` transazioni); chi lo ha inviato ne legge stato, risultato
+    ed errore senza bloccarsi.
+    """
+
+    def __init__(self, descrizione: str = "", chiave=None):
+        self.id = uuid.uuid4().hex
+        self.descrizione = descrizione
+        self.chiave = chiave
+        self.stato = LAVORO_IN_CODA
+        self.fase = ""
+        self.totale = None
+        self.completate = 0
+        self.risultato = None
+        self.errore = None
+        self.creato = time.time()
+        self.inizio = self.fine = None
+        self._terminato = threading.Event()
+
+    @property
+    def terminato(self) -> bool:
+        return self._terminato.is_set()
+
+    def attendi(self, timeout: float = None) -> bool:
+        """Attende la fine del lavoro per al più ``timeout`` secondi; True se terminato."""
+        return self._terminato.wait(timeout)
+
+    def imposta_fase(self, fase: str, totale: int = None):
+        """Inizia una nuova fase; con ``totale`` l'avanzamento riparte da zero."""
+        self.fase = fase
+        if totale is not None:
+            self.totale = totale
+            self.completate = 0
+
+    def avanza(self, transazioni: int):
+        """Callback di avanzamento (vedi scrivi_xml_cbi): conta le transazioni completate."""
+        self.completate += transazioni
+
+    def percentuale(self):
+        """Avanzamento in percentuale (0-100), None se il totale non è noto."""
+        if self.stato == LAVORO_COMPLETATO:
+            return 100.0
+        if not self.totale:
+            return None
+        return min(100.0, 100.0 * self.completate / self.totale)
+
+    def durata(self):
+        if self.inizio is None:
+            return None
+        return (self.fine or time.time()) - self.inizio
+
+    def _esegui(self, funzione, argomenti, opzioni):
+        self.stato = LAVORO_IN_CORSO
+        self.inizio = time.time()
+        try:
+            self.risultato = funzione(self, *argomenti, **opzioni)
+            self.stato = LAVORO_COMPLETATO
+        except Exception as e:
+            logger.exception("Lavoro %s (%s) fallito", self.id, self.descrizione)
+            self.errore = f"{type(e).__name__}: {e}"
+            self.stato = LAVORO_FALLITO
+        finally:
+            self.fine = time.time()
+            self._terminato.set()
+
+
+class CodaLavori:
+    """Esegue i lavori in un pool di thread e ne conserva stato e risultato.
+
+    I lavori sono thread del processo corrente, così il risultato (lotto,
+    contenuti XML) resta disponibile a chi lo ha inviato senza copie.
+    Un lavoro inviato con la ``chiave`` di uno non fallito ancora presente
+    non viene rilanciato: ``invia`` restituisce quello esistente. Dei lavori
+    terminati sono conservati gli ultimi ``max_terminati``: chi invia un
+    lavoro ne conserva il Lavoro restituito, l'unico riferimento sicuro al
+    risultato. Thread-safe.
+    """
+
+    def __init__(self, max_lavori: int = 2, max_terminati: int = 32):
+        self.max_terminati = max_terminati
+        self._pool = ThreadPoolExecutor(max_workers=max_lavori, thread_name_prefix="lavoro-sdd")
+        self._lavori = OrderedDict()
+        self._lock = threading.Lock()
+
+    def invia(self, funzione, *argomenti, descrizione: str = "", chiave=None, **opzioni) -> Lavoro:
+        """Accoda ``funzione(lavoro, *argomenti, **opzioni)`` e restituisce il Lavoro."""
+        with self._lock:
+            if chiave is not None:
+                for lavoro in self._lavori.values():
+                    if lavoro.chiave == chiave and lavoro.stato != LAVORO_FALLITO:
+                        return lavoro
+            lavoro = Lavoro(descrizione, chiave)
+            self._lavori[lavoro.id] = lavoro
+            self._dimentica_terminati()
+        self._pool.submit(lavoro._esegui, funzione, argomenti, opzioni)
+        return lavoro
+
+    def lavoro(self, id_lavoro: str):
+        """Lavoro con l'id indicato (None se sconosciuto o già dimenticato)."""
+        with self._lock:
+            return self._lavori.get(id_lavoro)
+
+    def lavori(self) -> list:
+        with self._lock:
+            return list(self._lavori.values())
+
+    def _dimentica_terminati(self):
+        terminati = [id_lavoro for id_lavoro, lavoro in self._lavori.items() if lavoro.terminato]
+        for id_lavoro in terminati[:max(0, len(terminati) - self.max_terminati)]:
+            del self._lavori[id_lavoro]
+
+    def chiudi(self, attendi: bool = True):
+        self._pool.shutdown(wait=attendi)
+
+
+# ---------------- PIPELINE SENZA INTERFACCIA ----------------
+
+def carica_dati_aziendali(percorso) -> dict:
+    """Legge e valida i dati aziendali (CSV, xlsx, Parquet o Arrow) da file; solleva ValueError se non validi."""
+    with open(percorso, "rb") as f:
+        df_aziendale = leggi_dati_aziendali(f)
+    valido, messaggio = valida_dati_aziendali(df_aziendale)
+    if not valido:
+        raise ValueError(messaggio)
+    return df_aziendale.iloc[0].to_dict()
+
+
+def genera_flusso_da_file(dati_aziendali: dict, percorso_incassi, data_addebito: str, id_flusso: str,
+                          destinazione, indent: str = "", notifica=None,
+                          dimensione_blocco: int = None, limiti: LimitiPartizione = None,
+                          processi: int = None, strumentazione: Strumentazione = None,
+                          registro_mandati=None, indice_incrementale=None, compressione: str = None,
+                          verifica: bool = False, xsd=None, indice_esiti=None, allocatore=None,
+                          ammetti_duplicati: bool = False, msg_id: str = None) -> dict:
+    """Esegue lettura, normalizzazione, aggregazione e scrittura XML per un file incassi.
+
+    Con ``dimensione_blocco`` il file viene letto a blocchi di righe e
+    aggregato in modo incrementale (per file più grandi della memoria).
+    Con ``limiti`` il flusso è suddiviso in sottodistinte e file
+    (``nome_001.xml``...), scritti con ``processi`` processi; un flusso di
+    un solo file usa i processi per generarne le transazioni a blocchi.
+    Se la validazione segnala errori o avvisi, il report è scritto accanto
+    alla destinazione (``nome_validazione.csv``). Solleva ValueError se il
+    file non è leggibile o non supera la validazione.
+    Con ``strumentazione`` tempi, righe e picchi di memoria di ogni fase
+    sono salvati in ``nome_diagnostica.json`` accanto alla destinazione.
+    Con ``registro_mandati`` (percorso del database SQLite, vedi
+    RegistroMandati) SeqTp e date di firma vengono dal registro, FRST e RCUR
+    vanno in sottodistinte separate e gli incassi sono registrati dopo la
+    scrittura dei file.
+    Con ``indice_incrementale`` (percorso del database SQLite, vedi
+    IndiceIncrementale) i debitori invariati rispetto all'esecuzione
+    precedente riusano il DrctDbtTxInf già generato; aggiunti, modificati e
+    rimossi sono salvati in ``nome_variazioni.csv``.
+    Con ``indice_esiti`` (percorso del database SQLite, vedi
+    IndiceRiconciliazione) le transazioni scritte sono registrate per
+    riconciliare gli esiti restituiti dalla banca.
+    Con ``allocatore`` (percorso del database SQLite, vedi
+    AllocatoreIdentificativi) il MsgId è assegnato dall'allocatore e gli
+    incassi già generati in un flusso precedente (stessi IBAN, importo,
+    causale e data di addebito) bloccano la generazione e finiscono nel
+    report di validazione; con ``ammetti_duplicati`` sono solo avvisi.
+    Senza allocatore il MsgId è ``msg_id`` o, se manca, genera_message_id.
+    Con ``compressione`` ("zip" o "gzip", vedi comprimi_flusso) i file XML
+    sono sostituiti dalla loro versione compressa.
+    Con ``verifica`` (o ``xsd``, vedi verifica_flusso) i file scritti sono
+    riletti e verificati prima della compressione; i problemi trovati sono
+    salvati in ``nome_verifica.csv`` e gli errori sollevano ValueError.
+    Se la generazione fallisce dopo la scrittura i file del flusso sono
+    eliminati e restano solo i report.
+    Registro, indici e prenotazione dell'allocatore sono aggiornati solo
+    dopo verifica e compressione: un flusso non generato non risulta
+    presentato.
+    Restituisce un riepilogo con numero di transazioni, totale e file scritti.
+    """
+    argomenti = (dati_aziendali, percorso_incassi, data_addebito, id_flusso, destinazione, indent,
+                 notifica, dimensione_blocco, limiti, processi, registro_mandati, indice_incrementale, compressione,
+                 verifica or bool(xsd), xsd, indice_esiti, allocatore, ammetti_duplicati, msg_id)
+    if strumentazione is None:
+        return _genera_flusso_da_file(*argomenti, NESSUNA_STRUMENTAZIONE)
+
+    with strumentazione:
+        riepilogo = _genera_flusso_da_file(*argomenti, strumentazione)
+    percorso_diagnostica = Path(destinazione).with_name(f"{Path(destinazione).stem}_diagnostica.json")
+    strumentazione.salva_json(percorso_diagnostica)
+    riepilogo["diagnostica"] = str(percorso_diagnostica)
+    return riepilogo
+
+
+def _genera_flusso_da_file(dati_aziendali: dict, percorso_incassi, data_addebito: str, id_flusso: str,
+                           destinazione, indent: str, notifica, dimensione_blocco: int,
+                           limiti: LimitiPartizione, processi: int, registro_mandati, indice_incrementale,
+                           compressione: str, verifica: bool, xsd, indice_esiti, allocatore,
+                           ammetti_duplicati: bool, msg_id: str, strumentazione: Strumentazione) -> dict:
+    errori = []
+    with open(percorso_incassi, "rb") as f:
+        if dimensione_blocco:
+            blocchi = leggi_incassi_a_blocchi(f, dimensione_blocco, notifica, strumentazione)
+            df_processato, messaggio = processa_csv_incassi_a_blocchi(blocchi, notifica, errori, strumentazione)
+        else:
+            df_incassi = leggi_incassi(f, notifica, strumentazione)
+            if df_incassi is None:
+                raise ValueError("Impossibile leggere il file incassi. Verifica il formato del file.")
+            df_processato, messaggio = processa_csv_incassi(df_incassi, notifica, errori, strumentazione)
+
+    report = _unisci_report(errori)
+    if df_processato is None:
+        if len(report):
+            messaggio += f" - report completo: {_salva_report_csv(destinazione)('validazione', report)}"
+        raise ValueError(messaggio)
+
+    with strumentazione.fase("lotto", len(df_processato)):
+        lotto = LottoIncassi.da_dataframe(df_processato)
+    del df_processato
+    riepilogo = genera_flusso_da_lotto(dati_aziendali, lotto, data_addebito, id_flusso, destinazione, indent,
+                                       report, limiti, processi, strumentazione, registro_mandati,
+                                       indice_incrementale, compressione, verifica, xsd, indice_esiti, allocatore,
+                                       ammetti_duplicati, msg_id)
+    return {"incassi": str(percorso_incassi), **riepilogo}
+
+
+def _salva_report_csv(destinazione):
+    """``salva_report`` di default: il report ``nome`` va in ``<destinazione>_<nome>.csv``."""
+    def salva(nome: str, report: pd.DataFrame) -> Path:
+        percorso = Path(destinazione).with_name(f"{Path(destinazione).stem}_{nome}.csv")
+        report.to_csv(percorso, index=False)
+        return percorso
+    return salva
+
+
+def genera_flusso_da_lotto(dati_aziendali: dict, lotto: LottoIncassi, data_addebito: str, id_flusso: str,
+                           destinazione, indent: str = "", report: pd.DataFrame = None,
+                           limiti: LimitiPartizione = None, processi: int = None,
+                           strumentazione: Strumentazione = NESSUNA_STRUMENTAZIONE, registro_mandati=None,
+                           indice_incrementale=None, compressione: str = None, verifica: bool = False,
+                           xsd=None, indice_esiti=None, allocatore=None, ammetti_duplicati: bool = False,
+                           msg_id: str = None, salva_report=None, crea_file=None, lavoro=None) -> dict:
+    """Genera il flusso di un lotto già aggregato (vedi genera_flusso_da_file per le opzioni).
+
+    È la parte di genera_flusso_da_file successiva alla lettura, usata anche
+    dall'interfaccia web: registro dei mandati, allocatore, confronto
+    incrementale, suddivisione, scrittura, verifica, compressione e, solo per
+    un flusso generato, registrazione negli indici; se qualcosa fallisce i file
+    del flusso sono eliminati e le prenotazioni dell'allocatore annullate.
+    ``report`` è il report di validazione della lettura, completato con gli
+    avvisi di registro e allocatore. ``salva_report(nome, report)`` salva i
+    report (``"validazione"``, ``"variazioni"``, ``"verifica"``) e ne
+    restituisce il percorso (o None); default: ``<destinazione>_<nome>.csv``.
+    Con ``crea_file`` (ad es. FileGenerato) i file sono scritti sugli oggetti
+    ``crea_file(nome)`` invece che su disco (senza compressione). ``lavoro``
+    (vedi Lavoro) riceve fase e transazioni scritte.
+    """
+    salva_report = salva_report or _salva_report_csv(destinazione)
+    imposta_fase = lavoro.imposta_fase if lavoro is not None else lambda fase, totale=None: None
+    report = report if report is not None else _unisci_report([])
+    messaggio = ""
+    registro = sequenza = prenotati = None
+    # File del flusso (anche parziali o compressi) da eliminare se la generazione fallisce
+    file_flusso = []
+    indice = confronto = corpi = percorso_variazioni = None
+    try:
+        if registro_mandati:
+            imposta_fase("registro mandati")
+            registro = RegistroMandati(registro_mandati)
+            with strumentazione.fase("registro_mandati", len(lotto)):
+                sequenza = applica_registro_mandati(lotto, dati_aziendali["prefisso_mandato"], registro)
+            lotto = sequenza.lotto
+            report = _unisci_report([report, sequenza.report])
+        if allocatore:
+            imposta_fase("controllo duplicati")
+            with AllocatoreIdentificativi(allocatore) as allocatore_id, \
+                    strumentazione.fase("duplicati", len(lotto)):
+                msg_id = allocatore_id.nuovo_message_id(id_flusso)
+                # Da qui ogni uscita senza flusso generato annulla le prenotazioni di msg_id
+                prenotati = msg_id
+                duplicati = allocatore_id.prenota_incassi(impronte_incassi(lotto, data_addebito), msg_id,
+                                                          data_addebito, ammetti_duplicati)
+            report = _unisci_report([report, report_duplicati(lotto, duplicati,
+                                                              "avviso" if ammetti_duplicati else "errore")])
+            if len(duplicati) and not ammetti_duplicati:
+                messaggio = f"{len(duplicati)} incassi già generati in flussi precedenti"
+                lotto = None
+
+        percorso_report = salva_report("validazione", report) if len(report) else None
+        if lotto is None:
+            if percorso_report is not None:
+                messaggio += f" - report completo: {percorso_report}"
+            raise ValueError(messaggio)
+
+        totali = lotto.totali()
+        if indice_incrementale:
+            imposta_fase("confronto incrementale")
+            indice = IndiceIncrementale(indice_incrementale)
+            parametri = parametri_incrementali(dati_aziendali, indent)
+            with strumentazione.fase("confronto_incrementale", len(lotto)):
+                confronto = indice.confronta(lotto, parametri)
+                corpi = corpi_incrementali(lotto, confronto, dati_aziendali["prefisso_mandato"], indent)
+            percorso_variazioni = salva_report("variazioni", confronto.variazioni(lotto))
+
+        partizioni = None
+        msg_id = msg_id or genera_message_id(id_flusso)
+        if limiti or sequenza is not None or corpi is not None or indice_esiti:
+            imposta_fase("suddivisione")
+            with strumentazione.fase("partizione", len(lotto)):
+                partizioni = partiziona_incassi(lotto, dati_aziendali, data_addebito, limiti, indent,
+                                                seq_tp=sequenza.seq_tp if sequenza is not None else None)
+            nomi = [str(p) for p in nomi_file_partizioni(destinazione, len(partizioni))]
+            file_flusso = [crea_file(nome) for nome in nomi] if crea_file else nomi
+            imposta_fase("generazione XML", len(lotto))
+            # Con più processi il picco di memoria non include quello dei processi figli
+            with strumentazione.fase("xml", len(lotto)):
+                file_scritti = scrivi_flusso_partizionato(file_flusso, dati_aziendali, lotto, partizioni, id_flusso,
+                                                          indent, processi, msg_id, corpi,
+                                                          avanzamento=lavoro.avanza if lavoro is not None else None)
+        else:
+            file_flusso = [crea_file(str(destinazione)) if crea_file else str(destinazione)]
+            imposta_fase("generazione XML", len(lotto))
+            with strumentazione.fase("xml", len(lotto)):
+                scrivi_xml_cbi(file_flusso[0], dati_aziendali, lotto, data_addebito, id_flusso, indent, totali,
+                               avanzamento=lavoro.avanza if lavoro is not None else None,
+                               processi=processi, msg_id=msg_id)
+            file_scritti = list(file_flusso)
+
+        # Registri e indici sono aggiornati solo per un flusso verificato e compresso:
+        # un flusso scartato non deve risultare presentato
+        esiti_verifica = None
+        if verifica:
+            imposta_fase("verifica")
+            with strumentazione.fase("verifica", totali[0]):
+                esiti_verifica = [verifica_flusso(file, xsd, processi) for file in file_scritti]
+            report_verifica = pd.concat([esito.report.assign(file=Path(_nome_file(file)).name)
+                                         for file, esito in zip(file_scritti, esiti_verifica)],
+                                        ignore_index=True)
+            percorso_verifica = None
+            if len(report_verifica):
+                percorso_verifica = salva_report("verifica", report_verifica[["file"] + COLONNE_REPORT_VERIFICA])
+            errori_verifica = sum(esito.errori for esito in esiti_verifica)
+            if errori_verifica:
+                raise ValueError(f"{errori_verifica} errori nella verifica del flusso generato"
+                                 + (f" - report completo: {percorso_verifica}" if percorso_verifica else ""))
+
+        if compressione:
+            imposta_fase("compressione")
+            file_flusso += ([str(Path(destinazione).with_suffix(".zip"))] if compressione == "zip"
+                            else [f"{percorso}.gz" for percorso in file_scritti])
+            with strumentazione.fase("compressione", totali[0]):
+                file_scritti = comprimi_flusso(file_scritti, compressione, destinazione)
+
+        if registro is not None or indice is not None or indice_esiti:
+            imposta_fase("registrazione incassi")
+        if registro is not None:
+            with strumentazione.fase("registro_mandati", len(lotto)):
+                registro.registra_flusso(lotto, sequenza.mandati, partizioni, msg_id, id_flusso)
+        if indice is not None:
+            with strumentazione.fase("indice_incrementale", len(lotto)):
+                indice.aggiorna(lotto, confronto, corpi, parametri)
+        if indice_esiti:
+            with strumentazione.fase("indice_esiti", len(lotto)), IndiceRiconciliazione(indice_esiti) as esiti:
+                mandati = sequenza.mandati if sequenza is not None else \
+                    [genera_mandate_id(dati_aziendali["prefisso_mandato"], cf) for cf in lotto.codice_fiscale]
+                esiti.registra_flusso(lotto, partizioni, msg_id, id_flusso, mandati)
+    except BaseException:
+        # Un flusso non generato non deve restare accanto ai report, dove sembrerebbe pronto per l'invio
+        for file in file_flusso:
+            if isinstance(file, FileGenerato):
+                file.chiudi()
+            else:
+                Path(file).unlink(missing_ok=True)
+        if prenotati is not None:
+            # Flusso non generato: i suoi incassi non vanno considerati già presentati
+            with AllocatoreIdentificativi(allocatore) as allocatore_id:
+                allocatore_id.annulla(prenotati)
+        raise
+    finally:
+        if registro is not None:
+            registro.chiudi()
+        if indice is not None:
+            indice.chiudi()
+
+    riepilogo = {
+        "output": ", ".join(_nome_file(file) for file in file_scritti),
+        "file": file_scritti,
+        "report_validazione": str(percorso_report) if percorso_report is not None else "",
+        "nb_of_txs": totali[0],
+        "ctrl_sum": formatta_centesimi(totali[1]),
+    }
+    if partizioni is not None:
+        riepilogo["sottodistinte"] = sum(len(p) for p in partizioni)
+    if sequenza is not None:
+        riepilogo["frst"] = sequenza.seq_tp.count(SEQ_TP_PRIMO)
+        riepilogo["rcur"] = len(sequenza.seq_tp) - riepilogo["frst"]
+    if confronto is not None:
+        riepilogo.update(confronto.conteggi(), variazioni=str(percorso_variazioni or ""))
+    if esiti_verifica is not None:
+        riepilogo["verifica"] = str(percorso_verifica) if percorso_verifica is not None else ""
+    return riepilogo
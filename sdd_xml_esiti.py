@@ -0,0 +1,90 @@
+"""
+Generatore XML SEPA SDD CBI - riconciliazione esiti - sdd_xml_esiti.py
+Descrizione: riconcilia i flussi di esito restituiti dalla banca (pain.002,
+             pacs.004, camt.054, anche .gz o dentro uno ZIP) con le
+             transazioni generate, registrate con --indice-esiti, e produce
+             il report per debitore e il file degli incassi da ripresentare
+
+Esempio:
+    python sdd_xml_esiti.py --indice esiti.sqlite esiti_banca/*.xml \\
+        --report esiti_marzo.csv --ripresentazione incassi_da_ripresentare.csv
+"""
+
+import argparse
+import logging
+import sys
+import zipfile
+from pathlib import Path
+
+from sdd_xml_core import (COLONNE_REPORT_ESITI, incassi_da_ripresentare, IndiceRiconciliazione, leggi_esiti,
+                          riepilogo_esiti)
+
+logger = logging.getLogger("sdd_xml_esiti")
+
+
+def flussi_esito(percorsi):
+    """Coppie (nome, sorgente) dei flussi di esito: le directory e i file ZIP sono espansi nei loro XML."""
+    for percorso in map(Path, percorsi):
+        if percorso.is_dir():
+            yield from flussi_esito(sorted(p for p in percorso.iterdir()
+                                           if p.name.lower().endswith((".xml", ".xml.gz", ".zip"))))
+        elif zipfile.is_zipfile(percorso):
+            with zipfile.ZipFile(percorso) as archivio:
+                for nome in archivio.namelist():
+                    if nome.lower().endswith(".xml"):
+                        with archivio.open(nome) as f:
+                            yield f"{percorso}:{nome}", f
+        else:
+            yield str(percorso), percorso
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Riconcilia gli esiti SDD della banca con i flussi generati.")
+    parser.add_argument("esiti", nargs="+", help="file di esito XML (anche .gz o ZIP) o directory che li contengono")
+    parser.add_argument("--indice", required=True, metavar="FILE",
+                        help="database SQLite delle transazioni generate (--indice-esiti della generazione)")
+    parser.add_argument("--report", metavar="FILE", help="CSV con l'esito di ogni debitore dei file riconciliati")
+    parser.add_argument("--ripresentazione", metavar="FILE",
+                        help="file incassi CSV con i respinti che si possono ripresentare")
+    parser.add_argument("-v", "--verbose", action="store_true", help="elenca gli EndToEndId non trovati nell'indice")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    if not Path(args.indice).exists():
+        logger.error("Indice non trovato: %s", args.indice)
+        return 1
+
+    errori = 0
+    riconciliati = []
+    with IndiceRiconciliazione(args.indice) as indice:
+        for nome, sorgente in flussi_esito(args.esiti):
+            try:
+                esito = indice.riconcilia(leggi_esiti(sorgente), nome)
+            except (OSError, ValueError, SyntaxError) as e:
+                # ET.ParseError è una sottoclasse di SyntaxError
+                errori += 1
+                logger.error("%s: %s", nome, e)
+                continue
+            riconciliati.append(nome)
+            print(f"{nome}: {esito.record} esiti, {esito.riconciliati} transazioni riconciliate, "
+                  f"{len(esito.sconosciuti)} non trovate nell'indice")
+            for identificativo in esito.sconosciuti:
+                logger.info("  non trovato: %s", identificativo)
+
+        esiti = indice.esiti(riconciliati)
+
+    print(riepilogo_esiti(esiti))
+    if args.report:
+        esiti.reindex(columns=COLONNE_REPORT_ESITI).to_csv(args.report, index=False)
+        print(f"report: {args.report}")
+    if args.ripresentazione:
+        incassi = incassi_da_ripresentare(esiti)
+        incassi.to_csv(args.ripresentazione, index=False)
+        print(f"incassi da ripresentare: {len(incassi)} in {args.ripresentazione}")
+
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,16 +4,39 @@ Versione: 4.0
 Ultimo aggiornamento: 2025-01-30 02:45:00
 Autore: Assistente AI
 Descrizione: Applicazione Streamlit per generare file XML SEPA SDD in formato CBI
+             (interfaccia sopra il nucleo sdd_xml_core)
 """
 
-import streamlit as st
-import csv
 import io
-from datetime import datetime
-from xml.etree.ElementTree import Element, SubElement, tostring
-from xml.dom import minidom
+import json
+import os
 import re
-import pandas as pd
+from functools import partial
+from pathlib import Path
+
+import streamlit as st
+from datetime import datetime
+
+from sdd_xml_core import (
+    CacheElaborazioni,
+    CodaLavori,
+    crea_template_aziendale,
+    crea_template_incassi,
+    elabora_dati_aziendali,
+    elabora_incassi,
+    ESTENSIONI_FILE,
+    FileGenerato,
+    formatta_centesimi,
+    genera_flusso_da_lotto,
+    IndiceTransazioni,
+    LAVORO_FALLITO,
+    LimitiPartizione,
+    NESSUNA_STRUMENTAZIONE,
+    scrivi_gzip,
+    scrivi_zip,
+    Strumentazione,
+    valida_id_flusso,
+)
 
 # Costanti versione
 APP_VERSION = "4.0"
@@ -35,321 +58,211 @@ if "data_addebito" not in st.session_state:
     st.session_state.data_addebito = None
 if "id_flusso" not in st.session_state:
     st.session_state.id_flusso = None
-
-
-def pulisci_iban(iban: str) -> str:
-    """Rimuove spazi dall'IBAN e lo normalizza in maiuscolo."""
-    return re.sub(r"\s+", "", str(iban).upper().strip())
-
-
-def normalizza_data(data_str) -> str:
-    """Normalizza una data nel formato YYYY-MM-DD. Se vuota/NaN -> data odierna."""
-    if pd.isna(data_str) or str(data_str).strip() == "":
-        return datetime.now().strftime("%Y-%m-%d")
-
-    data_str = str(data_str).strip()
-
-    formati = [
-        "%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y",
-        "%d.%m.%Y", "%Y/%m/%d", "%d/%m/%y",
-        "%d-%m-%y", "%d.%m.%y"
-    ]
-
-    for formato in formati:
-        try:
-            data_obj = datetime.strptime(data_str, formato)
-            return data_obj.strftime("%Y-%m-%d")
-        except ValueError:
-            continue
-
-    return datetime.now().strftime("%Y-%m-%d")
-
-
-def normalizza_importo(importo_str) -> str:
-    """Normalizza un importo nel formato xxxx.xx"""
-    if pd.isna(importo_str):
-        return "0.00"
-
-    importo_str = str(importo_str).strip()
-    importo_str = importo_str.replace(" ", "").replace(",", ".")
-
-    try:
-        importo_float = float(importo_str)
-        return f"{importo_float:.2f}"
-    except ValueError:
-        return "0.00"
-
-
-def aggrega_incassi(df: pd.DataFrame) -> pd.DataFrame:
-    """Aggrega le righe per lo stesso debitore (stesso IBAN)."""
-    df_aggregato = df.groupby("iban").agg({
-        "nome_debitore": "first",
-        "codice_fiscale": "first",
-        "importo": lambda x: sum(float(i) for i in x),
-        "causale": lambda x: list(dict.fromkeys(x)),
-        "data_firma_mandato": "first"
-    }).reset_index()
-
-    df_aggregato["causale"] = df_aggregato["causale"].apply(
-        lambda causali: "Ft. " + ", ".join(str(c) for c in causali)
-    )
-    df_aggregato["importo"] = df_aggregato["importo"].apply(lambda x: f"{x:.2f}")
-
-    return df_aggregato
-
-
-def genera_message_id(prefix: str) -> str:
-    """Genera un Message ID (con timestamp per ridurre collisioni)."""
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    return f"{prefix}{timestamp}"
-
-
-def genera_end_to_end_id(msg_id: str, idx: int) -> str:
-    """Genera un End-to-End ID."""
-    return f"{msg_id}-{idx:07d}"
-
-
-def genera_mandate_id(prefix: str, codice_fiscale: str) -> str:
-    """Genera un Mandate ID basato sul CF."""
-    cf = str(codice_fiscale).strip().upper()
-    return f"{prefix}{cf}"
-
-
-def crea_template_aziendale() -> str:
-    """Crea il template CSV per i dati aziendali."""
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["nome_azienda", "indirizzo_azienda", "iban", "abi", "creditor_id", "prefisso_mandato"])
-    writer.writerow(["ESEMPIO SRL", "Via Esempio 1", "IT00A0000000000000000000000", "01234", "IT00ZZZ0000000000000000", "EXM001"])
-    return output.getvalue()
-
-
-def crea_template_incassi() -> str:
-    """Crea il template CSV per gli incassi."""
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["nome_debitore", "codice_fiscale", "iban", "importo", "causale", "data_firma_mandato"])
-    writer.writerow(["Mario Rossi", "RSSMRA80A01H501U", "IT00B0000000000000000000001", "100.00",
-                     "Fattura 001/2025 del 15/01/2025", "15/01/2024"])
-    writer.writerow(["Mario Rossi", "RSSMRA80A01H501U", "IT00B0000000000000000000001", "50.00",
-                     "Fattura 002/2025 del 20/01/2025", "15/01/2024"])
-    writer.writerow(["Laura Bianchi", "BNCLRA85M45F205K", "IT00C0000000000000000000002", "150.50",
-                     "Abbonamento annuale 2025", "10/02/2024"])
-    return output.getvalue()
-
-
-def valida_dati_aziendali(df: pd.DataFrame):
-    """Valida i dati aziendali."""
-    required_fields = ["nome_azienda", "indirizzo_azienda", "iban", "abi", "creditor_id", "prefisso_mandato"]
-    for field in required_fields:
-        if field not in df.columns:
-            return False, f"Campo mancante: {field}"
-        if df[field].iloc[0] == "" or pd.isna(df[field].iloc[0]):
-            return False, f"Campo vuoto: {field}"
-
-    df["abi"] = df["abi"].astype(str).str.zfill(5)
-    return True, "OK"
-
-
-def processa_csv_incassi(df: pd.DataFrame):
-    """Processa il CSV degli incassi: normalizza date, importi e aggrega."""
-    required_fields = ["nome_debitore", "codice_fiscale", "iban", "importo", "causale", "data_firma_mandato"]
-
-    st.info(f"📊 CSV caricato: {len(df.columns)} colonne, {len(df)} righe")
-    st.write(f"🔍 Prime colonne rilevate: {list(df.columns[:3])}")
-
-    # Se il dataframe non ha i nomi delle colonne corretti, assegnali/mappali
-    if len(df.columns) == len(required_fields):
-        # colonne numeriche => CSV senza header
-        if isinstance(df.columns[0], int):
-            df.columns = required_fields
-            st.success("✅ Intestazioni colonne aggiunte automaticamente (CSV senza intestazioni)")
-        else:
-            prima_colonna = str(df.columns[0]).lower().strip()
-            st.write(f"🔍 Prima riga dati: {df.iloc[0].to_dict()}")
-
-            if prima_colonna not in ["nome_debitore", "nome", "debitore"]:
-                colonne_valide = any(
-                    str(col).lower().strip() in [
-                        "nome_debitore", "nome", "debitore", "codice_fiscale", "cf",
-                        "iban", "importo", "causale", "data", "data_firma_mandato"
-                    ] for col in df.columns
-                )
-
-                if not colonne_valide:
-                    df.columns = required_fields
-                    st.success("✅ Intestazioni colonne aggiunte automaticamente")
-                else:
-                    mapping = {}
-                    for col in df.columns:
-                        col_lower = str(col).lower().strip()
-                        if "nome" in col_lower or "debitore" in col_lower:
-                            mapping[col] = "nome_debitore"
-                        elif "codice" in col_lower or "fiscale" in col_lower or "cf" in col_lower or "piva" in col_lower or "partita" in col_lower:
-                            mapping[col] = "codice_fiscale"
-                        elif "iban" in col_lower:
-                            mapping[col] = "iban"
-                        elif "importo" in col_lower or "ammontare" in col_lower or "totale" in col_lower:
-                            mapping[col] = "importo"
-                        elif "causale" in col_lower or "descrizione" in col_lower or "motivo" in col_lower:
-                            mapping[col] = "causale"
-                        elif "data" in col_lower or "firma" in col_lower or "mandato" in col_lower:
-                            mapping[col] = "data_firma_mandato"
-
-                    if len(set(mapping.values())) == len(required_fields):
-                        df = df.rename(columns=mapping)
-                        st.success("✅ Intestazioni colonne mappate automaticamente")
-                    else:
-                        df.columns = required_fields
-                        st.warning("⚠️ Alcune intestazioni non riconosciute, applicate intestazioni standard")
+if "totali_incassi" not in st.session_state:
+    st.session_state.totali_incassi = None
+if "xml_generati" not in st.session_state:
+    # Lista di (nome file, FileGenerato) dell'ultima generazione
+    st.session_state.xml_generati = []
+if "indici_xml" not in st.session_state:
+    st.session_state.indici_xml = {}
+if "diagnostica" not in st.session_state:
+    # Strumentazione dell'ultimo file incassi misurato e opzioni con cui è stato misurato
+    st.session_state.diagnostica = None
+    st.session_state.diagnostica_file = None
+    # Strumentazione dell'ultima generazione XML misurata
+    st.session_state.diagnostica_generazione = None
+if "lavoro_incassi" not in st.session_state:
+    # Lavori in background della sessione: (chiave, Lavoro) dell'elaborazione incassi e Lavoro della
+    # generazione. La sessione tiene il Lavoro stesso, non il suo id: il risultato resta disponibile
+    # anche se la coda, condivisa tra le sessioni, lo ha già dimenticato
+    st.session_state.lavoro_incassi = None
+    st.session_state.lavoro_generazione = None
+    st.session_state.esito_generazione = None
+
+# Anteprime: righe/transazioni per pagina selezionabili
+RIGHE_PER_PAGINA = [50, 100, 500]
+TRANSAZIONI_PER_PAGINA = [10, 50, 200]
+FORMATI_DOWNLOAD = ["XML", "ZIP", "gzip"]
+# Attesa prima di mostrare l'avanzamento (i lavori brevi, es. da cache, finiscono nello stesso rerun)
+ATTESA_LAVORO_S = 0.3
+# Thread dei lavori in background, condivisi da tutte le sessioni: elaborazioni e generazioni hanno
+# pool separati, così una generazione lunga non ritarda l'elaborazione dei file caricati
+THREAD_LAVORI = {"incassi": 2, "generazione": 2}
+# Directory del server con i registri mandati: dall'interfaccia si sceglie solo il nome del registro
+VARIABILE_CARTELLA_REGISTRI = "SDD_XML_CARTELLA_REGISTRI"
+_RE_NOME_REGISTRO = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def notifica_streamlit(livello: str, messaggio: str):
+    """Mostra nella pagina i messaggi diagnostici del nucleo."""
+    getattr(st, livello, st.info)(messaggio)
+
+
+def selettore_pagina(totale: int, opzioni: list, chiave: str):
+    """Widget di paginazione: restituisce (pagina da 1, elementi per pagina).
+
+    ``chiave`` deve cambiare quando cambiano i dati, così la pagina riparte da 1.
+    """
+    col_pagina, col_per_pagina = st.columns([3, 1])
+    with col_per_pagina:
+        per_pagina = st.selectbox("Per pagina", opzioni, key=f"{chiave}_per_pagina")
+    pagine = max(1, -(-totale // per_pagina))
+    with col_pagina:
+        pagina = st.number_input(f"Pagina (di {pagine})", min_value=1, max_value=pagine, value=1,
+                                 key=f"{chiave}_pagina")
+    return int(pagina), per_pagina
+
+
+def indice_xml(numero: int) -> IndiceTransazioni:
+    """Indice delle transazioni di un file generato, costruito alla prima anteprima."""
+    if numero not in st.session_state.indici_xml:
+        st.session_state.indici_xml[numero] = IndiceTransazioni(st.session_state.xml_generati[numero][1].contenuto())
+    return st.session_state.indici_xml[numero]
+
+
+def percorso_registro(nome: str):
+    """Percorso del registro mandati ``nome`` nella directory configurata sul server.
+
+    Restituisce None se la directory non è configurata; solleva ValueError
+    se il nome contiene caratteri diversi da lettere, cifre, "_" e "-".
+    """
+    cartella = os.environ.get(VARIABILE_CARTELLA_REGISTRI)
+    if not cartella:
+        return None
+    if not _RE_NOME_REGISTRO.fullmatch(nome):
+        raise ValueError("Nome del registro non valido: usa solo lettere, cifre, \"_\" e \"-\" (max 64 caratteri)")
+    return str(Path(cartella) / f"{nome}.sqlite")
+
+
+def zip_generati(xml_generati: list) -> bytes:
+    """Archivio ZIP di tutti i file generati (costruito solo al click sul download)."""
+    buffer = io.BytesIO()
+    scrivi_zip(buffer, xml_generati)
+    return buffer.getvalue()
+
+
+def gzip_generato(nome: str, file: FileGenerato) -> bytes:
+    """File generato compresso gzip (costruito solo al click sul download)."""
+    buffer = io.BytesIO()
+    scrivi_gzip(buffer, file, nome)
+    return buffer.getvalue()
+
+
+@st.cache_resource
+def cache_elaborazioni() -> CacheElaborazioni:
+    """Cache dei file già elaborati, condivisa tra sessioni e rerun.
+
+    Un rerun (ad es. cambio di ID flusso o data) con lo stesso file caricato
+    non rilegge né riaggrega il CSV.
+    """
+    return CacheElaborazioni()
+
+
+@st.cache_resource
+def coda_lavori(tipo: str) -> CodaLavori:
+    """Lavori in background di un ``tipo`` ("incassi" o "generazione"), condivisi tra sessioni e rerun.
+
+    Ogni tipo ha il proprio pool di THREAD_LAVORI[tipo] thread. Un rerun non
+    interrompe né rilancia un lavoro: la sessione ne conserva il Lavoro e si
+    ricollega a quello in corso.
+    """
+    return CodaLavori(max_lavori=THREAD_LAVORI[tipo])
+
+
+@st.fragment(run_every=1)
+def mostra_avanzamento(lavoro):
+    """Avanzamento di un lavoro in background, aggiornato senza rieseguire la pagina.
+
+    Quando il lavoro termina riesegue la pagina, che ne mostra il risultato.
+    """
+    if lavoro.terminato:
+        st.rerun()
+    percentuale = lavoro.percentuale()
+    durata = lavoro.durata() or 0
+    if percentuale is None:
+        st.info(f"⏳ {lavoro.descrizione}: {lavoro.fase or 'in coda'} ({durata:.0f} s)")
     else:
-        return None, f"Il CSV deve avere {len(required_fields)} colonne, ne ha {len(df.columns)}"
+        st.progress(int(percentuale), text=f"⏳ {lavoro.descrizione}: {lavoro.fase} - {percentuale:.0f}% "
+                                           f"({lavoro.completate} di {lavoro.totale} transazioni, {durata:.0f} s)")
 
-    # Normalizzazioni
-    df["codice_fiscale"] = df["codice_fiscale"].astype(str).str.strip()
-    df["iban"] = df["iban"].apply(pulisci_iban)
-    df["data_firma_mandato"] = df["data_firma_mandato"].apply(normalizza_data)
-    df["importo"] = df["importo"].apply(normalizza_importo)
 
-    # Verifica campi obbligatori
-    for idx, row in df.iterrows():
-        for field in ["nome_debitore", "codice_fiscale", "iban", "importo", "causale"]:
-            valore = str(row[field]).strip() if not pd.isna(row[field]) else ""
-            if valore == "" or valore.lower() == "nan":
-                st.error(f"⚠️ Debug riga {idx+2}: {field} = '{row[field]}' (tipo: {type(row[field])})")
-                return None, f"Campo vuoto nella riga {idx+2}: {field}"
-
-    df_aggregato = aggrega_incassi(df)
-    return df_aggregato, "OK"
-
-
-def genera_xml_cbi(dati_aziendali, incassi, data_addebito: str, id_flusso: str) -> bytes:
-    """Genera il file XML SEPA SDD in formato CBI."""
-    numero_transazioni = len(incassi)
-    totale_importo = sum(float(inc["importo"]) for inc in incassi)
-
-    msg_id = genera_message_id(id_flusso)
-
-    root = Element("CBIBdySDDReq")
-    root.set("xmlns", "urn:CBI:xsd:CBIBdySDDReq.00.01.00")
-    root.set("xmlns:xsi", "http://www.w3.org/2001/XMLSchema-instance")
-    root.set("xsi:schemaLocation", "urn:CBI:xsd:CBIBdySDDReq.00.01.00 CBIBdySDDReq.00.01.00.xsd")
-
-    phy_msg_inf = SubElement(root, "PhyMsgInf")
-    SubElement(phy_msg_inf, "PhyMsgTpCd").text = "INC-SDDC-01"
-    SubElement(phy_msg_inf, "NbOfLogMsg").text = "1"
-
-    cbi_envel = SubElement(root, "CBIEnvelSDDReqLogMsg")
-    cbi_sdd_req = SubElement(cbi_envel, "CBISDDReqLogMsg")
-
-    grp_hdr = SubElement(cbi_sdd_req, "GrpHdr")
-    grp_hdr.set("xmlns", "urn:CBI:xsd:CBISDDReqLogMsg.00.01.00")
-
-    SubElement(grp_hdr, "MsgId").text = msg_id
-    SubElement(grp_hdr, "CreDtTm").text = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-    SubElement(grp_hdr, "NbOfTxs").text = str(numero_transazioni)
-    SubElement(grp_hdr, "CtrlSum").text = f"{totale_importo:.2f}"
-
-    initg_pty = SubElement(grp_hdr, "InitgPty")
-    SubElement(initg_pty, "Nm").text = dati_aziendali["nome_azienda"]
-
-    initg_pty_id = SubElement(initg_pty, "Id")
-    org_id = SubElement(initg_pty_id, "OrgId")
-    othr = SubElement(org_id, "Othr")
-    SubElement(othr, "Id").text = id_flusso
-    SubElement(othr, "Issr").text = "CBI"
-
-    pmt_inf = SubElement(cbi_sdd_req, "PmtInf")
-    pmt_inf.set("xmlns", "urn:CBI:xsd:CBISDDReqLogMsg.00.01.00")
-
-    SubElement(pmt_inf, "PmtInfId").text = "SOTTODISTINTA1"
-    SubElement(pmt_inf, "PmtMtd").text = "DD"
-
-    pmt_tp_inf = SubElement(pmt_inf, "PmtTpInf")
-    svc_lvl = SubElement(pmt_tp_inf, "SvcLvl")
-    SubElement(svc_lvl, "Cd").text = "SEPA"
-    lcl_instrm = SubElement(pmt_tp_inf, "LclInstrm")
-    SubElement(lcl_instrm, "Cd").text = "CORE"
-    SubElement(pmt_tp_inf, "SeqTp").text = "RCUR"
-
-    SubElement(pmt_inf, "ReqdColltnDt").text = data_addebito
-
-    cdtr = SubElement(pmt_inf, "Cdtr")
-    SubElement(cdtr, "Nm").text = dati_aziendali["nome_azienda"]
-
-    pstl_adr = SubElement(cdtr, "PstlAdr")
-    SubElement(pstl_adr, "Ctry").text = "IT"
-    SubElement(pstl_adr, "AdrLine").text = dati_aziendali["indirizzo_azienda"]
-
-    cdtr_acct = SubElement(pmt_inf, "CdtrAcct")
-    cdtr_acct_id = SubElement(cdtr_acct, "Id")
-    SubElement(cdtr_acct_id, "IBAN").text = pulisci_iban(dati_aziendali["iban"])
-
-    cdtr_agt = SubElement(pmt_inf, "CdtrAgt")
-    fin_instn_id = SubElement(cdtr_agt, "FinInstnId")
-    clr_sys_mmb_id = SubElement(SubElement(fin_instn_id, "ClrSysMmbId"), "MmbId")
-    clr_sys_mmb_id.text = str(dati_aziendali["abi"]).zfill(5)
-
-    cdtr_schme_id = SubElement(pmt_inf, "CdtrSchmeId")
-    SubElement(cdtr_schme_id, "Nm").text = dati_aziendali["nome_azienda"]
-
-    cdtr_schme_id_id = SubElement(cdtr_schme_id, "Id")
-    prvt_id = SubElement(cdtr_schme_id_id, "PrvtId")
-    othr_schme = SubElement(prvt_id, "Othr")
-    SubElement(othr_schme, "Id").text = dati_aziendali["creditor_id"]
-    schme_nm = SubElement(othr_schme, "SchmeNm")
-    SubElement(schme_nm, "Prtry").text = "SEPA"
-
-    for idx, incasso in enumerate(incassi, 1):
-        drct_dbt_tx_inf = SubElement(pmt_inf, "DrctDbtTxInf")
-
-        pmt_id = SubElement(drct_dbt_tx_inf, "PmtId")
-        SubElement(pmt_id, "InstrId").text = f"{idx:07d}"
-        SubElement(pmt_id, "EndToEndId").text = genera_end_to_end_id(msg_id, idx)
-
-        instd_amt = SubElement(drct_dbt_tx_inf, "InstdAmt")
-        instd_amt.set("Ccy", "EUR")
-        instd_amt.text = f"{float(incasso['importo']):.2f}"
-
-        drct_dbt_tx = SubElement(drct_dbt_tx_inf, "DrctDbtTx")
-        mndt_rltd_inf = SubElement(drct_dbt_tx, "MndtRltdInf")
-        SubElement(mndt_rltd_inf, "MndtId").text = genera_mandate_id(
-            dati_aziendali["prefisso_mandato"],
-            incasso["codice_fiscale"]
-        )
-        SubElement(mndt_rltd_inf, "DtOfSgntr").text = incasso["data_firma_mandato"]
+def elabora_incassi_in_background(lavoro, file_incassi, cache: CacheElaborazioni, strumentazione):
+    """Lavoro di elaborazione del CSV incassi: restituisce (elaborazione, strumentazione)."""
+    lavoro.imposta_fase("lettura, validazione e aggregazione")
+    if strumentazione is None:
+        return elabora_incassi(file_incassi, cache=cache), None
+    with strumentazione:
+        elaborazione = elabora_incassi(file_incassi, cache=cache, strumentazione=strumentazione)
+    return elaborazione, strumentazione
 
-        dbtr = SubElement(drct_dbt_tx_inf, "Dbtr")
-        SubElement(dbtr, "Nm").text = str(incasso["nome_debitore"])
 
-        dbtr_id = SubElement(dbtr, "Id")
-        dbtr_org_id = SubElement(dbtr_id, "OrgId")
-        dbtr_othr = SubElement(dbtr_org_id, "Othr")
-        SubElement(dbtr_othr, "Id").text = str(incasso["codice_fiscale"])
-        SubElement(dbtr_othr, "Issr").text = "ADE"
+def genera_flusso_in_background(lavoro, filename: str, dati_aziendali: dict, lotto, data_addebito: str,
+                                id_flusso: str, limiti: LimitiPartizione, registro_mandati: str,
+                                strumentazione: Strumentazione) -> dict:
+    """Lavoro di generazione XML: restituisce i file generati e i messaggi da mostrare.
 
-        dbtr_acct = SubElement(drct_dbt_tx_inf, "DbtrAcct")
-        dbtr_acct_id = SubElement(dbtr_acct, "Id")
-        SubElement(dbtr_acct_id, "IBAN").text = pulisci_iban(incasso["iban"])
+    La generazione è quella di CLI e batch (genera_flusso_da_lotto), su file
+    temporanei (FileGenerato) scritti in sequenza nel processo di Streamlit.
+    ``strumentazione`` (o None) è propria del lavoro e torna nel risultato.
+    """
+    report = {}
 
-        rmt_inf = SubElement(drct_dbt_tx_inf, "RmtInf")
-        causale_completa = f"{idx:019d} - {incasso['causale']}"
-        SubElement(rmt_inf, "Ustrd").text = causale_completa
+    def conserva_report(nome, dati):
+        report[nome] = dati
 
-    # Formattazione XML
-    xml_str = tostring(root, encoding="UTF-8")
-    dom = minidom.parseString(xml_str)
-    pretty_xml = dom.toprettyxml(indent="", encoding="UTF-8")
+    misura = strumentazione or NESSUNA_STRUMENTAZIONE
+    with misura:
+        riepilogo = genera_flusso_da_lotto(dati_aziendali, lotto, data_addebito, id_flusso, filename,
+                                           limiti=limiti if any(limiti) else None, processi=1,
+                                           strumentazione=misura, registro_mandati=registro_mandati,
+                                           salva_report=conserva_report, crea_file=FileGenerato, lavoro=lavoro)
 
-    lines = pretty_xml.decode("utf-8").split("\n")
-    lines = [line for line in lines if line.strip()]
-
-    final_xml = '<?xml version="1.0" encoding="UTF-8"?>\n' + "\n".join(lines[1:])
-    return final_xml.encode("utf-8")
+    messaggi = []
+    if "frst" in riepilogo:
+        messaggi.append(f"ℹ️ Registro mandati: {riepilogo['frst']} FRST, {riepilogo['rcur']} RCUR")
+    file_generati = riepilogo["file"]
+    if len(file_generati) > 1 or riepilogo.get("sottodistinte", 1) > 1:
+        messaggi.append(f"ℹ️ Flusso suddiviso in {len(file_generati)} file e "
+                        f"{riepilogo['sottodistinte']} sottodistinte")
+    xml_generati = [(file.nome, file) for file in file_generati]
+    # Il report della lettura è già mostrato: qui restano gli avvisi del registro mandati
+    return {"xml_generati": xml_generati, "messaggi": messaggi, "avvisi_registro": report.get("validazione"),
+            "diagnostica": strumentazione}
+
+
+def mostra_diagnostica(strumentazione: Strumentazione, nome: str):
+    """Pannello con tempi, righe e memoria di ogni fase misurata; ``nome`` distingue i download."""
+    report = strumentazione.report()
+    st.metric("Tempo totale", f"{report['secondi_totali']:.2f} s")
+    if report["rss_max_mb"] is not None:
+        st.metric("Picco RSS processo", f"{report['rss_max_mb']:.0f} MB")
+    st.dataframe(report["fasi"], use_container_width=True)
+    if report["tracemalloc"] or report["cprofile"]:
+        st.caption("Tempi misurati con tracemalloc/cProfile attivi: sono più alti del normale")
+    st.download_button(
+        label="📥 Scarica diagnostica (JSON)",
+        data=json.dumps(report, indent=2, ensure_ascii=False),
+        file_name=f"diagnostica_{nome}.json",
+        mime="application/json",
+        key=f"scarica_diagnostica_{nome}"
+    )
+    if report["profilo"]:
+        with st.expander("Profilo cProfile"):
+            st.code(report["profilo"])
 
 
 # ---------------- UI PRINCIPALE ----------------
 
+with st.sidebar:
+    st.header("🩺 Diagnostica")
+    diagnostica_attiva = st.toggle("Misura le fasi dell'elaborazione", key="diagnostica_attiva",
+                                   help="Tempo, righe e memoria di lettura, normalizzazione, validazione, "
+                                        "aggregazione e generazione XML. Il file incassi viene rielaborato "
+                                        "senza usare la cache.")
+    diagnostica_memoria = st.checkbox("Picco di memoria per fase (tracemalloc)", disabled=not diagnostica_attiva,
+                                      help="Rallenta molto l'elaborazione e conta anche le altre sessioni attive")
+    diagnostica_profilo = st.checkbox("Profilo cProfile", disabled=not diagnostica_attiva)
+
 st.title("💰 Generatore XML SEPA SDD CBI per Incassi Bancari")
 st.caption(f"Versione {APP_VERSION} | Ultimo aggiornamento: {LAST_UPDATE}")
 st.markdown("---")
@@ -371,32 +284,19 @@ with col1:
 
 with col2:
     uploaded_aziendale = st.file_uploader(
-        "📂 Carica CSV Dati Aziendali",
-        type=["csv"],
+        "📂 Carica Dati Aziendali (CSV, Excel, Parquet)",
+        type=ESTENSIONI_FILE,
         key="upload_aziendale"
     )
 
 if uploaded_aziendale is not None:
     try:
-        # Tentativi di lettura con encoding diversi
-        try:
-            df_aziendale = pd.read_csv(uploaded_aziendale, encoding="utf-8")
-        except UnicodeDecodeError:
-            uploaded_aziendale.seek(0)
-            try:
-                df_aziendale = pd.read_csv(uploaded_aziendale, encoding="utf-8-sig")
-            except UnicodeDecodeError:
-                uploaded_aziendale.seek(0)
-                try:
-                    df_aziendale = pd.read_csv(uploaded_aziendale, encoding="latin-1")
-                except UnicodeDecodeError:
-                    uploaded_aziendale.seek(0)
-                    df_aziendale = pd.read_csv(uploaded_aziendale, encoding="cp1252")
+        elaborazione = elabora_dati_aziendali(uploaded_aziendale, cache_elaborazioni())
+        for livello, messaggio in elaborazione.notifiche:
+            notifica_streamlit(livello, messaggio)
 
-        valido, messaggio = valida_dati_aziendali(df_aziendale)
-
-        if valido:
-            st.session_state.dati_azienda_caricati = df_aziendale.iloc[0].to_dict()
+        if elaborazione.dati is not None:
+            st.session_state.dati_azienda_caricati = elaborazione.dati
             st.success("✅ Dati Aziendali Caricati Correttamente!")
 
             with st.expander("🔍 Visualizza Dati Caricati"):
@@ -406,7 +306,7 @@ if uploaded_aziendale is not None:
                 st.write(f"**Creditor ID:** {st.session_state.dati_azienda_caricati['creditor_id']}")
                 st.write(f"**Prefisso Mandato:** {st.session_state.dati_azienda_caricati['prefisso_mandato']}")
         else:
-            st.error(f"❌ Errore: {messaggio}")
+            st.error(f"❌ Errore: {elaborazione.messaggio}")
     except Exception as e:
         st.error(f"❌ Errore nella lettura del file: {str(e)}")
 
@@ -425,15 +325,13 @@ id_flusso_input = st.text_input(
 
 if id_flusso_input:
     id_norm = id_flusso_input.strip().upper()
+    valido, messaggio = valida_id_flusso(id_norm)
 
-    if not id_norm:
-        st.error("❌ L'ID Flusso non può essere vuoto")
-        st.session_state.id_flusso = None
-    elif len(id_norm) > 12:
-        st.error("❌ L'ID Flusso deve essere massimo 12 caratteri")
+    if not valido:
+        st.error(f"❌ {messaggio}")
         st.session_state.id_flusso = None
-    elif not re.match(r"^[A-Z0-9]+$", id_norm):
-        st.warning("⚠️ L'ID Flusso dovrebbe contenere solo lettere maiuscole e numeri")
+    elif messaggio != "OK":
+        st.warning(f"⚠️ {messaggio}")
         st.session_state.id_flusso = id_norm
         st.info(f"✅ ID Flusso impostato: {st.session_state.id_flusso}")
     else:
@@ -474,87 +372,88 @@ with col1:
 
 with col2:
     uploaded_incassi = st.file_uploader(
-        "📂 Carica CSV Incassi",
-        type=["csv"],
+        "📂 Carica Incassi (CSV, Excel, Parquet)",
+        type=ESTENSIONI_FILE,
         key="upload_incassi",
-        help="Il CSV può avere o meno intestazioni. Date e importi saranno normalizzati automaticamente."
+        help="Il file può avere o meno intestazioni. Date e importi saranno normalizzati automaticamente; "
+             "da Excel e Parquet sono letti con i loro tipi."
     )
 
 if uploaded_incassi is not None:
     try:
-        def rileva_separatore(file_obj, encoding="utf-8"):
-            file_obj.seek(0)
-            try:
-                sample = file_obj.read(2048).decode(encoding, errors="ignore")
-            except Exception:
-                sample = file_obj.read(2048).decode("utf-8", errors="ignore")
-            file_obj.seek(0)
-            separatori = [",", ";", "\t", "|"]
-            conteggi = {sep: sample.count(sep) for sep in separatori}
-            sep_migliore = max(conteggi, key=conteggi.get)
-            return sep_migliore if conteggi[sep_migliore] > 0 else ","
-
-        def ha_intestazioni(file_obj, sep, encoding="utf-8"):
-            file_obj.seek(0)
-            try:
-                prima_riga = file_obj.readline().decode(encoding, errors="ignore").lower()
-            except Exception:
-                prima_riga = file_obj.readline().decode("utf-8", errors="ignore").lower()
-            file_obj.seek(0)
-            parole_chiave = ["nome_debitore", "debitore", "codice_fiscale", "causale", "data_firma"]
-            conteggio = sum(1 for parola in parole_chiave if parola in prima_riga)
-            return conteggio >= 2
-
-        df_incassi = None
-        encodings = ["utf-16", "utf-16-le", "utf-8", "utf-8-sig", "latin-1", "cp1252"]
-
-        for encoding in encodings:
-            try:
-                uploaded_incassi.seek(0)
-                sep = rileva_separatore(uploaded_incassi, encoding)
-                has_header = ha_intestazioni(uploaded_incassi, sep, encoding)
-                uploaded_incassi.seek(0)
-
-                if has_header:
-                    df_incassi = pd.read_csv(uploaded_incassi, encoding=encoding, sep=sep)
-                    st.info(f"🔍 Rilevato separatore: '{sep}' | Encoding: {encoding} | Con intestazioni")
-                else:
-                    df_incassi = pd.read_csv(uploaded_incassi, encoding=encoding, sep=sep, header=None)
-                    st.info(f"🔍 Rilevato separatore: '{sep}' | Encoding: {encoding} | Senza intestazioni")
-
-                if df_incassi is not None and len(df_incassi) > 0 and not df_incassi.iloc[0].isna().all():
-                    break
-                df_incassi = None
-            except (UnicodeDecodeError, pd.errors.ParserError, Exception):
-                df_incassi = None
-                continue
-
-        if df_incassi is not None:
-            df_processato, messaggio = processa_csv_incassi(df_incassi)
-
-            if df_processato is not None:
-                st.session_state.lista_incassi = df_processato.to_dict("records")
-
-                totale = sum(float(inc["importo"]) for inc in st.session_state.lista_incassi)
-
-                st.success(f"✅ CSV processato! {len(st.session_state.lista_incassi)} debitori aggregati")
+        misura = (uploaded_incassi.file_id, diagnostica_memoria, diagnostica_profilo)
+        # Misura una sola volta ogni file caricato, non a ogni rerun
+        da_misurare = diagnostica_attiva and st.session_state.diagnostica_file != misura
+        chiave = misura if diagnostica_attiva else (uploaded_incassi.file_id,)
+        lavoro = None
+        if st.session_state.lavoro_incassi is not None and st.session_state.lavoro_incassi[0] == chiave:
+            # Rerun durante (o dopo) l'elaborazione: ci si ricollega al lavoro
+            lavoro = st.session_state.lavoro_incassi[1]
+        if lavoro is None:
+            strumentazione = Strumentazione(memoria=diagnostica_memoria, profilo=diagnostica_profilo) \
+                if da_misurare else None
+            lavoro = coda_lavori("incassi").invia(elabora_incassi_in_background, uploaded_incassi,
+                                                  cache_elaborazioni(), strumentazione,
+                                                  descrizione=f"Elaborazione di {uploaded_incassi.name}")
+            st.session_state.lavoro_incassi = (chiave, lavoro)
+
+        elaborazione = None
+        if not lavoro.attendi(ATTESA_LAVORO_S):
+            # Finché il nuovo file non è elaborato non si genera con i debitori del precedente
+            st.session_state.lista_incassi = []
+            mostra_avanzamento(lavoro)
+        elif lavoro.stato == LAVORO_FALLITO:
+            st.session_state.lista_incassi = []
+            st.error(f"❌ Errore nella lettura del file: {lavoro.errore}")
+        else:
+            elaborazione, strumentazione = lavoro.risultato
+            if strumentazione is not None:
+                st.session_state.diagnostica = strumentazione
+                st.session_state.diagnostica_file = misura
+
+        if elaborazione is not None:
+            for livello, messaggio in elaborazione.notifiche:
+                notifica_streamlit(livello, messaggio)
+
+            if len(elaborazione.errori):
+                bloccanti = int((elaborazione.errori["gravita"] == "errore").sum())
+                with st.expander(f"🧾 Report validazione: {bloccanti} errori, "
+                                 f"{len(elaborazione.errori) - bloccanti} avvisi", expanded=bloccanti > 0):
+                    st.dataframe(elaborazione.errori.head(1000), use_container_width=True)
+                    if len(elaborazione.errori) > 1000:
+                        st.caption(f"Mostrate le prime 1000 di {len(elaborazione.errori)} segnalazioni")
+                    st.download_button(
+                        label="📥 Scarica report validazione",
+                        data=elaborazione.errori.to_csv(index=False),
+                        file_name="report_validazione.csv",
+                        mime="text/csv"
+                    )
+
+            if elaborazione.lotto is not None:
+                st.session_state.lista_incassi = elaborazione.lotto
+                st.session_state.totali_incassi = st.session_state.lista_incassi.totali()
+
+                numero_debitori, totale_centesimi = st.session_state.totali_incassi
+
+                st.success(f"✅ CSV processato! {numero_debitori} debitori aggregati")
 
                 col_a, col_b, col_c = st.columns(3)
                 with col_a:
-                    st.metric("Numero Debitori", len(st.session_state.lista_incassi))
+                    st.metric("Numero Debitori", numero_debitori)
                 with col_b:
-                    st.metric("Totale Incassi", f"€ {totale:.2f}")
+                    st.metric("Totale Incassi", f"€ {formatta_centesimi(totale_centesimi)}")
                 with col_c:
-                    st.metric("Media per Debitore", f"€ {totale/len(st.session_state.lista_incassi):.2f}")
+                    st.metric("Media per Debitore", f"€ {totale_centesimi / numero_debitori / 100:.2f}")
 
                 with st.expander("🔍 Visualizza Debitori Aggregati"):
-                    st.dataframe(df_processato, use_container_width=True)
+                    pagina, per_pagina = selettore_pagina(numero_debitori, RIGHE_PER_PAGINA,
+                                                          f"debitori_{numero_debitori}")
+                    st.dataframe(elaborazione.lotto.pagina((pagina - 1) * per_pagina, per_pagina),
+                                 use_container_width=True)
 
                 st.info("ℹ️ I debitori con lo stesso IBAN sono stati aggregati sommando gli importi e unendo le causali")
             else:
-                st.error(f"❌ Errore: {messaggio}")
-        else:
-            st.error("❌ Impossibile leggere il file CSV. Verifica il formato del file.")
+                st.error(f"❌ Errore: {elaborazione.messaggio}")
 
     except Exception as e:
         st.error(f"❌ Errore nella lettura del file: {str(e)}")
@@ -572,33 +471,132 @@ if (
 ):
     st.info("✅ Tutti i dati sono pronti! Puoi generare il file XML SEPA CBI.")
 
-    if st.button("🚀 Genera XML SEPA CBI", type="primary", use_container_width=True):
-        try:
-            xml_content = genera_xml_cbi(
-                st.session_state.dati_azienda_caricati,
-                st.session_state.lista_incassi,
-                st.session_state.data_addebito,
-                st.session_state.id_flusso
-            )
+    with st.expander("⚙️ Suddivisione del flusso (facoltativa)"):
+        st.caption("0 = nessun limite. I flussi grandi possono essere divisi in più sottodistinte e più file.")
+        col_a, col_b, col_c = st.columns(3)
+        with col_a:
+            max_tx_sottodistinta = st.number_input("Max transazioni per sottodistinta", min_value=0, value=0, step=1000)
+        with col_b:
+            max_tx_file = st.number_input("Max transazioni per file", min_value=0, value=0, step=1000)
+        with col_c:
+            max_mb_file = st.number_input("Max MB per file", min_value=0.0, value=0.0, step=1.0)
+    limiti = LimitiPartizione(
+        max_tx_sottodistinta=int(max_tx_sottodistinta) or None,
+        max_tx_file=int(max_tx_file) or None,
+        max_byte_file=int(max_mb_file * 1024 * 1024) or None,
+    )
 
-            filename = f"SEPA_SDD_CBI_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xml"
+    registro_mandati = ""
+    with st.expander("📚 Registro mandati (facoltativo)"):
+        if not os.environ.get(VARIABILE_CARTELLA_REGISTRI):
+            st.caption(f"Non disponibile: imposta {VARIABILE_CARTELLA_REGISTRI} con la directory dei registri "
+                       "prima di avviare l'applicazione.")
+        else:
+            nome_registro = st.text_input(
+                "Nome del registro",
+                value="",
+                help="Con il registro SeqTp è FRST per i mandati mai incassati (o con IBAN cambiato) e RCUR "
+                     "per gli altri; le date di firma note vengono dal registro. Gli incassi generati "
+                     "vengono registrati: genera il flusso solo se verrà presentato in banca."
+            ).strip()
+            if nome_registro:
+                try:
+                    registro_mandati = percorso_registro(nome_registro)
+                except ValueError as e:
+                    st.error(f"❌ {e}")
+                    registro_mandati = None
+
+    # La generazione gira in background: i rerun (anche cambiando altri widget) si ricollegano al lavoro
+    lavoro = st.session_state.lavoro_generazione
+    in_corso = lavoro is not None and not lavoro.terminato
+
+    if st.button("🚀 Genera XML SEPA CBI", type="primary", use_container_width=True,
+                 disabled=in_corso or registro_mandati is None):
+        # Ogni generazione ha la sua strumentazione, pubblicata nella sessione solo a lavoro terminato
+        strumentazione = Strumentazione(memoria=diagnostica_memoria, profilo=diagnostica_profilo) \
+            if diagnostica_attiva else None
+        lavoro = coda_lavori("generazione").invia(
+            genera_flusso_in_background,
+            f"SEPA_SDD_CBI_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xml",
+            dict(st.session_state.dati_azienda_caricati),
+            st.session_state.lista_incassi,
+            st.session_state.data_addebito,
+            st.session_state.id_flusso,
+            limiti,
+            registro_mandati,
+            strumentazione,
+            descrizione="Generazione XML SEPA CBI"
+        )
+        st.session_state.lavoro_generazione = lavoro
 
+    if lavoro is not None:
+        if not lavoro.attendi(ATTESA_LAVORO_S):
+            mostra_avanzamento(lavoro)
+        else:
+            st.session_state.lavoro_generazione = None
+            if lavoro.stato == LAVORO_FALLITO:
+                st.error(f"❌ Errore nella generazione del file XML: {lavoro.errore}")
+            else:
+                st.session_state.xml_generati = lavoro.risultato["xml_generati"]
+                st.session_state.indici_xml = {}
+                st.session_state.esito_generazione = lavoro.risultato
+                st.session_state.diagnostica_generazione = lavoro.risultato["diagnostica"]
+                st.success(f"✅ File XML SEPA CBI generato con successo in {lavoro.durata():.1f} s!")
+                st.balloons()
+
+    esito = st.session_state.esito_generazione
+    if esito is not None and st.session_state.xml_generati is esito["xml_generati"]:
+        for messaggio in esito["messaggi"]:
+            st.info(messaggio)
+        if esito["avvisi_registro"] is not None:
+            with st.expander(f"⚠️ {len(esito['avvisi_registro'])} avvisi dal registro mandati"):
+                st.dataframe(esito["avvisi_registro"].head(1000), use_container_width=True)
+
+    # Download e anteprima restano disponibili anche nei rerun successivi; i file sono
+    # letti (ed eventualmente compressi) solo al click, non a ogni rerun
+    xml_generati = st.session_state.xml_generati
+    if xml_generati:
+        formato = st.radio("Formato download", FORMATI_DOWNLOAD, horizontal=True, key="formato_download",
+                           help="ZIP raccoglie in un unico archivio tutti i file del flusso")
+        if formato == "ZIP":
             st.download_button(
-                label="💾 Scarica File XML",
-                data=xml_content,
-                file_name=filename,
-                mime="application/xml",
-                use_container_width=True
+                label="💾 Scarica archivio ZIP",
+                data=partial(zip_generati, xml_generati),
+                file_name=f"{xml_generati[0][0].rsplit('.', 1)[0]}.zip",
+                mime="application/zip",
+                use_container_width=True,
+                key="download_zip"
             )
+        else:
+            for numero, (nome, file) in enumerate(xml_generati, 1):
+                compresso = formato == "gzip"
+                st.download_button(
+                    label=("💾 Scarica File XML" if len(xml_generati) == 1 else f"💾 Scarica {nome}")
+                    + (" (gzip)" if compresso else ""),
+                    data=partial(gzip_generato, nome, file) if compresso else file.leggi,
+                    file_name=f"{nome}.gz" if compresso else nome,
+                    mime="application/gzip" if compresso else "application/xml",
+                    use_container_width=True,
+                    key=f"download_{formato}_{numero}"
+                )
 
-            st.success("✅ File XML SEPA CBI generato con successo!")
-            st.balloons()
-
-            with st.expander("📄 Anteprima XML"):
-                st.code(xml_content.decode("utf-8"), language="xml")
-
-        except Exception as e:
-            st.error(f"❌ Errore nella generazione del file XML: {str(e)}")
+    if xml_generati:
+        with st.expander("📄 Anteprima XML"):
+            scelto = 0
+            if len(xml_generati) > 1:
+                scelto = st.selectbox("File", range(len(xml_generati)),
+                                      format_func=lambda i: xml_generati[i][0], key="anteprima_file")
+            indice = indice_xml(scelto)
+            vista = st.radio("Vista", ["Riepilogo", "Transazioni"], horizontal=True, key="anteprima_vista")
+
+            if vista == "Riepilogo":
+                st.write(f"**{len(indice)}** transazioni, {indice.dimensione / 1024 / 1024:.2f} MB")
+                st.code(indice.intestazione(), language="xml")
+                st.caption(f"... {len(indice)} elementi DrctDbtTxInf ...")
+                st.code(indice.coda(), language="xml")
+            else:
+                pagina, per_pagina = selettore_pagina(len(indice), TRANSAZIONI_PER_PAGINA, f"anteprima_{scelto}")
+                st.code(indice.pagina(pagina, per_pagina), language="xml")
 else:
     messaggi = []
     if not st.session_state.dati_azienda_caricati:
@@ -615,6 +613,19 @@ else:
 st.markdown("---")
 st.info("ℹ️ Il file XML generato è compatibile con il formato CBI (Corporate Banking Interbancario) e pronto per essere caricato nel tuo sistema di home banking.")
 
+if diagnostica_attiva:
+    with st.sidebar:
+        st.subheader("Elaborazione incassi")
+        if st.session_state.diagnostica is not None:
+            mostra_diagnostica(st.session_state.diagnostica, "incassi")
+        else:
+            st.caption("Carica un CSV incassi per misurarne l'elaborazione")
+        st.subheader("Generazione XML")
+        if st.session_state.diagnostica_generazione is not None:
+            mostra_diagnostica(st.session_state.diagnostica_generazione, "generazione")
+        else:
+            st.caption("Genera un flusso per misurarne la scrittura")
+
 # Footer
 st.markdown("---")
 st.caption(f"Generatore XML SEPA SDD CBI v{APP_VERSION} | Formato: CBIBdySDDReq.00.01.00 | Aggregazione automatica debitori | Ultimo aggiornamento: {LAST_UPDATE}")
@@ -0,0 +1,450 @@
+"""
+Generatore XML SEPA SDD CBI - servizio HTTP locale - sdd_xml_server.py
+Descrizione: espone elaborazione, validazione e generazione dei flussi come API HTTP
+             (per ERP e script), eseguite da processi di lavoro già avviati
+
+Endpoint:
+    GET  /salute                 stato del servizio (JSON)
+    POST /valida                 report di validazione del CSV incassi (JSON)
+    POST /elabora                debitori aggregati e totali del CSV incassi (JSON)
+    POST /genera?data_addebito=YYYY-MM-DD&id_flusso=ID
+                                 flusso XML (un ZIP se suddiviso in più file)
+
+Il file incassi (CSV, xlsx, Parquet o Arrow) è il corpo della richiesta (anche
+in chunked transfer) oppure il campo ``incassi`` di un form multipart; in
+/genera il campo facoltativo ``azienda`` sostituisce i dati aziendali di
+default (``--azienda``).
+Parametri facoltativi di /genera: max_tx_sottodistinta, max_tx_file,
+max_mb_file, comprimi (zip o gzip). Gli errori sono restituiti in JSON
+con il campo ``errore`` (e ``report`` per gli errori di validazione).
+
+Esempio:
+    python sdd_xml_server.py --azienda dati_aziendali.csv --porta 8080
+    curl --data-binary @incassi.csv -o flusso.xml \\
+        "http://127.0.0.1:8080/genera?data_addebito=2025-03-10&id_flusso=FLX9J372"
+"""
+
+import argparse
+import email.policy
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from email.parser import BytesParser
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+
+from sdd_xml_core import (carica_dati_aziendali, comprimi_flusso, crea_template_incassi, elabora_incassi,
+                          FORMATI_COMPRESSIONE, formatta_centesimi, genera_flusso_da_file, genera_message_id,
+                          LimitiPartizione, valida_data_addebito, valida_id_flusso)
+
+logger = logging.getLogger("sdd_xml_server")
+
+MAX_MB_RICHIESTA = 200
+BLOCCO_RISPOSTA = 1024 * 1024
+TIPI_CONTENUTO = {".xml": "application/xml", ".zip": "application/zip", ".gz": "application/gzip"}
+
+
+class ErroreRichiesta(Exception):
+    """Richiesta rifiutata: ``stato`` è il codice HTTP, ``dettagli`` i campi aggiunti alla risposta JSON."""
+
+    def __init__(self, stato: HTTPStatus, messaggio: str, **dettagli):
+        super().__init__(messaggio)
+        self.stato = stato
+        self.dettagli = dettagli
+
+
+# ---------------- PROCESSI DI LAVORO ----------------
+# Funzioni eseguite nei processi del pool: ricevono e restituiscono solo dati serializzabili
+
+def _inizializza_processo():
+    # Ctrl-C arriva a tutto il gruppo di processi: l'arresto è gestito dal server
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def riscalda() -> int:
+    """Prepara un processo di lavoro elaborando il template incassi (import e primo uso di pandas)."""
+    elabora_incassi(BytesIO(crea_template_incassi().encode("utf-8")))
+    return os.getpid()
+
+
+def _record(df: pd.DataFrame) -> list:
+    return json.loads(df.to_json(orient="records", force_ascii=False))
+
+
+def elabora(incassi: bytes, con_debitori: bool = True) -> dict:
+    """Validazione e aggregazione del CSV incassi.
+
+    Con ``con_debitori`` la risposta contiene anche i debitori aggregati.
+    """
+    elaborazione = elabora_incassi(BytesIO(incassi))
+    errori = int((elaborazione.errori["gravita"] == "errore").sum()) if len(elaborazione.errori) else 0
+    risposta = {
+        "valido": elaborazione.lotto is not None,
+        "messaggio": elaborazione.messaggio,
+        "errori": errori,
+        "avvisi": len(elaborazione.errori) - errori,
+        "report": _record(elaborazione.errori),
+        "notifiche": [{"livello": livello, "messaggio": messaggio} for livello, messaggio in elaborazione.notifiche],
+    }
+    if elaborazione.lotto is not None:
+        numero_debitori, totale_centesimi = elaborazione.lotto.totali()
+        risposta.update(nb_of_txs=numero_debitori, ctrl_sum=formatta_centesimi(totale_centesimi))
+        if con_debitori:
+            risposta["debitori"] = _record(elaborazione.lotto.pagina(0, numero_debitori))
+    return risposta
+
+
+def genera(cartella: str, incassi: bytes, azienda: bytes, data_addebito: str, id_flusso: str,
+           limiti: LimitiPartizione, compressione: str, allocatore: str = None, msg_id: str = None) -> dict:
+    """Genera il flusso in ``cartella`` con genera_flusso_da_file.
+
+    Restituisce il riepilogo con il file da inviare (``invio``: un ZIP se il
+    flusso è suddiviso in più file non compressi) oppure ``errore`` e
+    ``report`` se i dati non sono validi.
+    """
+    cartella = Path(cartella)
+    percorso_incassi = cartella / "incassi.csv"
+    percorso_incassi.write_bytes(incassi)
+    percorso_azienda = cartella / "azienda.csv"
+    percorso_azienda.write_bytes(azienda)
+    destinazione = cartella / f"SEPA_SDD_CBI_{id_flusso}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xml"
+
+    try:
+        dati_aziendali = carica_dati_aziendali(percorso_azienda)
+    except ValueError as e:
+        return {"errore": f"Dati aziendali non validi: {e}", "report": []}
+    try:
+        riepilogo = genera_flusso_da_file(dati_aziendali, percorso_incassi, data_addebito, id_flusso,
+                                          destinazione, limiti=limiti, processi=1, compressione=compressione,
+                                          allocatore=allocatore, msg_id=msg_id)
+    except ValueError as e:
+        percorso_report = destinazione.with_name(f"{destinazione.stem}_validazione.csv")
+        report = pd.read_csv(percorso_report, dtype=str, keep_default_na=False) if percorso_report.exists() else None
+        return {"errore": str(e), "report": _record(report) if report is not None else []}
+
+    file = riepilogo["file"]
+    riepilogo["invio"] = comprimi_flusso(file, "zip", destinazione)[0] if len(file) > 1 else file[0]
+    return riepilogo
+
+
+# ---------------- SERVIZIO HTTP ----------------
+
+def leggi_multipart(tipo_contenuto: str, corpo: bytes) -> dict:
+    """Campi di un corpo multipart/form-data: {nome: contenuto in byte}."""
+    messaggio = BytesParser(policy=email.policy.HTTP).parsebytes(
+        b"Content-Type: " + tipo_contenuto.encode("latin-1") + b"\r\n\r\n" + corpo
+    )
+    if not messaggio.is_multipart():
+        raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Corpo multipart non valido")
+    return {parte.get_param("name", header="content-disposition"): parte.get_payload(decode=True) or b""
+            for parte in messaggio.iter_parts()}
+
+
+def _parametro_numero(parametri: dict, nome: str, tipo):
+    valore = parametri.get(nome)
+    if not valore:
+        return None
+    try:
+        numero = tipo(valore)
+    except ValueError:
+        raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"Parametro {nome} non valido: {valore}")
+    if numero <= 0:
+        raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"Parametro {nome} deve essere positivo")
+    return numero
+
+
+class GestoreRichieste(BaseHTTPRequestHandler):
+    """Gestisce una richiesta HTTP: legge il corpo, delega al pool e risponde."""
+
+    server_version = "SDDXml/1.0"
+    protocol_version = "HTTP/1.1"
+    # Secondi di inattività del client prima di chiudere la connessione
+    timeout = 120
+
+    def log_message(self, formato, *argomenti):
+        logger.info("%s %s", self.address_string(), formato % argomenti)
+
+    def do_GET(self):
+        if urlsplit(self.path).path == "/salute":
+            self._rispondi_json(HTTPStatus.OK, self.server.stato())
+        else:
+            self._rispondi_json(HTTPStatus.NOT_FOUND, {"errore": f"Endpoint sconosciuto: {self.path}"})
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        operazione = {"/valida": self._valida, "/elabora": self._elabora, "/genera": self._genera}.get(url.path)
+        if operazione is None:
+            self.close_connection = True
+            self._rispondi_json(HTTPStatus.NOT_FOUND, {"errore": f"Endpoint sconosciuto: {url.path}"})
+            return
+        if not self.server.occupa_posto():
+            # Il corpo non viene letto: la connessione va chiusa
+            self.close_connection = True
+            self._rispondi_json(HTTPStatus.SERVICE_UNAVAILABLE,
+                                {"errore": "Troppe richieste in corso, riprova più tardi"},
+                                {"Retry-After": "5"})
+            return
+        try:
+            parametri = {nome: valori[-1] for nome, valori in parse_qs(url.query).items()}
+            operazione(self._leggi_corpo(), parametri)
+        except ErroreRichiesta as e:
+            self.close_connection = True
+            self._rispondi_json(e.stato, {"errore": str(e), **e.dettagli})
+        except Exception as e:
+            logger.exception("Errore nella richiesta %s", self.path)
+            self.close_connection = True
+            self._rispondi_json(HTTPStatus.INTERNAL_SERVER_ERROR, {"errore": f"{type(e).__name__}: {e}"})
+        finally:
+            self.server.libera_posto()
+
+    # ---- lettura della richiesta ----
+
+    def _leggi_corpo(self) -> dict:
+        """Campi della richiesta: quelli del form multipart, altrimenti il corpo come ``incassi``."""
+        massimo = self.server.max_byte
+        if "chunked" in self.headers.get("Transfer-Encoding", "").lower():
+            corpo = self._leggi_chunked(massimo)
+        else:
+            try:
+                lunghezza = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Content-Length non valido")
+            if lunghezza > massimo:
+                raise ErroreRichiesta(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                      f"Richiesta oltre il limite di {massimo} byte")
+            corpo = self.rfile.read(lunghezza)
+        if self.headers.get_content_type() == "multipart/form-data":
+            return leggi_multipart(self.headers["Content-Type"], corpo)
+        return {"incassi": corpo}
+
+    def _leggi_chunked(self, massimo: int) -> bytes:
+        parti, totale = [], 0
+        while True:
+            riga = self.rfile.readline(65537)
+            try:
+                dimensione = int(riga.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, "Chunked transfer non valido")
+            if dimensione == 0:
+                # Eventuali trailer fino alla riga vuota
+                while self.rfile.readline(65537) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(parti)
+            totale += dimensione
+            if totale > massimo:
+                raise ErroreRichiesta(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                                      f"Richiesta oltre il limite di {massimo} byte")
+            parti.append(self.rfile.read(dimensione))
+            self.rfile.readline()
+
+    @staticmethod
+    def _incassi(campi: dict) -> bytes:
+        incassi = campi.get("incassi")
+        if not incassi:
+            raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, "CSV incassi mancante (corpo o campo 'incassi')")
+        return incassi
+
+    # ---- operazioni ----
+
+    def _valida(self, campi: dict, parametri: dict):
+        risposta = self.server.esegui(elabora, self._incassi(campi), False)
+        self._rispondi_json(HTTPStatus.OK, risposta)
+
+    def _elabora(self, campi: dict, parametri: dict):
+        risposta = self.server.esegui(elabora, self._incassi(campi), True)
+        self._rispondi_json(HTTPStatus.OK if risposta["valido"] else HTTPStatus.UNPROCESSABLE_ENTITY, risposta)
+
+    def _genera(self, campi: dict, parametri: dict):
+        incassi = self._incassi(campi)
+        azienda = campi.get("azienda") or self.server.azienda
+        if not azienda:
+            raise ErroreRichiesta(HTTPStatus.BAD_REQUEST,
+                                  "CSV aziendale mancante (campo 'azienda' o --azienda del servizio)")
+        data_addebito = parametri.get("data_addebito", "")
+        valido, messaggio = valida_data_addebito(data_addebito)
+        if not valido:
+            raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"data_addebito: {messaggio}")
+        id_flusso = parametri.get("id_flusso", "").strip().upper()
+        valido, messaggio = valida_id_flusso(id_flusso)
+        if not valido:
+            raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, messaggio)
+        compressione = parametri.get("comprimi") or None
+        if compressione is not None and compressione not in FORMATI_COMPRESSIONE:
+            raise ErroreRichiesta(HTTPStatus.BAD_REQUEST, f"comprimi deve essere uno di: "
+                                                          f"{', '.join(FORMATI_COMPRESSIONE)}")
+        max_mb_file = _parametro_numero(parametri, "max_mb_file", float)
+        limiti = LimitiPartizione(
+            max_tx_sottodistinta=_parametro_numero(parametri, "max_tx_sottodistinta", int),
+            max_tx_file=_parametro_numero(parametri, "max_tx_file", int),
+            max_byte_file=int(max_mb_file * 1024 * 1024) if max_mb_file else None,
+        )
+
+        # Senza allocatore il MsgId è assegnato qui, nel processo del server: due richieste
+        # concorrenti con lo stesso ID flusso non ricevono lo stesso MsgId dai processi di lavoro
+        msg_id = None if self.server.allocatore else genera_message_id(id_flusso)
+        cartella = tempfile.mkdtemp(prefix="sdd_server_")
+        try:
+            riepilogo = self.server.esegui(genera, cartella, incassi, azienda, data_addebito, id_flusso,
+                                           limiti if any(limiti) else None, compressione, self.server.allocatore,
+                                           msg_id)
+            if "errore" in riepilogo:
+                raise ErroreRichiesta(HTTPStatus.UNPROCESSABLE_ENTITY, riepilogo["errore"],
+                                      report=riepilogo["report"])
+            self._rispondi_file(Path(riepilogo["invio"]), {
+                "X-SDD-NbOfTxs": str(riepilogo["nb_of_txs"]),
+                "X-SDD-CtrlSum": riepilogo["ctrl_sum"],
+                "X-SDD-File": str(len(riepilogo["file"])),
+            })
+        finally:
+            shutil.rmtree(cartella, ignore_errors=True)
+
+    # ---- risposte ----
+
+    def _rispondi_json(self, stato: HTTPStatus, dati: dict, intestazioni: dict = None):
+        corpo = json.dumps(dati, ensure_ascii=False).encode("utf-8")
+        self.send_response(stato)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(corpo)))
+        for nome, valore in (intestazioni or {}).items():
+            self.send_header(nome, valore)
+        if self.close_connection:
+            self.send_header("Connection", "close")
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def _rispondi_file(self, percorso: Path, intestazioni: dict):
+        """Invia il file a blocchi, senza caricarlo in memoria."""
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", TIPI_CONTENUTO.get(percorso.suffix, "application/octet-stream"))
+        self.send_header("Content-Length", str(percorso.stat().st_size))
+        self.send_header("Content-Disposition", f'attachment; filename="{percorso.name}"')
+        for nome, valore in intestazioni.items():
+            self.send_header(nome, valore)
+        self.end_headers()
+        with open(percorso, "rb") as f:
+            shutil.copyfileobj(f, self.wfile, BLOCCO_RISPOSTA)
+
+
+class ServizioSdd(ThreadingHTTPServer):
+    """Server HTTP con un pool di processi di lavoro già avviati.
+
+    Al più ``max_richieste`` richieste sono accettate contemporaneamente
+    (le altre ricevono 503); quelle oltre ``processi`` attendono un processo
+    libero. I corpi oltre ``max_byte`` sono rifiutati con 413.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, indirizzo: tuple, processi: int = None, max_richieste: int = None,
+                 max_byte: int = MAX_MB_RICHIESTA * 1024 * 1024, azienda: bytes = None, allocatore: str = None):
+        super().__init__(indirizzo, GestoreRichieste)
+        self.processi = processi or os.cpu_count() or 1
+        self.max_richieste = max_richieste or 2 * self.processi
+        self.max_byte = max_byte
+        self.azienda = azienda
+        self.allocatore = allocatore
+        # Richieste accettate e non ancora concluse, protette da _lock_posti
+        self.in_corso = 0
+        self._lock_posti = threading.Lock()
+        # spawn: i processi non ereditano thread e socket del server
+        self.pool = ProcessPoolExecutor(max_workers=self.processi, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=_inizializza_processo)
+        self.avvio = time.time()
+
+    def riscalda(self) -> set:
+        """Avvia tutti i processi di lavoro e li prepara; restituisce i loro PID."""
+        return {future.result() for future in [self.pool.submit(riscalda) for _ in range(self.processi)]}
+
+    def occupa_posto(self) -> bool:
+        """Accetta una richiesta se ce ne sono meno di ``max_richieste`` in corso."""
+        with self._lock_posti:
+            if self.in_corso >= self.max_richieste:
+                return False
+            self.in_corso += 1
+            return True
+
+    def libera_posto(self):
+        with self._lock_posti:
+            self.in_corso -= 1
+
+    def esegui(self, funzione, *argomenti):
+        """Esegue ``funzione`` in un processo di lavoro e ne attende il risultato."""
+        return self.pool.submit(funzione, *argomenti).result()
+
+    def stato(self) -> dict:
+        return {
+            "stato": "ok",
+            "processi": self.processi,
+            "max_richieste": self.max_richieste,
+            "richieste_in_corso": self.in_corso,
+            "max_byte_richiesta": self.max_byte,
+            "azienda_default": self.azienda is not None,
+            "allocatore": self.allocatore is not None,
+            "attivo_da_s": round(time.time() - self.avvio),
+        }
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown(cancel_futures=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Servizio HTTP locale per validare e generare flussi SDD.")
+    parser.add_argument("--host", default="127.0.0.1", help="indirizzo di ascolto (default: solo locale)")
+    parser.add_argument("--porta", type=int, default=8080)
+    parser.add_argument("--azienda", help="CSV con i dati aziendali usati se la richiesta non li contiene")
+    parser.add_argument("--processi", type=int, default=None, help="processi di lavoro (default: tutti i core)")
+    parser.add_argument("--max-richieste", type=int, default=None,
+                        help="richieste accettate contemporaneamente (default: 2 per processo)")
+    parser.add_argument("--max-mb", type=float, default=MAX_MB_RICHIESTA,
+                        help=f"dimensione massima del corpo di una richiesta (default: {MAX_MB_RICHIESTA} MB)")
+    parser.add_argument("--allocatore", metavar="FILE",
+                        help="database SQLite che assegna MsgId univoci tra le richieste e rifiuta (422) gli "
+                             "incassi già generati")
+    parser.add_argument("-v", "--verbose", action="store_true", help="registra ogni richiesta")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    azienda = None
+    if args.azienda:
+        try:
+            carica_dati_aziendali(args.azienda)
+        except (OSError, ValueError) as e:
+            logger.error("Dati aziendali non validi (%s): %s", args.azienda, e)
+            return 1
+        azienda = Path(args.azienda).read_bytes()
+
+    servizio = ServizioSdd((args.host, args.porta), args.processi, args.max_richieste,
+                           int(args.max_mb * 1024 * 1024), azienda,
+                           str(Path(args.allocatore).resolve()) if args.allocatore else None)
+    # SIGTERM (es. arresto del servizio di sistema) come Ctrl-C: chiude server e pool
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        processi = servizio.riscalda()
+        print(f"Servizio SDD su http://{args.host}:{servizio.server_address[1]} "
+              f"({len(processi)} processi di lavoro pronti)", flush=True)
+        servizio.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servizio.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
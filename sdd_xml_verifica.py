@@ -0,0 +1,72 @@
+"""
+Generatore XML SEPA SDD CBI - verifica dei flussi - sdd_xml_verifica.py
+Descrizione: verifica flussi XML CBI già generati (anche .xml.gz o dentro uno
+             ZIP) leggendoli a blocchi: totali NbOfTxs/CtrlSum, unicità di
+             InstrId ed EndToEndId, lunghezze e set di caratteri, IBAN e,
+             con --xsd, lo schema CBIBdySDDReq
+
+Esempio:
+    python sdd_xml_verifica.py flussi/SEPA_SDD_CBI_marzo.xml --xsd CBIBdySDDReq.00.01.00.xsd --report
+"""
+
+import argparse
+import logging
+import sys
+import zipfile
+from pathlib import Path
+
+from sdd_xml_core import COLONNE_REPORT_VERIFICA, riepilogo_verifica, verifica_flusso
+
+logger = logging.getLogger("sdd_xml_verifica")
+
+
+def flussi_da_verificare(percorsi):
+    """Terne (nome, sorgente, report) dei flussi da verificare: i file ZIP sono espansi nei loro XML."""
+    for percorso in map(Path, percorsi):
+        if zipfile.is_zipfile(percorso):
+            with zipfile.ZipFile(percorso) as archivio:
+                for nome in archivio.namelist():
+                    if nome.lower().endswith(".xml"):
+                        with archivio.open(nome) as f:
+                            yield (f"{percorso}:{nome}", f,
+                                   percorso.with_name(f"{Path(nome).stem}_verifica.csv"))
+        else:
+            yield str(percorso), percorso, percorso.with_name(f"{percorso.name.split('.')[0]}_verifica.csv")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Verifica flussi XML SEPA SDD CBI già generati.")
+    parser.add_argument("flussi", nargs="+", help="file XML, .xml.gz o ZIP di file XML")
+    parser.add_argument("--xsd", metavar="FILE", help="schema XSD CBIBdySDDReq con cui validare (richiede lxml)")
+    parser.add_argument("--report", action="store_true",
+                        help="salva i problemi di ogni flusso in <nome>_verifica.csv accanto al file")
+    parser.add_argument("--processi", type=int, default=None,
+                        help="processi per verificare i blocchi del file (default: tutti i core)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="mostra tutti i problemi trovati")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s %(message)s")
+
+    errori = 0
+    for nome, sorgente, percorso_report in flussi_da_verificare(args.flussi):
+        try:
+            esito = verifica_flusso(sorgente, args.xsd, args.processi)
+        except (OSError, ValueError) as e:
+            errori += 1
+            logger.error("%s: %s", nome, e)
+            continue
+        print(f"{nome}: {riepilogo_verifica(esito)}")
+        if not esito.valido:
+            errori += 1
+        for riga in esito.report.itertuples(index=False):
+            logger.info("  messaggio %s, transazione %s, %s %r: %s (%s)", riga.messaggio, riga.transazione,
+                        riga.campo, riga.valore, riga.errore, riga.gravita)
+        if args.report and len(esito.report):
+            esito.report[COLONNE_REPORT_VERIFICA].to_csv(percorso_report, index=False)
+            print(f"  report: {percorso_report}")
+
+    return 1 if errori else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())